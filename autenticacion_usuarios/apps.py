@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AutenticacionUsuariosConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'autenticacion_usuarios'
+
+    def ready(self):
+        from . import signals  # noqa: F401 (registra las señales de invalidación)
@@ -0,0 +1,113 @@
+"""
+CU1: Contexto del usuario de la petición
+
+`ContextoUsuarioMiddleware` deja en `request.usuario` el usuario de la sesión
+con su rol y, si es cliente, su Cliente, resueltos con una sola consulta
+(`select_related('id_rol', 'cliente')`). Se evalúa al primer acceso: las
+peticiones que no lo usan no leen la sesión ni la BD.
+
+El resultado se guarda en la caché local con una clave que incluye la versión
+de 'usuarios'; toda escritura de usuarios, clientes o roles llama a
+`invalidar_usuarios()` (señales en signals.py) y las entradas anteriores dejan
+de consultarse. `request.usuario` es falso si no hay sesión o el usuario ya no
+existe.
+
+Con varios workers: los contextos viven en la caché USUARIO_CACHE_ALIAS
+('default', LocMem por omisión: una por proceso), pero la versión se guarda en
+la caché compartida (VERSIONES_CACHE_ALIAS, ver productos/cache_catalogo.py),
+así que una invalidación deja de servir el contexto anterior en todos los
+workers en su siguiente petición.
+La sesión puede venir de la BD o de un token firmado (tokens.py).
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.functional import SimpleLazyObject
+
+from productos.cache_catalogo import invalidar_datos, version_datos
+from .models import Cliente, Usuario
+from .tokens import quitar_cookie_token, sesion_de_token
+
+
+def _cache():
+    return caches[getattr(settings, 'USUARIO_CACHE_ALIAS', 'default')]
+
+
+def _clave(user_id):
+    return f"usuario:{user_id}:{version_datos('usuarios')}"
+
+
+def invalidar_usuarios():
+    """Descartar los contextos cacheados (al modificar usuarios, clientes o roles)"""
+    invalidar_datos('usuarios')
+
+
+# ==========================================================
+# RESOLUCIÓN DEL USUARIO
+# ==========================================================
+
+def cargar_usuario(user_id):
+    """Usuario con rol y cliente (cacheado por versión), o None si no existe"""
+    clave = _clave(user_id)
+    cache = _cache()
+    usuario = cache.get(clave)
+    if usuario is None:
+        usuario = Usuario.objects.select_related('id_rol', 'cliente').filter(pk=user_id).first()
+        if usuario is None:
+            return None
+        cache.set(clave, usuario, timeout=getattr(settings, 'USUARIO_CACHE_TTL', 300))
+    return usuario
+
+
+def usuario_de_sesion(request):
+    if not request.session.get('is_authenticated'):
+        return None
+    user_id = request.session.get('user_id')
+    return cargar_usuario(user_id) if user_id else None
+
+
+class ContextoUsuarioMiddleware:
+    """
+    Expone `request.usuario` (perezoso) para todas las vistas. Si la petición
+    trae un token de sesión (ver tokens.py), la sesión sale del token y no de la BD.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sesion = sesion_de_token(request)
+        if sesion:
+            request.session = sesion
+        request.usuario = SimpleLazyObject(lambda: usuario_de_sesion(request))
+        response = self.get_response(request)
+
+        # Cookie con un token inválido, revocado o recién cerrado: se borra
+        if sesion is False or (sesion and sesion.desde_cookie and sesion.revocada):
+            quitar_cookie_token(response)
+        return response
+
+
+# ==========================================================
+# VERIFICACIONES COMPARTIDAS
+# ==========================================================
+
+def _rol(usuario):
+    return usuario.id_rol.nombre.lower() if usuario else ''
+
+
+def es_admin(usuario):
+    return _rol(usuario) == 'administrador'
+
+
+def es_cliente(usuario):
+    return _rol(usuario) == 'cliente'
+
+
+def cliente_de(usuario):
+    """Cliente del usuario (ya cargado con el contexto, sin consulta), o None"""
+    if not usuario:
+        return None
+    try:
+        return usuario.cliente
+    except Cliente.DoesNotExist:
+        return None
@@ -0,0 +1,20 @@
+"""
+CU1: Invalidación del contexto de usuario
+
+Toda escritura de Usuario, Rol o Cliente (vistas, admin, comandos) descarta
+los contextos cacheados por ContextoUsuarioMiddleware (ver contexto.py). Los
+`QuerySet.update()` no emiten señales: quien los use debe llamar a
+`invalidar_usuarios()`.
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .contexto import invalidar_usuarios
+from .models import Cliente, Rol, Usuario
+
+
+@receiver([post_save, post_delete], sender=Usuario)
+@receiver([post_save, post_delete], sender=Rol)
+@receiver([post_save, post_delete], sender=Cliente)
+def invalidar_contexto(sender, **kwargs):
+    invalidar_usuarios()
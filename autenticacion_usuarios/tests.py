@@ -1,3 +1,128 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+from django.core.cache import caches
+from django.test import Client, TestCase, override_settings
+
+from .contexto import cargar_usuario, cliente_de
+from .models import Cliente, Rol, Usuario
+
+
+# ==========================================================
+# SESIÓN POR TOKEN (revocación)
+# ==========================================================
+
+@override_settings(AUTH_TOKEN_HABILITADO=True, PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class TokenSesionTests(TestCase):
+
+    def setUp(self):
+        # Los contextos de usuario viven en la caché local: sin on_commit en
+        # TestCase, los de otra clase de pruebas seguirían ahí
+        caches['default'].clear()
+        caches['revocados'].clear()
+        rol_admin = Rol.objects.create(nombre='Administrador')
+        rol_cliente = Rol.objects.create(nombre='Cliente')
+        self.admin = self._usuario('admin@tienda.com', rol_admin)
+        self.usuario = self._usuario('ana@tienda.com', rol_cliente)
+        self.cliente = Cliente.objects.create(id=self.usuario)
+        self.http = Client()
+
+    def _usuario(self, email, rol):
+        usuario = Usuario(nombre=email.split('@')[0], email=email, id_rol=rol)
+        usuario.set_password('clave123')
+        usuario.save()
+        return usuario
+
+    def _token(self, email):
+        respuesta = self.http.post(
+            '/api/login/', json.dumps({'email': email, 'contrasena': 'clave123', 'modo': 'token'}),
+            content_type='application/json',
+        )
+        self.assertEqual(respuesta.status_code, 200)
+        self.http.cookies.clear()  # Solo el encabezado: la cookie se prueba aparte
+        return respuesta.json()['token']
+
+    def _autenticado(self, token):
+        respuesta = self.http.get('/api/check-session/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        return respuesta.json()['authenticated']
+
+    def test_token_valido(self):
+        self.assertTrue(self._autenticado(self._token('ana@tienda.com')))
+
+    def test_cerrar_sesion_revoca_el_token(self):
+        token = self._token('ana@tienda.com')
+        respuesta = self.http.post('/api/logout/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertFalse(self._autenticado(token))
+
+    def test_revocacion_sobrevive_a_muchas_entradas(self):
+        token = self._token('ana@tienda.com')
+        self.http.post('/api/logout/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        # Más revocaciones que el MAX_ENTRIES por defecto (300) de una caché sin opciones
+        caches['revocados'].set_many({f'revocado:otro-{i}': 1 for i in range(400)}, timeout=3600)
+        self.assertFalse(self._autenticado(token))
+
+    def test_desactivar_cliente_revoca_sus_tokens(self):
+        token = self._token('ana@tienda.com')
+        token_admin = self._token('admin@tienda.com')
+        respuesta = self.http.delete(f'/api/clientes/{self.cliente.pk}/', HTTP_AUTHORIZATION=f'Bearer {token_admin}')
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertFalse(self._autenticado(token))
+        self.assertTrue(self._autenticado(token_admin))
+
+    def test_cookie_revocada_se_borra(self):
+        respuesta = self.http.post(
+            '/api/login/', json.dumps({'email': 'ana@tienda.com', 'contrasena': 'clave123', 'modo': 'token'}),
+            content_type='application/json',
+        )
+        self.assertIn('token_sesion', respuesta.cookies)
+        token = respuesta.cookies['token_sesion'].value
+        respuesta = self.http.post('/api/logout/')
+        self.assertEqual(respuesta.cookies['token_sesion'].value, '')
+
+        # Una cookie con el token ya revocado tampoco autentica y se vuelve a borrar
+        self.http.cookies['token_sesion'] = token
+        respuesta = self.http.get('/api/check-session/')
+        self.assertFalse(respuesta.json()['authenticated'])
+        self.assertEqual(respuesta.cookies['token_sesion'].value, '')
+
+
+# ==========================================================
+# CONTEXTO DEL USUARIO (invalidación por señales)
+# ==========================================================
+
+class ContextoUsuarioTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.rol = Rol.objects.create(nombre='Cliente')
+        self.usuario = Usuario.objects.create(nombre='Ana', email='ana@tienda.com', contrasena='x', id_rol=self.rol)
+
+    def test_guardar_usuario_rol_o_cliente_invalida_el_contexto(self):
+        self.assertEqual(cargar_usuario(self.usuario.pk).nombre, 'Ana')
+
+        self.usuario.nombre = 'Ana María'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.usuario.save()
+        self.assertEqual(cargar_usuario(self.usuario.pk).nombre, 'Ana María')
+
+        self.rol.nombre = 'Cliente VIP'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.rol.save()
+        self.assertEqual(cargar_usuario(self.usuario.pk).id_rol.nombre, 'Cliente VIP')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Cliente.objects.create(id=self.usuario, ciudad='Santa Cruz')
+        self.assertEqual(cliente_de(cargar_usuario(self.usuario.pk)).ciudad, 'Santa Cruz')
+
+    def test_desactivacion_llega_a_todos_los_workers(self):
+        self.assertTrue(cargar_usuario(self.usuario.pk).estado)
+        # La versión de 'usuarios' vive en la caché compartida: al cambiarla,
+        # ningún worker vuelve a consultar su contexto local anterior
+        version = caches['compartida'].get('usuarios:version')
+        self.assertIsNotNone(version)
+
+        self.usuario.estado = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.usuario.save()
+        self.assertNotEqual(caches['compartida'].get('usuarios:version'), version)
+        self.assertFalse(cargar_usuario(self.usuario.pk).estado)
@@ -0,0 +1,173 @@
+"""
+CU1: Sesión por token firmado (opcional)
+
+Con AUTH_TOKEN_HABILITADO, un login con "modo": "token" no guarda la sesión
+en la BD: devuelve un JWT firmado (simplejwt) con el id del usuario, su rol y
+su cliente, y lo deja también en una cookie HttpOnly. ContextoUsuarioMiddleware
+lo lee del encabezado `Authorization: Bearer ...` o de la cookie y reemplaza
+`request.session` por una SesionToken en memoria con las mismas claves que
+guarda el login, así que las vistas no cambian y no se consulta django_session.
+
+Revocación con una lista de denegación compacta en la caché 'revocados':
+- `revocado:<jti>`: el token (al cerrar sesión), hasta que vence;
+- `revocado:usuario:<id>`: hora desde la que se rechazan los tokens emitidos
+  antes para ese usuario (al desactivar la cuenta).
+Ninguna entrada dura más que la vigencia de un token.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import SessionBase
+from django.core.cache import caches
+
+try:
+    from rest_framework_simplejwt.exceptions import TokenError
+    from rest_framework_simplejwt.tokens import AccessToken
+except ImportError:
+    AccessToken = None
+    TokenError = Exception
+
+
+COOKIE_TOKEN = 'token_sesion'
+
+
+def token_habilitado():
+    return AccessToken is not None and getattr(settings, 'AUTH_TOKEN_HABILITADO', False)
+
+
+def _cache():
+    return caches[getattr(settings, 'AUTH_TOKEN_CACHE_ALIAS', 'revocados')]
+
+
+def _vigencia():
+    return int(AccessToken.lifetime.total_seconds())
+
+
+# ==========================================================
+# EMISIÓN Y VALIDACIÓN
+# ==========================================================
+
+def emitir_token(usuario, cliente=None):
+    """Token firmado para `usuario`; devuelve (token, segundos de vigencia)"""
+    token = AccessToken()
+    token['user_id'] = usuario.id
+    token['rol'] = usuario.id_rol.nombre
+    token['cliente_id'] = cliente.pk if cliente is not None else None
+    return str(token), _vigencia()
+
+
+def leer_token(crudo):
+    """Datos del token si la firma y la vigencia son válidas y no fue revocado, o None"""
+    try:
+        datos = AccessToken(crudo).payload
+    except TokenError:
+        return None
+    clave_token = f"revocado:{datos['jti']}"
+    clave_usuario = f"revocado:usuario:{datos.get('user_id')}"
+    revocados = _cache().get_many([clave_token, clave_usuario])
+    if clave_token in revocados:
+        return None
+    desde = revocados.get(clave_usuario)
+    if desde is not None and datos.get('iat', 0) <= desde:
+        return None
+    return datos
+
+
+def revocar_token(datos):
+    """Rechazar este token hasta que venza (cerrar sesión)"""
+    restante = int(datos['exp'] - time.time())
+    if restante > 0:
+        _cache().set(f"revocado:{datos['jti']}", 1, timeout=restante)
+
+
+def revocar_tokens_de(usuario_id):
+    """Rechazar todos los tokens ya emitidos para el usuario (desactivación)"""
+    if AccessToken is None:
+        return
+    _cache().set(f'revocado:usuario:{usuario_id}', int(time.time()), timeout=_vigencia())
+
+
+# ==========================================================
+# SESIÓN Y COOKIE
+# ==========================================================
+
+class SesionToken(SessionBase):
+    """
+    Sesión de solo lectura armada con los datos del token: no lee ni escribe
+    la BD. `flush()` (cerrar sesión) revoca el token.
+    """
+
+    def __init__(self, datos, desde_cookie=False):
+        super().__init__()
+        self.datos = datos
+        self.desde_cookie = desde_cookie
+        self.revocada = False
+        self._session_cache = {
+            'user_id': datos['user_id'],
+            'user_rol': datos.get('rol'),
+            'cliente_id': datos.get('cliente_id'),
+            'is_authenticated': True,
+        }
+
+    # Los cambios quedan en memoria: SessionMiddleware nunca la guarda
+    @property
+    def modified(self):
+        return False
+
+    @modified.setter
+    def modified(self, valor):
+        pass
+
+    def load(self):
+        return {}
+
+    def exists(self, session_key):
+        return False
+
+    def create(self):
+        pass
+
+    def save(self, must_create=False):
+        pass
+
+    def delete(self, session_key=None):
+        pass
+
+    def cycle_key(self):
+        pass
+
+    def flush(self):
+        revocar_token(self.datos)
+        self._session_cache = {}
+        self.revocada = True
+
+
+def sesion_de_token(request):
+    """
+    SesionToken del encabezado Authorization o de la cookie, o None si no hay
+    token. Devuelve False si la cookie trae un token inválido o revocado.
+    """
+    if not token_habilitado():
+        return None
+    encabezado = request.META.get('HTTP_AUTHORIZATION', '')
+    if encabezado.startswith('Bearer '):
+        datos = leer_token(encabezado[len('Bearer '):].strip())
+        return SesionToken(datos) if datos else None
+    crudo = request.COOKIES.get(COOKIE_TOKEN)
+    if not crudo:
+        return None
+    datos = leer_token(crudo)
+    return SesionToken(datos, desde_cookie=True) if datos else False
+
+
+def aplicar_cookie_token(response, token, vigencia):
+    response.set_cookie(
+        COOKIE_TOKEN, token, max_age=vigencia, httponly=True,
+        secure=settings.SESSION_COOKIE_SECURE, samesite=settings.SESSION_COOKIE_SAMESITE,
+    )
+    return response
+
+
+def quitar_cookie_token(response):
+    response.delete_cookie(COOKIE_TOKEN, samesite=settings.SESSION_COOKIE_SAMESITE)
+    return response
@@ -9,16 +9,52 @@ import json
 import logging
 
 from .models import Usuario, Rol, Bitacora, Cliente
+from productos.cache_catalogo import invalidar_datos
+from .contexto import es_admin
+from .tokens import aplicar_cookie_token, emitir_token, revocar_tokens_de, token_habilitado
+from productos.campos import CamposInvalidos, campos_solicitados, columnas
 
 # Importar modelos de ventas si existen
 try:
     from ventas_carrito.models import Venta, DetalleVenta
+    from ventas_carrito.almacen_carrito import aplicar_cookie, persistir_carrito_anonimo
 except ImportError:
     Venta = None
     DetalleVenta = None
+    aplicar_cookie = persistir_carrito_anonimo = None
 
 logger = logging.getLogger(__name__)
 
+
+def _incorporar_carrito_anonimo(request, cliente):
+    """Pasar al cliente el carrito que armó como visitante (no impide el inicio de sesión)"""
+    if persistir_carrito_anonimo is None:
+        return
+    try:
+        persistir_carrito_anonimo(request, cliente)
+    except Exception as e:
+        logger.error(f"Error al incorporar el carrito anónimo: {str(e)}", exc_info=True)
+
+
+def _con_cookie_carrito(request, response):
+    return aplicar_cookie(request, response) if aplicar_cookie else response
+
+# Listado de clientes: clave de la API -> columnas que necesita (para `fields=`)
+COLUMNAS_CLIENTE = {
+    'id': ('id__id',),
+    'nombre': ('id__nombre', 'id__apellido'),
+    'apellido': ('id__apellido',),
+    'email': ('id__email',),
+    'telefono': ('id__telefono',),
+    'direccion': ('direccion',),
+    'ciudad': ('ciudad',),
+    'estado': ('id__estado',),
+    'total_compras': (),
+    'monto_total': (),
+    'ultima_compra': (),
+}
+CAMPOS_CLIENTE = tuple(COLUMNAS_CLIENTE)
+
 # ==========================================================
 # CASO DE USO 1: INICIAR SESIÓN
 # ==========================================================
@@ -37,6 +73,7 @@ class LoginView(View):
             'method': 'POST',
             'description': 'Iniciar sesión en el sistema',
             'required_fields': ['email', 'contrasena'],
+            'optional_fields': ['modo'],  # 'token': sesión firmada sin BD (si está habilitada)
             'example': {
                 'email': 'admin@tienda.com',
                 'contrasena': 'admin123'
@@ -93,12 +130,14 @@ class LoginView(View):
                 ip=ip_address
             )
             
-            # Crear sesión
-            request.session['user_id'] = usuario.id
-            request.session['user_email'] = usuario.email
-            request.session['user_nombre'] = usuario.nombre
-            request.session['user_rol'] = usuario.id_rol.nombre
-            request.session['is_authenticated'] = True
+            # Crear sesión (en modo token no se guarda en la BD: viaja firmada)
+            modo_token = data.get('modo') == 'token' and token_habilitado()
+            if not modo_token:
+                request.session['user_id'] = usuario.id
+                request.session['user_email'] = usuario.email
+                request.session['user_nombre'] = usuario.nombre
+                request.session['user_rol'] = usuario.id_rol.nombre
+                request.session['is_authenticated'] = True
             
             # Respuesta exitosa
             response_data = {
@@ -115,6 +154,7 @@ class LoginView(View):
             }
             
             # Si es cliente, agregar información adicional
+            cliente = None
             if usuario.id_rol.nombre.lower() == 'cliente':
                 try:
                     cliente = usuario.cliente
@@ -122,8 +162,18 @@ class LoginView(View):
                     response_data['user']['ciudad'] = cliente.ciudad
                 except:
                     pass  # Si no tiene registro de cliente, no pasa nada
+                else:
+                    _incorporar_carrito_anonimo(request, cliente)
             
-            return JsonResponse(response_data, status=200)
+            if not modo_token:
+                return _con_cookie_carrito(request, JsonResponse(response_data, status=200))
+            
+            token, vigencia = emitir_token(usuario, cliente)
+            response_data['token'] = token
+            response_data['token_tipo'] = 'Bearer'
+            response_data['expira_en'] = vigencia
+            response = _con_cookie_carrito(request, JsonResponse(response_data, status=200))
+            return aplicar_cookie_token(response, token, vigencia)
             
         except json.JSONDecodeError:
             return JsonResponse({
@@ -176,26 +226,19 @@ class LogoutView(View):
                     'message': 'No hay sesión activa'
                 }, status=400)
             
-            # Obtener información del usuario
-            user_id = request.session.get('user_id')
-            user_nombre = request.session.get('user_nombre', 'Usuario')
-            
             # Obtener IP del cliente
             ip_address = self.get_client_ip(request)
             
-            # Registrar en bitácora
-            if user_id:
-                try:
-                    usuario = Usuario.objects.get(id=user_id)
-                    Bitacora.objects.create(
-                        id_usuario=usuario,
-                        accion='CIERRE_SESION',
-                        modulo='AUTENTICACION',
-                        descripcion=f'Usuario {usuario.nombre} cerró sesión',
-                        ip=ip_address
-                    )
-                except Usuario.DoesNotExist:
-                    pass  # Si no existe el usuario, continuar con el logout
+            # Registrar en bitácora (si el usuario ya no existe, continuar con el logout)
+            usuario = request.usuario
+            if usuario:
+                Bitacora.objects.create(
+                    id_usuario=usuario,
+                    accion='CIERRE_SESION',
+                    modulo='AUTENTICACION',
+                    descripcion=f'Usuario {usuario.nombre} cerró sesión',
+                    ip=ip_address
+                )
             
             # Limpiar sesión
             request.session.flush()
@@ -234,9 +277,8 @@ class CheckSessionView(View):
     def get(self, request):
         try:
             if request.session.get('is_authenticated'):
-                user_id = request.session.get('user_id')
-                try:
-                    usuario = Usuario.objects.get(id=user_id)
+                usuario = request.usuario
+                if usuario:
                     return JsonResponse({
                         'success': True,
                         'authenticated': True,
@@ -249,12 +291,11 @@ class CheckSessionView(View):
                             'telefono': usuario.telefono
                         }
                     })
-                except Usuario.DoesNotExist:
-                    request.session.flush()
-                    return JsonResponse({
-                        'success': True,
-                        'authenticated': False
-                    })
+                request.session.flush()
+                return JsonResponse({
+                    'success': True,
+                    'authenticated': False
+                })
             else:
                 return JsonResponse({
                     'success': True,
@@ -388,6 +429,7 @@ class RegisterView(View):
                 cliente.direccion = direccion
                 cliente.ciudad = ciudad
                 cliente.save()
+            invalidar_datos('clientes')
             
             # Obtener IP del cliente
             ip_address = self.get_client_ip(request)
@@ -407,9 +449,10 @@ class RegisterView(View):
             request.session['user_nombre'] = usuario.nombre
             request.session['user_rol'] = 'Cliente'
             request.session['is_authenticated'] = True
+            _incorporar_carrito_anonimo(request, cliente)
 
             # Respuesta exitosa
-            return JsonResponse({
+            return _con_cookie_carrito(request, JsonResponse({
                 'success': True,
                 'message': 'Cuenta de cliente creada exitosamente',
                 'user': {
@@ -422,7 +465,7 @@ class RegisterView(View):
                     'ciudad': cliente.ciudad,
                     'rol': 'Cliente'
                 }
-            }, status=201)
+            }, status=201))
             
         except json.JSONDecodeError:
             return JsonResponse({
@@ -468,27 +511,33 @@ class ClientesListView(View):
                     'message': 'No autenticado'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-                if usuario.id_rol.nombre.lower() != 'administrador':
-                    return JsonResponse({
-                        'success': False,
-                        'message': 'No autorizado. Solo administradores pueden ver clientes.'
-                    }, status=403)
-            except Usuario.DoesNotExist:
+            usuario = request.usuario
+            if not usuario:
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
                 }, status=401)
+            if not es_admin(usuario):
+                return JsonResponse({
+                    'success': False,
+                    'message': 'No autorizado. Solo administradores pueden ver clientes.'
+                }, status=403)
+            
+            # Claves a devolver (?fields=id,nombre,email); sin el parámetro, todas
+            try:
+                campos = campos_solicitados(request, CAMPOS_CLIENTE)
+            except CamposInvalidos as e:
+                return JsonResponse({'success': False, 'message': str(e)}, status=400)
             
             # Obtener parámetros de búsqueda y filtro
             search = request.GET.get('search', '').strip()
             estado_filter = request.GET.get('estado', '').strip()
             ciudad_filter = request.GET.get('ciudad', '').strip()
             
-            # Obtener todos los clientes con información del usuario
-            clientes = Cliente.objects.select_related('id').all()
+            # Obtener todos los clientes con información del usuario (solo las columnas pedidas)
+            clientes = Cliente.objects.select_related('id').only(
+                *columnas(campos, COLUMNAS_CLIENTE, fijas=('id__id',))
+            )
             
             # Aplicar filtros de búsqueda
             if search:
@@ -506,32 +555,28 @@ class ClientesListView(View):
             if ciudad_filter:
                 clientes = clientes.filter(ciudad__icontains=ciudad_filter)
             
-            # Obtener estadísticas básicas de ventas para cada cliente
+            # Estadísticas básicas de ventas: agregadas en la misma consulta y
+            # solo si se pidió alguna
+            if Venta and campos & {'total_compras', 'monto_total', 'ultima_compra'}:
+                clientes = clientes.annotate(
+                    total_compras=Count('venta'),
+                    monto_total=Sum('venta__total'),
+                    ultima_compra=Max('venta__fecha_venta'),
+                )
+            
             clientes_data = []
             for cliente in clientes:
-                usuario_cliente = cliente.id
-                
-                # Calcular estadísticas básicas de ventas
-                stats = self._get_cliente_stats_basic(cliente)
-                
-                clientes_data.append({
-                    'id': usuario_cliente.id,
-                    'nombre': f"{usuario_cliente.nombre} {usuario_cliente.apellido or ''}".strip(),
-                    'apellido': usuario_cliente.apellido or '',
-                    'email': usuario_cliente.email,
-                    'telefono': usuario_cliente.telefono or '',
-                    'direccion': cliente.direccion or '',
-                    'ciudad': cliente.ciudad or '',
-                    'estado': 'Activo' if usuario_cliente.estado else 'Inactivo',
-                    'total_compras': stats['total_compras'],
-                    'monto_total': float(stats['monto_total']),
-                    'ultima_compra': stats['ultima_compra']
-                })
+                clientes_data.append(self._serializar_cliente(cliente, campos))
             
             # Ordenamiento
             sort_by = request.GET.get('sort_by', 'id')
             sort_order = request.GET.get('sort_order', 'asc')
             
+            if sort_by in ('nombre', 'monto_total', 'total_compras') and sort_by not in campos:
+                return JsonResponse({
+                    'success': False,
+                    'message': f'Para ordenar por {sort_by} debe incluirse en fields'
+                }, status=400)
             if sort_by == 'nombre':
                 clientes_data.sort(key=lambda x: x['nombre'].lower(), reverse=(sort_order == 'desc'))
             elif sort_by == 'monto_total':
@@ -552,30 +597,33 @@ class ClientesListView(View):
                 'message': f'Error interno: {str(e)}'
             }, status=500)
     
-    def _get_cliente_stats_basic(self, cliente):
-        """Obtener estadísticas básicas de un cliente"""
-        stats = {
-            'total_compras': 0,
-            'monto_total': 0.0,
-            'ultima_compra': None
-        }
-        
-        if Venta:
-            try:
-                ventas = Venta.objects.filter(cliente=cliente)
-                stats['total_compras'] = ventas.count()
-                
-                if stats['total_compras'] > 0:
-                    total = ventas.aggregate(Sum('total'))['total__sum'] or 0.0
-                    stats['monto_total'] = float(total)
-                    
-                    ultima_venta = ventas.order_by('-fecha_venta').first()
-                    if ultima_venta:
-                        stats['ultima_compra'] = ultima_venta.fecha_venta.strftime('%Y-%m-%d')
-            except Exception as e:
-                logger.error(f"Error obteniendo stats básicas: {str(e)}")
-        
-        return stats
+    @staticmethod
+    def _serializar_cliente(cliente, campos):
+        """Cliente del listado con solo las claves pedidas"""
+        usuario_cliente = cliente.id
+        datos = {'id': usuario_cliente.id}
+        if 'nombre' in campos:
+            datos['nombre'] = f"{usuario_cliente.nombre} {usuario_cliente.apellido or ''}".strip()
+        if 'apellido' in campos:
+            datos['apellido'] = usuario_cliente.apellido or ''
+        if 'email' in campos:
+            datos['email'] = usuario_cliente.email
+        if 'telefono' in campos:
+            datos['telefono'] = usuario_cliente.telefono or ''
+        if 'direccion' in campos:
+            datos['direccion'] = cliente.direccion or ''
+        if 'ciudad' in campos:
+            datos['ciudad'] = cliente.ciudad or ''
+        if 'estado' in campos:
+            datos['estado'] = 'Activo' if usuario_cliente.estado else 'Inactivo'
+        if 'total_compras' in campos:
+            datos['total_compras'] = getattr(cliente, 'total_compras', 0)
+        if 'monto_total' in campos:
+            datos['monto_total'] = float(getattr(cliente, 'monto_total', None) or 0)
+        if 'ultima_compra' in campos:
+            ultima_compra = getattr(cliente, 'ultima_compra', None)
+            datos['ultima_compra'] = ultima_compra.strftime('%Y-%m-%d') if ultima_compra else None
+        return datos
 
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -596,19 +644,17 @@ class ClienteDetailView(View):
                     'message': 'No autenticado'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-                if usuario.id_rol.nombre.lower() != 'administrador':
-                    return JsonResponse({
-                        'success': False,
-                        'message': 'No autorizado'
-                    }, status=403)
-            except Usuario.DoesNotExist:
+            usuario = request.usuario
+            if not usuario:
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
                 }, status=401)
+            if not es_admin(usuario):
+                return JsonResponse({
+                    'success': False,
+                    'message': 'No autorizado'
+                }, status=403)
             
             # Obtener cliente
             try:
@@ -712,19 +758,17 @@ class ClienteDetailView(View):
                     'message': 'No autenticado'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-                if usuario.id_rol.nombre.lower() != 'administrador':
-                    return JsonResponse({
-                        'success': False,
-                        'message': 'No autorizado'
-                    }, status=403)
-            except Usuario.DoesNotExist:
+            usuario = request.usuario
+            if not usuario:
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
                 }, status=401)
+            if not es_admin(usuario):
+                return JsonResponse({
+                    'success': False,
+                    'message': 'No autorizado'
+                }, status=403)
             
             # Obtener datos del request
             data = json.loads(request.body)
@@ -762,6 +806,8 @@ class ClienteDetailView(View):
                 usuario_cliente.estado = estado_str in ['activo', 'true', '1', 'yes']
             
             usuario_cliente.save()
+            if not usuario_cliente.estado:
+                revocar_tokens_de(usuario_cliente.id)
             
             # Actualizar campos del cliente
             if 'direccion' in data:
@@ -770,6 +816,7 @@ class ClienteDetailView(View):
                 cliente.ciudad = data.get('ciudad', '').strip()
             
             cliente.save()
+            invalidar_datos('clientes')
             
             # Registrar en bitácora
             ip_address = self.get_client_ip(request)
@@ -817,19 +864,17 @@ class ClienteDetailView(View):
                     'message': 'No autenticado'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-                if usuario.id_rol.nombre.lower() != 'administrador':
-                    return JsonResponse({
-                        'success': False,
-                        'message': 'No autorizado'
-                    }, status=403)
-            except Usuario.DoesNotExist:
+            usuario = request.usuario
+            if not usuario:
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
                 }, status=401)
+            if not es_admin(usuario):
+                return JsonResponse({
+                    'success': False,
+                    'message': 'No autorizado'
+                }, status=403)
             
             # Obtener cliente
             try:
@@ -845,6 +890,8 @@ class ClienteDetailView(View):
             # Desactivar cliente (no eliminar físicamente)
             usuario_cliente.estado = False
             usuario_cliente.save()
+            revocar_tokens_de(usuario_cliente.id)
+            invalidar_datos('clientes')
             
             # Registrar en bitácora
             ip_address = self.get_client_ip(request)
@@ -894,19 +941,17 @@ class ClienteVentasView(View):
                     'message': 'No autenticado'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-                if usuario.id_rol.nombre.lower() != 'administrador':
-                    return JsonResponse({
-                        'success': False,
-                        'message': 'No autorizado'
-                    }, status=403)
-            except Usuario.DoesNotExist:
+            usuario = request.usuario
+            if not usuario:
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
                 }, status=401)
+            if not es_admin(usuario):
+                return JsonResponse({
+                    'success': False,
+                    'message': 'No autorizado'
+                }, status=403)
             
             # Obtener cliente
             try:
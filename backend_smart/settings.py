@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 import os
+from datetime import timedelta
 from pathlib import Path
 from decouple import config
 
@@ -35,6 +36,15 @@ DEBUG = config('DEBUG', default=False, cast=bool)
 
 # Configuración de ImgBB API
 API_KEY_IMGBB = config('API_KEY_IMGBB', default='49879cfe2271fe3272c9864c92e980d1')
+# Almacén de imágenes: 'imgbb' o 'local' (MEDIA_ROOT, útil sin conexión)
+IMAGENES_ALMACEN = config('IMAGENES_ALMACEN', default='imgbb')
+# Hilos para subidas asíncronas (?async=1)
+IMAGENES_WORKERS = config('IMAGENES_WORKERS', default=4, cast=int)
+# Caché donde se guarda el estado de las subidas asíncronas (compartida entre workers)
+IMAGENES_CACHE_ALIAS = 'compartida'
+# Miniaturas WebP en MEDIA_ROOT/miniaturas (espacio máximo antes de expulsar las menos usadas)
+MINIATURAS_MAX_BYTES = config('MINIATURAS_MAX_BYTES', default=500 * 1024 * 1024, cast=int)
+MINIATURAS_WORKERS = config('MINIATURAS_WORKERS', default=2, cast=int)
 
 # Configuración de Stripe
 STRIPE_SECRET_KEY = config('STRIPE_SECRET_KEY', default='')
@@ -78,6 +88,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # request.usuario: usuario de la sesión con rol y cliente (una consulta, cacheado)
+    'autenticacion_usuarios.contexto.ContextoUsuarioMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -202,6 +214,121 @@ REST_FRAMEWORK = {
     ],
 }
 
+# -------------------------------
+# CACHÉ
+# -------------------------------
+# Memoria local por defecto; en producción se puede apuntar a Redis/Memcached
+# (p. ej. CACHE_BACKEND=django.core.cache.backends.redis.RedisCache). Las
+# versiones del catálogo y de usuarios viven en 'compartida' (VERSIONES_CACHE_ALIAS)
+# para que una invalidación llegue a todos los workers.
+# Redis compartido (opcional, requiere el paquete `redis`): lo usan las
+# cachés que deben verse desde todos los workers
+REDIS_URL = config('REDIS_URL', default='')
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='backend-smart'),
+    },
+    # Carritos de visitantes anónimos: deben sobrevivir a reinicios, verse
+    # desde todos los workers y ofrecer un `add` atómico (bloqueo por carrito).
+    # Redis con REDIS_URL; si no, la tabla `cache_carritos` de la BD (la crea
+    # la migración ventas_carrito 0010): cada escritura cuenta sus filas y, por
+    # encima de CARRITO_CACHE_MAX, borra primero los carritos vencidos y solo
+    # luego descarta vigentes. Debe superar los carritos activos en
+    # CARRITO_ANONIMO_TTL; con mucho tráfico anónimo conviene Redis.
+    'carritos': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'carritos',
+    } if REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'cache_carritos',
+        'OPTIONS': {'MAX_ENTRIES': config('CARRITO_CACHE_MAX', default=200_000, cast=int)},
+    },
+    # Datos efímeros que deben verse desde todos los workers (p. ej. el estado
+    # de las subidas de imágenes asíncronas): Redis o la tabla `cache_compartida`
+    'compartida': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'compartida',
+    } if REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'cache_compartida',
+        'OPTIONS': {'MAX_ENTRIES': config('COMPARTIDA_CACHE_MAX', default=10000, cast=int)},
+    },
+    # Tokens de sesión revocados: compartida entre workers y persistente. Una
+    # entrada descartada antes de vencer vuelve a aceptar un token cerrado, así
+    # que la caché no puede purgar entradas vigentes:
+    # - con REDIS_URL se usa Redis (sin límite de entradas; configurar
+    #   maxmemory-policy volatile-ttl o noeviction, nunca allkeys-*);
+    # - si no, la tabla `cache_revocados` de la BD (creada por las migraciones),
+    #   que borra primero las vencidas y solo descarta vigentes por encima de
+    #   REVOCADOS_CACHE_MAX. Ese valor debe superar con holgura los cierres de
+    #   sesión más desactivaciones durante la vigencia de un token (AUTH_TOKEN_MINUTOS).
+    'revocados': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'revocados',
+    } if REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'cache_revocados',
+        'OPTIONS': {'MAX_ENTRIES': config('REVOCADOS_CACHE_MAX', default=1_000_000, cast=int)},
+    },
+}
+
+# Reconstrucción periódica (segundos) del índice de sugerencias de cada worker
+SUGERENCIAS_TTL = config('SUGERENCIAS_TTL', default=600, cast=int)
+
+# Segundos que se conserva una respuesta del catálogo (se invalida antes si hay escrituras)
+CATALOGO_CACHE_TTL = config('CATALOGO_CACHE_TTL', default=300, cast=int)
+
+# Segundos que se conserva el contexto del usuario (request.usuario); se
+# invalida antes, en todos los workers, al modificar usuarios, clientes o roles
+USUARIO_CACHE_TTL = config('USUARIO_CACHE_TTL', default=300, cast=int)
+
+# -------------------------------
+# SESIÓN POR TOKEN (OPCIONAL)
+# -------------------------------
+# Login con "modo": "token": la sesión viaja en un JWT firmado (encabezado
+# Authorization: Bearer o cookie HttpOnly) y no se lee la tabla de sesiones
+AUTH_TOKEN_HABILITADO = config('AUTH_TOKEN_HABILITADO', default=False, cast=bool)
+AUTH_TOKEN_CACHE_ALIAS = 'revocados'
+SIMPLE_JWT = {
+    'ACCESS_TOKEN_LIFETIME': timedelta(minutes=config('AUTH_TOKEN_MINUTOS', default=60, cast=int)),
+    'SIGNING_KEY': SECRET_KEY,
+    'USER_ID_CLAIM': 'user_id',
+}
+
+# -------------------------------
+# CARRITO ANÓNIMO
+# -------------------------------
+# Los visitantes sin sesión guardan el carrito en la caché 'carritos' (no en
+# la BD); se persiste al iniciar sesión, fusionar o pagar
+CARRITO_ANONIMO_CACHE = config('CARRITO_ANONIMO_CACHE', default=True, cast=bool)
+CARRITO_CACHE_ALIAS = 'carritos'
+# Segundos sin uso tras los que expira un carrito anónimo
+CARRITO_ANONIMO_TTL = config('CARRITO_ANONIMO_TTL', default=7 * 24 * 3600, cast=int)
+
+# -------------------------------
+# RESERVAS DE STOCK
+# -------------------------------
+# Segundos que un carrito retiene el stock de sus líneas desde su último cambio
+# (0 = los carritos no reservan; el stock se valida solo al pagar)
+RESERVA_CARRITO_TTL = config('RESERVA_CARRITO_TTL', default=15 * 60, cast=int)
+# Segundos que una venta con pago pendiente (Stripe) retiene su stock
+RESERVA_PAGO_TTL = config('RESERVA_PAGO_TTL', default=30 * 60, cast=int)
+# Las vencidas se liberan con `python manage.py liberar_reservas` (programarlo cada minuto)
+
+# -------------------------------
+# RECOMENDACIONES ("comprados juntos")
+# -------------------------------
+# Productos relacionados que se guardan por producto
+RECOMENDACIONES_TOP_K = config('RECOMENDACIONES_TOP_K', default=10, cast=int)
+# Procesar en segundo plano cada venta completada (si no, solo con
+# `python manage.py actualizar_recomendaciones`)
+RECOMENDACIONES_AUTO = config('RECOMENDACIONES_AUTO', default=True, cast=bool)
+
 # -------------------------------
 # ID AUTOMÁTICO
 # -------------------------------
@@ -20,6 +20,7 @@ from .models import HistorialEntrenamiento
 from reportes_dinamicos.models import ModeloIA, PrediccionVenta
 from ventas_carrito.models import Venta, DetalleVenta
 from productos.models import Categoria
+from autenticacion_usuarios.contexto import es_admin
 
 logger = logging.getLogger(__name__)
 
@@ -116,18 +117,14 @@ class EntrenarModeloView(View):
                     'message': 'Debe iniciar sesión'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            try:
-                from autenticacion_usuarios.models import Usuario
-                usuario = Usuario.objects.get(id=user_id)
-                is_admin = usuario.id_rol and usuario.id_rol.nombre.lower() == 'administrador'
-            except:
+            usuario = request.usuario
+            if not usuario:
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
                 }, status=404)
             
-            if not is_admin:
+            if not es_admin(usuario):
                 return JsonResponse({
                     'success': False,
                     'message': 'Solo administradores pueden entrenar modelos'
@@ -0,0 +1,175 @@
+"""
+CU6: Actualización masiva de precios y stock
+
+Dos modos, ambos aplicados con UPDATE por conjuntos dentro de una transacción:
+- items: lista de {id, precio?, stock?} -> un UPDATE con CASE por columna.
+- filtro + ajuste: p. ej. {"filtro": {"categoria": "Hogar"}, "precio": "+5%"}
+  -> un UPDATE con expresiones F() sobre todos los productos del filtro.
+
+Formato de los ajustes: "+5%" / "-10%" (porcentaje), "+3" / "-3" (suma),
+"=99.90" o un número (valor fijo). El stock admite suma o valor fijo y nunca
+queda negativo; se aplica con productos/inventario.py (filas bloqueadas y un
+movimiento de ajuste por producto). Con filtro, los productos se recorren por
+lotes de ids. Los conteos de stock informan solo los registros que cambiaron.
+"""
+import re
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Value, When
+from django.db.models.functions import Greatest, Round
+
+from .models import Producto, Stock
+from .cache_catalogo import invalidar_catalogo
+from .inventario import ajustar_stock_filtrado, fijar_stock
+from .categorias import ErrorCategoria, filtrar_por_categoria
+
+
+MAX_ITEMS = 10000
+
+_PATRON_AJUSTE = re.compile(r'^\s*([+\-=]?)\s*(\d+(?:\.\d+)?)\s*(%?)\s*$')
+_CENTAVOS = Decimal('0.01')
+
+
+class ErrorActualizacion(ValueError):
+    """Solicitud de actualización masiva no válida"""
+
+    def __init__(self, mensaje, errores=None):
+        super().__init__(mensaje)
+        self.errores = errores or []
+
+
+def interpretar_ajuste(valor, campo, permite_porcentaje=True):
+    """Devolver (operacion, numero) con operacion en 'fijar', 'sumar' o 'porcentaje'"""
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        valor = str(valor)
+    coincidencia = _PATRON_AJUSTE.match(valor) if isinstance(valor, str) else None
+    if not coincidencia:
+        raise ErrorActualizacion(f'Ajuste de {campo} inválido: {valor}')
+
+    signo, numero, porcentaje = coincidencia.groups()
+    numero = Decimal(numero)
+    if porcentaje:
+        if not permite_porcentaje or signo not in ('+', '-'):
+            raise ErrorActualizacion(f'Ajuste de {campo} inválido: {valor}')
+        return 'porcentaje', -numero if signo == '-' else numero
+    if signo in ('+', '-'):
+        return 'sumar', -numero if signo == '-' else numero
+    return 'fijar', numero
+
+
+def _expresion_precio(operacion, numero):
+    if operacion == 'fijar':
+        return Value(numero.quantize(_CENTAVOS))
+    if operacion == 'sumar':
+        nuevo = F('precio') + Value(numero)
+    else:
+        nuevo = F('precio') * Value(1 + numero / 100)
+    campo = DecimalField(max_digits=10, decimal_places=2)
+    return Greatest(Round(nuevo, 2, output_field=campo), Value(Decimal('0.00')), output_field=campo)
+
+
+def filtrar_productos(filtro):
+    """Construir el queryset de productos a partir del filtro de la solicitud"""
+    if not isinstance(filtro, dict) or not filtro:
+        raise ErrorActualizacion('El filtro es obligatorio (use {"todos": true} para todo el catálogo)')
+
+    productos = Producto.objects.all()
+    if filtro.get('todos') is True:
+        return productos
+
+    criterios = 0
+    if filtro.get('categoria'):
+        try:
+            productos = filtrar_por_categoria(productos, filtro['categoria'])  # Incluye subcategorías
+        except ErrorCategoria as e:
+            raise ErrorActualizacion(str(e))
+        criterios += 1
+    for campo in ('marca', 'proveedor'):
+        if filtro.get(campo):
+            productos = productos.filter(**{f'{campo}__nombre__iexact': filtro[campo]})
+            criterios += 1
+    if filtro.get('ids'):
+        try:
+            productos = productos.filter(pk__in=[int(pid) for pid in filtro['ids']])
+        except (TypeError, ValueError):
+            raise ErrorActualizacion('ids debe ser una lista de enteros')
+        criterios += 1
+    if not criterios:
+        raise ErrorActualizacion('Filtro sin criterios válidos (categoria, marca, proveedor, ids o todos)')
+    return productos
+
+
+def actualizar_por_filtro(filtro, ajuste_precio=None, ajuste_stock=None):
+    """Aplicar ajustes de precio y/o stock a todos los productos que cumplen el filtro"""
+    if ajuste_precio is None and ajuste_stock is None:
+        raise ErrorActualizacion('Indique un ajuste de precio y/o stock')
+    productos = filtrar_productos(filtro)
+    precio = interpretar_ajuste(ajuste_precio, 'precio') if ajuste_precio is not None else None
+    stock = interpretar_ajuste(ajuste_stock, 'stock', permite_porcentaje=False) if ajuste_stock is not None else None
+
+    resultado = {'productos_actualizados': 0, 'stocks_actualizados': 0, 'stocks_creados': 0}
+    with transaction.atomic():
+        if precio:
+            resultado['productos_actualizados'] = productos.update(precio=_expresion_precio(*precio))
+        if stock:
+            # Por lotes de ids: el filtro puede ser todo el catálogo
+            actualizados, creados = ajustar_stock_filtrado(productos, *stock, referencia='actualizacion_masiva')
+            resultado['stocks_actualizados'] = actualizados
+            resultado['stocks_creados'] = creados
+        invalidar_catalogo()
+    return resultado
+
+
+def actualizar_items(items):
+    """Aplicar precio/stock por producto con un UPDATE por columna"""
+    if not isinstance(items, list) or not items:
+        raise ErrorActualizacion('items debe ser una lista no vacía')
+    if len(items) > MAX_ITEMS:
+        raise ErrorActualizacion(f'Máximo {MAX_ITEMS} items por solicitud')
+
+    precios, stocks, errores = {}, {}, []
+    for posicion, item in enumerate(items):
+        try:
+            producto_id = int(item['id'])
+            if 'precio' in item:
+                precio = Decimal(str(item['precio'])).quantize(_CENTAVOS)
+                if precio < 0:
+                    raise InvalidOperation
+                precios[producto_id] = precio
+            if 'stock' in item:
+                stock = int(item['stock'])
+                if stock < 0:
+                    raise ValueError
+                stocks[producto_id] = stock
+        except (KeyError, TypeError, ValueError, InvalidOperation):
+            errores.append({'posicion': posicion, 'item': item})
+    if errores:
+        raise ErrorActualizacion('Items inválidos', errores=errores[:100])
+
+    ids = set(precios) | set(stocks)
+    existentes = set(Producto.objects.filter(pk__in=ids).values_list('pk', flat=True))
+    precios = {pid: v for pid, v in precios.items() if pid in existentes}
+    stocks = {pid: v for pid, v in stocks.items() if pid in existentes}
+
+    resultado = {
+        'productos_actualizados': 0,
+        'stocks_actualizados': 0,
+        'stocks_creados': 0,
+        'no_encontrados': sorted(ids - existentes),
+    }
+    with transaction.atomic():
+        if precios:
+            resultado['productos_actualizados'] = Producto.objects.filter(pk__in=precios).update(
+                precio=Case(
+                    *[When(pk=pid, then=Value(precio)) for pid, precio in precios.items()],
+                    output_field=DecimalField(max_digits=10, decimal_places=2),
+                )
+            )
+        if stocks:
+            con_registro = set(Stock.objects.filter(producto_id__in=stocks).values_list('producto_id', flat=True))
+            movimientos = fijar_stock(stocks, referencia='actualizacion_masiva')
+            resultado['stocks_actualizados'] = len({m.producto_id for m in movimientos} & con_registro)
+            resultado['stocks_creados'] = len(stocks) - len(con_registro)
+        invalidar_catalogo()
+    return resultado
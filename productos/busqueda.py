@@ -0,0 +1,232 @@
+"""
+CU7: Búsqueda de productos por texto
+
+- PostgreSQL: columna `search_vector` (tsvector con configuración 'spanish' y
+  sin acentos) indexada con GIN, consultas por prefijo y ranking con ts_rank.
+- Otros motores (SQLite en desarrollo): índice invertido en memoria con el
+  mismo plegado de acentos y un stemming español simplificado.
+
+El índice se mantiene desde las rutas de escritura del catálogo
+(indexar_productos / eliminar_productos).
+"""
+import bisect
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import Case, F, FloatField, Func, TextField, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import Producto
+
+
+CONFIG_BUSQUEDA = 'spanish'
+
+# Peso de cada campo en el ranking (A > B en PostgreSQL)
+PESO_NOMBRE = 1.0
+PESO_DESCRIPCION = 0.4
+
+_PATRON_TOKEN = re.compile(r'[a-z0-9]+')
+
+# Sufijos que se recortan en el stemming simplificado (del más largo al más corto)
+_SUFIJOS = (
+    'amientos', 'imientos', 'amiento', 'imiento', 'aciones', 'uciones',
+    'idades', 'mente', 'acion', 'ucion', 'idad', 'ables', 'ibles', 'able', 'ible',
+    'osos', 'osas', 'oso', 'osa', 'es', 's',
+)
+
+
+def normalizar(texto):
+    """Pasar a minúsculas y quitar acentos (mismo plegado que _sin_acentos)"""
+    texto = unicodedata.normalize('NFKD', (texto or '').lower())
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+
+def tokenizar(texto):
+    """Separar un texto normalizado en palabras alfanuméricas"""
+    return _PATRON_TOKEN.findall(normalizar(texto))
+
+
+def raiz(palabra):
+    """Stemming español ligero usado por el índice en memoria"""
+    for sufijo in _SUFIJOS:
+        if palabra.endswith(sufijo) and len(palabra) - len(sufijo) >= 3:
+            palabra = palabra[:-len(sufijo)]
+            break
+    if len(palabra) > 3 and palabra[-1] in 'aeo':
+        palabra = palabra[:-1]
+    return palabra
+
+
+def usa_postgres():
+    return connection.vendor == 'postgresql'
+
+
+# ==========================================================
+# POSTGRESQL: tsvector + GIN
+# ==========================================================
+
+# Plegado de acentos con translate() (nativo, no requiere la extensión unaccent)
+ACENTOS = 'áàäâéèëêíìïîóòöôúùüûñçÁÀÄÂÉÈËÊÍÌÏÎÓÒÖÔÚÙÜÛÑÇ'
+SIN_ACENTOS = 'aaaaeeeeiiiioooouuuuncAAAAEEEEIIIIOOOOUUUUNC'
+
+
+def _sin_acentos(expresion):
+    return Func(expresion, Value(ACENTOS), Value(SIN_ACENTOS), function='translate', output_field=TextField())
+
+
+def vector_busqueda():
+    """Expresión que calcula el tsvector de un producto"""
+    return (
+        SearchVector(_sin_acentos(F('nombre')), weight='A', config=CONFIG_BUSQUEDA)
+        + SearchVector(_sin_acentos(Coalesce(F('descripcion'), Value(''), output_field=TextField())), weight='B', config=CONFIG_BUSQUEDA)
+    )
+
+
+def _consulta_prefijos(tokens):
+    """Construir un tsquery donde cada palabra se busca por prefijo (búsqueda al teclear)"""
+    return ' & '.join(f'{token}:*' for token in tokens)
+
+
+# ==========================================================
+# FALLBACK: ÍNDICE INVERTIDO EN MEMORIA
+# ==========================================================
+
+class IndiceInvertido:
+    """Índice raíz -> {producto_id: peso} para motores sin búsqueda de texto completo"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._construido = False
+        self._postings = defaultdict(dict)
+        self._raices_ordenadas = []
+        self._raices_por_producto = {}
+
+    def _asegurar_construido(self):
+        if self._construido:
+            return
+        with self._lock:
+            if self._construido:
+                return
+            for fila in Producto.objects.values('id', 'nombre', 'descripcion').iterator():
+                self._agregar(fila['id'], fila['nombre'], fila['descripcion'])
+            self._raices_ordenadas = sorted(self._postings)
+            self._construido = True
+
+    def _agregar(self, producto_id, nombre, descripcion):
+        pesos = defaultdict(float)
+        for token in tokenizar(nombre):
+            pesos[raiz(token)] += PESO_NOMBRE
+        for token in tokenizar(descripcion):
+            pesos[raiz(token)] += PESO_DESCRIPCION
+        for r, peso in pesos.items():
+            self._postings[r][producto_id] = peso
+        self._raices_por_producto[producto_id] = set(pesos)
+
+    def _quitar(self, producto_id):
+        for r in self._raices_por_producto.pop(producto_id, ()):
+            postings = self._postings.get(r)
+            if postings is not None:
+                postings.pop(producto_id, None)
+                if not postings:
+                    del self._postings[r]
+
+    def actualizar(self, filas):
+        """Reindexar productos (filas con id, nombre y descripcion)"""
+        if not self._construido:
+            return  # Se indexarán al construir el índice
+        with self._lock:
+            for fila in filas:
+                self._quitar(fila['id'])
+                self._agregar(fila['id'], fila['nombre'], fila['descripcion'])
+            self._raices_ordenadas = sorted(self._postings)
+
+    def eliminar(self, producto_ids):
+        if not self._construido:
+            return
+        with self._lock:
+            for producto_id in producto_ids:
+                self._quitar(producto_id)
+            self._raices_ordenadas = sorted(self._postings)
+
+    def buscar(self, tokens):
+        """Devolver {producto_id: puntaje} de los productos que contienen todos los términos"""
+        self._asegurar_construido()
+        resultado = None
+        for token in tokens:
+            prefijo = raiz(token)
+            puntajes = defaultdict(float)
+            inicio = bisect.bisect_left(self._raices_ordenadas, prefijo)
+            for r in self._raices_ordenadas[inicio:]:
+                if not r.startswith(prefijo):
+                    break
+                for producto_id, peso in self._postings[r].items():
+                    puntajes[producto_id] += peso
+            if resultado is None:
+                resultado = dict(puntajes)
+            else:
+                resultado = {pid: resultado[pid] + p for pid, p in puntajes.items() if pid in resultado}
+            if not resultado:
+                return {}
+        return resultado or {}
+
+
+indice_memoria = IndiceInvertido()
+
+
+# ==========================================================
+# API PÚBLICA
+# ==========================================================
+
+def _sin_resultados(productos):
+    # Conserva la anotación para que el ordenamiento por relevancia siga siendo válido
+    return productos.annotate(relevancia=Value(0.0, output_field=FloatField())).none()
+
+
+def buscar_productos(productos, texto):
+    """
+    Filtrar `productos` por texto y anotar `relevancia` para ordenar resultados.
+    Devuelve el queryset sin resultados si el texto no tiene palabras buscables.
+    """
+    tokens = tokenizar(texto)
+    if not tokens:
+        return _sin_resultados(productos)
+
+    if usa_postgres():
+        consulta = SearchQuery(_consulta_prefijos(tokens), search_type='raw', config=CONFIG_BUSQUEDA)
+        return productos.filter(search_vector=consulta).annotate(
+            relevancia=SearchRank(F('search_vector'), consulta)
+        )
+
+    puntajes = indice_memoria.buscar(tokens)
+    if not puntajes:
+        return _sin_resultados(productos)
+    return productos.filter(pk__in=puntajes.keys()).annotate(
+        relevancia=Case(
+            *[When(pk=pid, then=Value(p)) for pid, p in puntajes.items()],
+            default=Value(0.0),
+            output_field=FloatField(),
+        )
+    )
+
+
+def indexar_productos(producto_ids):
+    """Recalcular el índice de búsqueda de los productos indicados"""
+    producto_ids = list(producto_ids)
+    if not producto_ids:
+        return
+    if usa_postgres():
+        Producto.objects.filter(pk__in=producto_ids).update(search_vector=vector_busqueda())
+    else:
+        indice_memoria.actualizar(
+            Producto.objects.filter(pk__in=producto_ids).values('id', 'nombre', 'descripcion')
+        )
+
+
+def eliminar_productos(producto_ids):
+    """Quitar productos eliminados del índice en memoria (en PostgreSQL se borra con la fila)"""
+    if not usa_postgres():
+        indice_memoria.eliminar(list(producto_ids))
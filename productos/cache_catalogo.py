@@ -0,0 +1,179 @@
+"""
+CU6: Caché de respuestas del catálogo y de categorías
+
+Las respuestas se guardan en el framework de caché de Django con una clave
+formada por la vista, la versión del catálogo y los parámetros normalizados.
+Toda escritura que afecte al catálogo (productos, categorías o stock) llama a
+`invalidar_catalogo()`, que cambia la versión: las entradas anteriores dejan
+de consultarse y expiran solas por TTL.
+
+Las versiones viven en la caché VERSIONES_CACHE_ALIAS ('compartida' por
+omisión, Redis o una tabla de la BD), así una escritura invalida las
+respuestas y ETags de todos los workers aunque las respuestas se guarden en
+una caché por proceso.
+
+Las mismas versiones sirven para calcular ETags sin serializar la respuesta
+(`respuesta_condicional`). Otros conjuntos de datos (p. ej. 'clientes') usan
+`version_datos` / `invalidar_datos` con su propio nombre.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+
+
+CLAVE_ACIERTOS = 'catalogo:stats:aciertos'
+CLAVE_FALLOS = 'catalogo:stats:fallos'
+
+
+def _cache():
+    return caches[getattr(settings, 'CATALOGO_CACHE_ALIAS', 'default')]
+
+
+def _cache_versiones():
+    return caches[getattr(settings, 'VERSIONES_CACHE_ALIAS', 'compartida')]
+
+
+def _ttl():
+    return getattr(settings, 'CATALOGO_CACHE_TTL', 300)
+
+
+def _incrementar(clave):
+    """Incremento del contador de estadísticas (lo crea si no existe)"""
+    cache = _cache()
+    cache.add(clave, 0, timeout=None)
+    try:
+        return cache.incr(clave)
+    except ValueError:
+        # La clave fue expulsada entre add() e incr()
+        cache.set(clave, 1, timeout=None)
+        return 1
+
+
+def _nueva_version():
+    # Cada versión es la hora actual en nanosegundos: no repite versiones (ni
+    # ETags) ya entregadas si la caché se vació, y escribirla con set() no
+    # depende de un incr() atómico, que DatabaseCache no ofrece
+    return time.time_ns()
+
+
+# ==========================================================
+# VERSIONES DE DATOS
+# ==========================================================
+
+def version_datos(nombre):
+    """Versión actual del conjunto de datos `nombre`"""
+    cache = _cache_versiones()
+    clave = f'{nombre}:version'
+    version = cache.get(clave)
+    if version is None:
+        cache.add(clave, _nueva_version(), timeout=None)
+        version = cache.get(clave)
+    return version
+
+
+def invalidar_datos(nombre):
+    """
+    Cambiar la versión de `nombre`. Dentro de una transacción se aplica al
+    confirmar, para que ningún lector cachee datos aún no visibles.
+    """
+    transaction.on_commit(lambda: _cache_versiones().set(f'{nombre}:version', _nueva_version(), timeout=None))
+
+
+def version_catalogo():
+    """Versión actual de los datos del catálogo (productos, categorías y stock)"""
+    return version_datos('catalogo')
+
+
+def invalidar_catalogo():
+    invalidar_datos('catalogo')
+
+
+# ==========================================================
+# RESPUESTAS CACHEADAS
+# ==========================================================
+
+def normalizar_parametros(request):
+    """Parámetros GET ordenados y sin valores vacíos, para que URLs equivalentes compartan entrada"""
+    pares = sorted(
+        (clave, valor.strip())
+        for clave, valores in request.GET.lists()
+        for valor in valores
+        if valor.strip()
+    )
+    return '&'.join(f'{clave}={valor}' for clave, valor in pares)
+
+
+def clave_respuesta(vista, request, version=None):
+    if version is None:
+        version = version_catalogo()
+    resumen = hashlib.sha1(normalizar_parametros(request).encode('utf-8')).hexdigest()
+    return f'catalogo:v{version}:{vista}:{resumen}'
+
+
+def respuesta_cacheada(vista, request, generar):
+    """
+    Devolver la respuesta cacheada de `vista` para los parámetros del request
+    o generarla con `generar()` y guardarla si fue exitosa (200).
+    """
+    cache = _cache()
+    clave = clave_respuesta(vista, request)
+
+    contenido = cache.get(clave)
+    if contenido is not None:
+        _incrementar(CLAVE_ACIERTOS)
+        response = HttpResponse(contenido, content_type='application/json')
+        response['X-Cache'] = 'HIT'
+        return response
+
+    _incrementar(CLAVE_FALLOS)
+    response = generar()
+    if response.status_code == 200:
+        cache.set(clave, response.content, timeout=_ttl())
+    response['X-Cache'] = 'MISS'
+    return response
+
+
+def respuesta_condicional(request, etag, generar):
+    """
+    Responder 304 si `If-None-Match` coincide con `etag`; si no, generar la
+    respuesta y adjuntarle el ETag. El ETag debe calcularse sin serializar datos.
+    """
+    no_modificado = get_conditional_response(request, etag=etag)
+    if no_modificado is not None:
+        no_modificado['ETag'] = etag
+        return no_modificado
+
+    response = generar()
+    if response.status_code == 200:
+        response['ETag'] = etag
+    return response
+
+
+def etag_datos(vista, request, *nombres, extra=''):
+    """ETag fuerte a partir de la vista, los parámetros y las versiones de datos indicadas"""
+    versiones = ':'.join(str(version_datos(nombre)) for nombre in nombres)
+    base = f'{vista}|{versiones}|{extra}|{normalizar_parametros(request)}'
+    return '"%s"' % hashlib.sha1(base.encode('utf-8')).hexdigest()
+
+
+def estadisticas_cache():
+    """Aciertos, fallos y tasa de aciertos de la caché del catálogo"""
+    cache = _cache()
+    aciertos = cache.get(CLAVE_ACIERTOS, 0)
+    fallos = cache.get(CLAVE_FALLOS, 0)
+    total = aciertos + fallos
+    return {
+        'version': version_catalogo(),
+        'aciertos': aciertos,
+        'fallos': fallos,
+        'tasa_aciertos': round(aciertos / total, 4) if total else 0.0,
+    }
+
+
+def reiniciar_estadisticas():
+    _cache().delete_many([CLAVE_ACIERTOS, CLAVE_FALLOS])
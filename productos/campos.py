@@ -0,0 +1,62 @@
+"""
+CU6: Selección de campos en los listados (fields= / include=)
+
+Los listados aceptan:
+- `fields=id,nombre,precio`: solo esas claves en cada elemento.
+- `include=productos,comprobante`: relaciones anidadas (costosas) a agregar.
+
+Sin ninguno de los dos parámetros se devuelven todas las claves, como antes.
+Con `include` sin `fields` se devuelven los campos simples más los anidados
+pedidos. `id` se devuelve siempre.
+
+Cada vista traduce las claves pedidas a columnas (`only()` / `values()`) y
+relaciones (`select_related` / `prefetch_related`), así que un cliente que
+solo necesita id/nombre/precio no paga los joins ni las consultas del resto.
+"""
+
+
+class CamposInvalidos(ValueError):
+    """`fields` o `include` contienen claves que el listado no ofrece"""
+
+
+def _lista(valor):
+    return {campo.strip() for campo in (valor or '').split(',') if campo.strip()}
+
+
+def campos_solicitados(request, simples, anidados=()):
+    """
+    Conjunto de claves a serializar a partir de `fields` e `include`.
+    simples: claves baratas (columnas o joins a uno); anidados: listas o relaciones opcionales.
+    """
+    fields = request.GET.get('fields')
+    include = request.GET.get('include')
+    validos = set(simples) | set(anidados)
+    if not fields and not include:
+        return validos
+
+    pedidos = _lista(fields) if fields else set(simples)
+    pedidos |= _lista(include)
+    desconocidos = pedidos - validos
+    if desconocidos:
+        raise CamposInvalidos(
+            f"Campos no disponibles: {', '.join(sorted(desconocidos))}. "
+            f"Disponibles: {', '.join(sorted(validos))}"
+        )
+    if 'id' in validos:
+        pedidos.add('id')
+    return pedidos
+
+
+def columnas(campos, mapa, fijas=()):
+    """Columnas ORM necesarias para `campos` según mapa {clave: (columnas,)}"""
+    resultado = list(fijas)
+    for campo in campos:
+        for columna in mapa.get(campo, ()):
+            if columna not in resultado:
+                resultado.append(columna)
+    return resultado
+
+
+def recortar(elemento, campos):
+    """Quitar del diccionario las claves no pedidas"""
+    return {clave: valor for clave, valor in elemento.items() if clave in campos}
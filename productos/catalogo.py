@@ -0,0 +1,97 @@
+"""
+CU4/CU6: Serialización del catálogo de productos
+Carga stock, categoría, marca y proveedor de toda la página en una sola consulta
+"""
+from django.db.models import F, OuterRef, Subquery, Sum, Value, IntegerField
+from django.db.models.functions import Coalesce, Greatest, Now
+
+from .models import ReservaStock, Stock
+from .miniaturas import url_miniatura
+from .campos import columnas, recortar
+
+
+# Columnas que se leen de la BD para cada fila del catálogo
+CAMPOS_CATALOGO = (
+    'id',
+    'nombre',
+    'descripcion',
+    'precio',
+    'imagen',
+    'categoria__nombre',
+    'marca__nombre',
+    'proveedor__nombre',
+    'stock_actual',
+)
+
+# Clave de la API -> columnas que necesita (para `fields=`)
+COLUMNAS_POR_CAMPO = {
+    'id': ('id',),
+    'nombre': ('nombre',),
+    'descripcion': ('descripcion',),
+    'precio': ('precio',),
+    'stock': ('stock_actual',),
+    'imagen': ('imagen',),
+    'imagen_miniatura': ('id', 'imagen'),
+    'categoria': ('categoria__nombre',),
+    'marca': ('marca__nombre',),
+    'proveedor': ('proveedor__nombre',),
+    'estado': (),
+}
+CAMPOS_PRODUCTO = tuple(COLUMNAS_POR_CAMPO)
+
+
+def anotar_stock(productos):
+    """
+    Anotar el stock vendible (existencia menos reservas vigentes) de cada
+    producto como subconsulta correlacionada (Stock tiene un único registro por
+    producto). Las reservas vencidas aún no liberadas no se descuentan.
+    """
+    vencidas = ReservaStock.objects.filter(producto=OuterRef('producto'), vence__lte=Now()).order_by().values(
+        'producto'
+    ).annotate(total=Sum('cantidad')).values('total')
+    reservado = Greatest(F('reservado') - Coalesce(Subquery(vencidas, output_field=IntegerField()), Value(0)), Value(0))
+    stock_actual = Stock.objects.filter(producto=OuterRef('pk')).annotate(
+        libre=Greatest(F('cantidad') - reservado, Value(0))
+    ).values('libre')[:1]
+
+    return productos.annotate(
+        stock_actual=Coalesce(Subquery(stock_actual, output_field=IntegerField()), Value(0))
+    )
+
+
+def serializar_producto(fila):
+    """Convertir una fila de valores del catálogo al formato JSON de la API"""
+    return {
+        'id': fila['id'],
+        'nombre': fila['nombre'] or '',
+        'descripcion': fila['descripcion'] or '',
+        'precio': float(fila['precio']) if fila['precio'] else 0.0,
+        'stock': fila['stock_actual'],
+        'imagen': fila['imagen'] or '',
+        'imagen_miniatura': url_miniatura(fila['id'], fila['imagen']),
+        'categoria': fila['categoria__nombre'],
+        'marca': fila['marca__nombre'],
+        'proveedor': fila['proveedor__nombre'],
+        'estado': True,
+    }
+
+
+def serializar_productos(productos, campos=None):
+    """
+    Serializar una página de productos con una única consulta.
+
+    `productos` puede venir filtrado, ordenado y recortado ([inicio:fin]);
+    el stock y los nombres de las relaciones se resuelven en el mismo SELECT.
+    Con `campos` (claves de la API) solo se leen las columnas, joins y
+    subconsultas que esas claves necesitan.
+    """
+    if campos is None:
+        filas = anotar_stock(productos).values(*CAMPOS_CATALOGO)
+        return [serializar_producto(fila) for fila in filas]
+
+    necesarias = columnas(campos, COLUMNAS_POR_CAMPO, fijas=('id',))
+    if 'stock_actual' in necesarias:
+        productos = anotar_stock(productos)
+    filas = productos.values(*necesarias)
+    completas = (dict.fromkeys(CAMPOS_CATALOGO) | fila for fila in filas)
+    return [recortar(serializar_producto(fila), campos) for fila in completas]
@@ -0,0 +1,164 @@
+"""
+CU7: Jerarquía de categorías (ruta materializada)
+
+Cada categoría guarda en `ruta` los ids de sus ancestros y el propio, con
+ancho fijo y separados por '/': la subcategoría 12 de la categoría 3 tiene la
+ruta '000003/000012/'. Con eso:
+- "X y todas sus descendientes" es un LIKE 'ruta_x%' sobre un índice
+  (varchar_pattern_ops), sin recorrer la jerarquía nivel por nivel.
+- Las migas de pan salen de los ids de la ruta (una consulta por clave primaria).
+- Mover una categoría reemplaza el prefijo de todo su subárbol con un UPDATE.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Value
+from django.db.models.functions import Concat, Substr
+
+from .models import Categoria, Producto
+from .cache_catalogo import invalidar_catalogo
+
+
+ANCHO_SEGMENTO = 6
+SEPARADOR = '/'
+
+
+class ErrorCategoria(Exception):
+    """Operación inválida sobre la jerarquía (ciclos, categoría inexistente)"""
+
+
+def ids_de_ruta(ruta):
+    """Ids de la ruta, desde la raíz hasta la propia categoría"""
+    return [int(segmento) for segmento in ruta.split(SEPARADOR) if segmento]
+
+
+def buscar_categoria(nombre=None, categoria_id=None):
+    """
+    Categoría por nombre (sin distinguir mayúsculas) o, si se indica, por id;
+    None si no existe. Lanza ErrorCategoria si el id no es un entero.
+    """
+    if categoria_id is not None:
+        try:
+            categoria_id = int(categoria_id)
+        except (TypeError, ValueError):
+            raise ErrorCategoria('categoria_id debe ser un entero')
+        return Categoria.objects.filter(pk=categoria_id).first()
+    return Categoria.objects.filter(nombre__iexact=str(nombre).strip()).first()
+
+
+def _ruta(categoria):
+    """Ruta de la categoría; una vacía coincidiría con todas como prefijo"""
+    if not categoria.ruta:
+        raise ErrorCategoria(f'La categoría "{categoria.nombre}" no tiene ruta en la jerarquía')
+    return categoria.ruta
+
+
+# ==========================================================
+# FILTROS
+# ==========================================================
+
+def filtrar_por_categoria(productos, nombre=None, categoria_id=None):
+    """
+    Productos de la categoría (por nombre o por id) y de todas sus subcategorías.
+    Lanza ErrorCategoria si el id no es válido o la categoría no tiene ruta.
+    """
+    categoria = buscar_categoria(nombre, categoria_id)
+    if categoria is None:
+        return productos.none()
+    return productos.filter(categoria__ruta__startswith=_ruta(categoria))
+
+
+def subarbol(categoria):
+    """La categoría y todas sus descendientes"""
+    return Categoria.objects.filter(ruta__startswith=_ruta(categoria))
+
+
+# ==========================================================
+# MODIFICACIÓN
+# ==========================================================
+
+def mover_categoria(categoria, padre):
+    """
+    Cambiar el padre de `categoria` (None la deja como raíz). Se reescriben la
+    ruta y el nivel de todo el subárbol en una sentencia.
+    """
+    anterior = _ruta(categoria)
+    if padre is not None and _ruta(padre).startswith(anterior):
+        raise ErrorCategoria('Una categoría no puede moverse dentro de sí misma o de una subcategoría')
+
+    nueva = (padre.ruta if padre else '') + f'{categoria.pk:0{ANCHO_SEGMENTO}d}{SEPARADOR}'
+    if nueva == anterior:
+        return categoria
+    diferencia = nueva.count(SEPARADOR) - anterior.count(SEPARADOR)
+
+    with transaction.atomic():
+        Categoria.objects.filter(pk=categoria.pk).update(padre=padre)
+        subarbol(categoria).update(
+            ruta=Concat(Value(nueva), Substr('ruta', len(anterior) + 1)),
+            nivel=F('nivel') + diferencia,
+        )
+        invalidar_catalogo()
+    categoria.refresh_from_db()
+    return categoria
+
+
+def eliminar_categoria(categoria):
+    """Eliminar la categoría; sus subcategorías pasan a depender de su padre"""
+    with transaction.atomic():
+        for hija in categoria.subcategorias.all():
+            mover_categoria(hija, categoria.padre)
+        categoria.delete()
+        invalidar_catalogo()
+
+
+# ==========================================================
+# LECTURA
+# ==========================================================
+
+def migas(categoria):
+    """Migas de pan [{'id', 'nombre'}] desde la raíz hasta la categoría"""
+    ids = ids_de_ruta(categoria.ruta)
+    nombres = dict(Categoria.objects.filter(pk__in=ids).values_list('id_categoria', 'nombre'))
+    return [{'id': pk, 'nombre': nombres.get(pk, '')} for pk in ids]
+
+
+def arbol():
+    """
+    Árbol completo con conteo de productos propio y del subárbol.
+    Dos consultas: categorías ordenadas por ruta (los padres quedan antes que
+    sus hijas) y productos agrupados por categoría.
+    """
+    directos = dict(
+        Producto.objects.filter(categoria__isnull=False).order_by()
+        .values_list('categoria_id').annotate(cantidad=Count('id'))
+    )
+
+    nodos, raices = {}, []
+    totales = defaultdict(int)
+    categorias = Categoria.objects.order_by('ruta').values(
+        'id_categoria', 'nombre', 'descripcion', 'padre_id', 'ruta', 'nivel'
+    )
+    for fila in categorias:
+        propios = directos.get(fila['id_categoria'], 0)
+        for ancestro in ids_de_ruta(fila['ruta']):
+            totales[ancestro] += propios
+        nodo = {
+            'id': fila['id_categoria'],
+            'nombre': fila['nombre'] or '',
+            'descripcion': fila['descripcion'] or '',
+            'nivel': fila['nivel'],
+            'productos': propios,
+            'subcategorias': [],
+        }
+        nodos[fila['id_categoria']] = nodo
+        padre = nodos.get(fila['padre_id'])
+        (padre['subcategorias'] if padre else raices).append(nodo)
+
+    def completar(lista):
+        lista.sort(key=lambda n: n['nombre'].lower())
+        for nodo in lista:
+            nodo['productos_total'] = totales[nodo['id']]
+            completar(nodo['subcategorias'])
+
+    completar(raices)
+    return raices
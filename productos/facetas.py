@@ -0,0 +1,89 @@
+"""
+CU7: Facetas del catálogo (conteos por categoría, marca y rango de precio)
+
+Todas las facetas pedidas salen de una sola consulta agrupada sobre el mismo
+queryset filtrado del listado: se agrupa por la combinación de dimensiones y
+cada faceta se obtiene sumando en memoria (pocas filas: categorías × marcas × rangos).
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Case, CharField, Count, F, Value, When
+
+
+FACETAS = ('categoria', 'marca', 'precio')
+
+# Límites de los rangos de precio: [0-100), [100-500), ... [10000, ∞)
+LIMITES_PRECIO = (0, 100, 500, 1000, 5000, 10000)
+
+
+def _rangos_precio():
+    rangos = []
+    for i, minimo in enumerate(LIMITES_PRECIO):
+        maximo = LIMITES_PRECIO[i + 1] if i + 1 < len(LIMITES_PRECIO) else None
+        etiqueta = f'{minimo}-{maximo}' if maximo is not None else f'{minimo}+'
+        rangos.append((etiqueta, minimo, maximo))
+    return rangos
+
+
+RANGOS_PRECIO = _rangos_precio()
+
+
+def facetas_solicitadas(valor):
+    """Interpretar el parámetro `facets` (lista separada por comas, o 'all'/'1')"""
+    if not valor:
+        return ()
+    if valor in ('all', '1', 'true'):
+        return FACETAS
+    pedidas = {f.strip() for f in valor.split(',')}
+    return tuple(f for f in FACETAS if f in pedidas)
+
+
+def _rango_precio():
+    return Case(
+        *[
+            When(precio__gte=Decimal(minimo), precio__lt=Decimal(maximo), then=Value(etiqueta))
+            for etiqueta, minimo, maximo in RANGOS_PRECIO if maximo is not None
+        ],
+        default=Value(RANGOS_PRECIO[-1][0]),
+        output_field=CharField(),
+    )
+
+
+def calcular_facetas(productos, facetas):
+    """Devolver {faceta: [conteos]} para las facetas pedidas con una sola consulta"""
+    if not facetas:
+        return {}
+
+    dimensiones = {
+        'categoria': F('categoria__nombre'),
+        'marca': F('marca__nombre'),
+        'precio': _rango_precio(),
+    }
+    alias = {faceta: f'faceta_{faceta}' for faceta in facetas}
+    filas = (
+        productos.order_by()
+        .annotate(**{alias[f]: dimensiones[f] for f in facetas})
+        .values(*alias.values())
+        .annotate(cantidad=Count('id'))
+    )
+
+    conteos = {faceta: defaultdict(int) for faceta in facetas}
+    for fila in filas:
+        for faceta in facetas:
+            conteos[faceta][fila[alias[faceta]]] += fila['cantidad']
+
+    resultado = {}
+    for faceta in facetas:
+        if faceta == 'precio':
+            resultado[faceta] = [
+                {'rango': etiqueta, 'min': minimo, 'max': maximo, 'cantidad': conteos[faceta][etiqueta]}
+                for etiqueta, minimo, maximo in RANGOS_PRECIO
+                if conteos[faceta][etiqueta]
+            ]
+        else:
+            resultado[faceta] = sorted(
+                ({'valor': valor, 'cantidad': cantidad} for valor, cantidad in conteos[faceta].items()),
+                key=lambda c: (-c['cantidad'], c['valor'] or ''),
+            )
+    return resultado
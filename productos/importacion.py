@@ -0,0 +1,384 @@
+"""
+CU6: Importación masiva de productos (CSV / NDJSON)
+
+Las filas se leen en streaming y se procesan por lotes:
+- Categoría, marca y proveedor se resuelven con mapas nombre -> id en memoria;
+  los nombres nuevos de cada lote se crean con un solo bulk_create (las
+  categorías nuevas quedan como raíces, con su ruta completa).
+- Los productos nuevos se insertan con bulk_create y los existentes (por `id`
+  o por `nombre`) que cambian se guardan con un upsert por clave primaria
+  (bulk_create con update_conflicts), junto con su stock.
+- Cada lote corre en su propia transacción (o todo en una con `atomico=True`).
+- Las filas inválidas no detienen la importación: se devuelven en el reporte.
+
+Columnas reconocidas: id, nombre, descripcion, precio, precio_compra, stock,
+imagen, categoria, marca, proveedor.
+"""
+import csv
+import json
+import time
+import zlib
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection, transaction
+
+from .models import Producto, Categoria, Marca, Proveedor
+from .busqueda import indexar_productos
+from .sugerencias import refrescar_productos
+from .cache_catalogo import invalidar_catalogo
+from .inventario import fijar_stock
+
+
+FORMATOS = ('csv', 'ndjson')
+TAMANO_LOTE = 5000
+# Filas por sentencia de bulk_create dentro de un lote
+FILAS_POR_SENTENCIA = 1000
+MAX_ERRORES_REPORTE = 1000
+
+CAMPOS_TEXTO = ('descripcion', 'imagen')
+CAMPOS_RELACION = {
+    'categoria': Categoria,
+    'marca': Marca,
+    'proveedor': Proveedor,
+}
+
+
+class ErrorImportacion(ValueError):
+    """Archivo o parámetros de importación no válidos"""
+
+
+def detectar_formato(nombre_archivo='', content_type=''):
+    """Deducir el formato a partir de la extensión o el Content-Type"""
+    nombre_archivo = (nombre_archivo or '').lower()
+    content_type = (content_type or '').lower()
+    if nombre_archivo.endswith(('.ndjson', '.jsonl')) or 'ndjson' in content_type or 'jsonl' in content_type:
+        return 'ndjson'
+    return 'csv'
+
+
+def _lineas_texto(lineas):
+    """Decodificar líneas de bytes (archivo subido, body del request) quitando el BOM"""
+    primera = True
+    for linea in lineas:
+        if isinstance(linea, bytes):
+            linea = linea.decode('utf-8')
+        if primera:
+            linea = linea.lstrip('\ufeff')
+            primera = False
+        yield linea
+
+
+def leer_filas(lineas, formato):
+    """Generar (número de fila, dict) sin cargar el archivo completo en memoria"""
+    if formato not in FORMATOS:
+        raise ErrorImportacion(f"Formato no soportado: {formato}. Use: {', '.join(FORMATOS)}")
+
+    lineas = _lineas_texto(lineas)
+    if formato == 'csv':
+        lector = csv.DictReader(lineas)
+        for fila in lector:
+            yield lector.line_num, fila
+        return
+
+    for numero, linea in enumerate(lineas, start=1):
+        if not linea.strip():
+            continue
+        try:
+            fila = json.loads(linea)
+        except json.JSONDecodeError:
+            yield numero, None
+            continue
+        yield numero, fila if isinstance(fila, dict) else None
+
+
+def _texto(valor):
+    if valor is None:
+        return ''
+    return str(valor).strip()
+
+
+def validar_fila(fila):
+    """
+    Normalizar una fila. Devuelve (datos, errores); en `datos` solo quedan las
+    columnas con valor, para que una actualización no borre lo que no se envió.
+    """
+    if fila is None:
+        return None, ['Línea con formato inválido']
+
+    errores = []
+    datos = {}
+
+    producto_id = _texto(fila.get('id'))
+    if producto_id:
+        try:
+            datos['id'] = int(producto_id)
+        except ValueError:
+            errores.append('id debe ser un entero')
+
+    nombre = _texto(fila.get('nombre'))
+    if nombre:
+        if len(nombre) > 200:
+            errores.append('nombre supera 200 caracteres')
+        datos['nombre'] = nombre
+    elif 'id' not in datos:
+        errores.append('El nombre es obligatorio')
+
+    for campo in ('precio', 'precio_compra'):
+        valor = _texto(fila.get(campo))
+        if not valor:
+            continue
+        try:
+            decimal = Decimal(valor).quantize(Decimal('0.01'))
+            if decimal < 0 or decimal >= Decimal('100000000'):
+                raise InvalidOperation
+            datos[campo] = decimal
+        except InvalidOperation:
+            errores.append(f'{campo} inválido: {valor}')
+    if 'precio' not in datos and 'id' not in datos and not errores:
+        errores.append('El precio es obligatorio')
+
+    stock = _texto(fila.get('stock'))
+    if stock:
+        try:
+            datos['stock'] = int(stock)
+            if datos['stock'] < 0:
+                errores.append('stock no puede ser negativo')
+        except ValueError:
+            errores.append(f'stock inválido: {stock}')
+
+    for campo in CAMPOS_TEXTO:
+        valor = _texto(fila.get(campo))
+        if valor:
+            datos[campo] = valor
+    if len(datos.get('imagen', '')) > 500:
+        errores.append('imagen supera 500 caracteres')
+
+    for campo in CAMPOS_RELACION:
+        valor = _texto(fila.get(campo))
+        if valor:
+            datos[campo] = valor
+
+    return datos, errores
+
+
+class MapaNombres:
+    """Mapa nombre -> id de una tabla de búsqueda, cargado una vez por importación"""
+
+    def __init__(self, modelo):
+        self.modelo = modelo
+        self.pk = modelo._meta.pk.attname
+        self.ids = {}
+        for pk, nombre in modelo.objects.values_list(self.pk, 'nombre').order_by(self.pk).iterator():
+            self.ids.setdefault(nombre, pk)
+
+    def resolver(self, nombres):
+        """Crear en bloque los nombres que faltan y actualizar el mapa"""
+        faltantes = {nombre for nombre in nombres if nombre not in self.ids}
+        if not faltantes:
+            return
+        with transaction.atomic():
+            # Proveedor.nombre no es único, así que ignore_conflicts no basta: un
+            # bloqueo por tabla hasta el fin de la transacción hace que dos
+            # importaciones simultáneas vean los nombres que creó la otra
+            # (SQLite ya serializa las escrituras)
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s)', [zlib.crc32(self.modelo._meta.db_table.encode())])
+            existentes = set(self.modelo.objects.filter(nombre__in=faltantes).values_list('nombre', flat=True))
+            self.modelo.objects.bulk_create(
+                [self.modelo(nombre=nombre) for nombre in faltantes - existentes],
+                ignore_conflicts=True,  # Categoría y marca únicas: altas por otras vías
+            )
+        filas = self.modelo.objects.filter(nombre__in=faltantes).values_list(self.pk, 'nombre').order_by(self.pk)
+        for pk, nombre in filas:
+            self.ids.setdefault(nombre, pk)
+
+
+class ImportadorProductos:
+    """Importa productos por lotes y acumula el reporte de resultados"""
+
+    def __init__(self, tamano_lote=TAMANO_LOTE, atomico=False):
+        if tamano_lote < 1:
+            raise ErrorImportacion('El tamaño de lote debe ser mayor a 0')
+        self.tamano_lote = tamano_lote
+        self.atomico = atomico
+        self.creados = 0
+        self.actualizados = 0
+        self.procesadas = 0
+        self.con_error = 0
+        self.errores = []
+
+    # ------------------------------------------------------
+    # Reporte
+    # ------------------------------------------------------
+
+    def _registrar_error(self, numero, mensajes):
+        self.con_error += 1
+        if len(self.errores) < MAX_ERRORES_REPORTE:
+            self.errores.append({'fila': numero, 'errores': mensajes})
+
+    def reporte(self, segundos):
+        return {
+            'procesadas': self.procesadas,
+            'creados': self.creados,
+            'actualizados': self.actualizados,
+            'con_error': self.con_error,
+            'errores': self.errores,
+            'errores_omitidos': max(0, self.con_error - len(self.errores)),
+            'segundos': round(segundos, 3),
+        }
+
+    # ------------------------------------------------------
+    # Proceso
+    # ------------------------------------------------------
+
+    def importar(self, filas):
+        """Procesar un iterable de (número, fila) y devolver el reporte"""
+        inicio = time.perf_counter()
+        self.mapas = {campo: MapaNombres(modelo) for campo, modelo in CAMPOS_RELACION.items()}
+        self.ids_por_nombre = {}
+        for pk, nombre in Producto.objects.values_list('id', 'nombre').order_by('id').iterator():
+            self.ids_por_nombre.setdefault(nombre, pk)
+
+        if self.atomico:
+            with transaction.atomic():
+                self._importar(filas)
+        else:
+            self._importar(filas)
+
+        invalidar_catalogo()
+        return self.reporte(time.perf_counter() - inicio)
+
+    def _importar(self, filas):
+        lote = {}
+        for numero, fila in filas:
+            self.procesadas += 1
+            datos, errores = validar_fila(fila)
+            if errores:
+                self._registrar_error(numero, errores)
+                continue
+
+            clave = datos.get('id') or datos['nombre']
+            if clave in lote:
+                # La misma fila aparece dos veces en el lote: se aplica en orden
+                self._procesar_lote(lote)
+                lote = {}
+            lote[clave] = (numero, datos)
+
+            if len(lote) >= self.tamano_lote:
+                self._procesar_lote(lote)
+                lote = {}
+
+        if lote:
+            self._procesar_lote(lote)
+
+    def _procesar_lote(self, lote):
+        filas = list(lote.values())
+        try:
+            # Relaciones del lote (una consulta por tabla como máximo); se crean
+            # fuera de la transacción del lote para que el mapa no quede con ids revertidos
+            for campo, mapa in self.mapas.items():
+                mapa.resolver({datos[campo] for _, datos in filas if campo in datos})
+
+            if self.atomico:
+                creados, actualizados, no_encontrados = self._guardar_lote(filas)
+            else:
+                with transaction.atomic():
+                    creados, actualizados, no_encontrados = self._guardar_lote(filas)
+        except Exception as e:
+            if self.atomico:
+                raise
+            for numero, _ in filas:
+                self._registrar_error(numero, [f'Error al guardar el lote: {str(e)}'])
+            return
+
+        for producto in creados:
+            self.ids_por_nombre.setdefault(producto.nombre, producto.id)
+        for numero, producto_id in no_encontrados:
+            self._registrar_error(numero, [f'Producto {producto_id} no encontrado'])
+        self.creados += len(creados)
+        self.actualizados += len(actualizados)
+
+    def _guardar_lote(self, filas):
+        nuevos, existentes = [], {}
+        for numero, datos in filas:
+            producto_id = datos.get('id') or self.ids_por_nombre.get(datos['nombre'])
+            if producto_id in existentes:
+                # Mismo producto referido por id y por nombre: se combinan en orden
+                datos = {**existentes[producto_id][1], **datos}
+            if producto_id:
+                existentes[producto_id] = (numero, datos)
+            else:
+                nuevos.append(datos)
+
+        productos_existentes = Producto.objects.in_bulk(list(existentes))
+        no_encontrados = []
+        for producto_id in list(existentes):
+            if producto_id not in productos_existentes:
+                numero, _ = existentes.pop(producto_id)
+                no_encontrados.append((numero, producto_id))
+
+        creados = self._crear(nuevos)
+        actualizados = self._actualizar(productos_existentes, existentes)
+
+        stocks = {p.id: datos['stock'] for p, datos in creados if 'stock' in datos}
+        stocks.update({pid: datos['stock'] for pid, (_, datos) in existentes.items() if 'stock' in datos})
+        self._guardar_stock(stocks)
+
+        indexar_productos([p.id for p, _ in creados] + actualizados)
+        refrescar_productos([p.id for p, _ in creados] + actualizados)
+        return [p for p, _ in creados], actualizados, no_encontrados
+
+    def _relaciones(self, datos):
+        return {
+            f'{campo}_id': self.mapas[campo].ids[datos[campo]]
+            for campo in CAMPOS_RELACION if campo in datos
+        }
+
+    def _crear(self, filas):
+        if not filas:
+            return []
+        productos = [
+            Producto(
+                nombre=datos['nombre'],
+                descripcion=datos.get('descripcion', ''),
+                precio=datos['precio'],
+                precio_compra=datos.get('precio_compra', Decimal('0.00')),
+                imagen=datos.get('imagen', ''),
+                **self._relaciones(datos),
+            )
+            for datos in filas
+        ]
+        Producto.objects.bulk_create(productos, batch_size=FILAS_POR_SENTENCIA)
+        return list(zip(productos, filas))
+
+    def _actualizar(self, productos, filas):
+        """Guardar solo los productos que cambian, y de ellos solo los campos que cambian"""
+        modificados, campos = [], set()
+        for producto_id, (_, datos) in filas.items():
+            producto = productos[producto_id]
+            valores = {k: v for k, v in datos.items() if k not in ('id', 'stock') and k not in CAMPOS_RELACION}
+            valores.update(self._relaciones(datos))
+            cambios = {campo: valor for campo, valor in valores.items() if getattr(producto, campo) != valor}
+            if not cambios:
+                continue
+            for campo, valor in cambios.items():
+                setattr(producto, campo, valor)
+            campos.update(cambios)
+            modificados.append(producto)
+        if modificados:
+            # Upsert por clave primaria: una fila VALUES por producto en vez del
+            # CASE por fila y campo que arma bulk_update
+            Producto.objects.bulk_create(
+                modificados,
+                batch_size=FILAS_POR_SENTENCIA,
+                update_conflicts=True,
+                unique_fields=['id'],
+                update_fields=sorted(campos),
+            )
+        return list(filas)
+
+    def _guardar_stock(self, stocks):
+        """Fijar el stock importado (queda como ajuste en el libro de movimientos)"""
+        if stocks:
+            fijar_stock(stocks, referencia='importacion')
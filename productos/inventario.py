@@ -0,0 +1,497 @@
+"""
+CU6/CU10: Inventario (libro de movimientos y stock por ubicación)
+
+La existencia se guarda en dos niveles que se mantienen juntos:
+- StockUbicacion: cantidad de cada producto en cada ubicación (depósito/sucursal).
+- Stock: un único registro por producto con el total de todas las ubicaciones.
+  Es el saldo materializado del libro MovimientoStock y lo que leen catálogo,
+  carrito y reportes (una búsqueda por índice único, sin sumar en cada lectura).
+
+Toda modificación pasa por este módulo:
+1. Se bloquean los registros de Stock involucrados (SELECT ... FOR UPDATE,
+   siempre en orden de producto para no provocar interbloqueos). Ese bloqueo
+   protege también las filas de StockUbicacion del producto.
+2. Se calcula el nuevo total con el valor bloqueado y se reparte la diferencia
+   entre ubicaciones (las salidas con `asignar_ubicaciones`). Si alguna salida
+   no alcanza se rechaza la operación completa.
+3. Se actualizan ambos niveles y se insertan los movimientos en la misma transacción.
+
+Así dos compras simultáneas del último ítem no pueden venderlo dos veces: la
+segunda espera el bloqueo de la primera y ve el saldo ya descontado.
+
+Reservas: un carrito o un pago pendiente retiene unidades por un tiempo
+(ReservaStock, una fila por referencia y producto con su vencimiento) y
+Stock.reservado guarda la suma de las reservas del producto, actualizada bajo
+el mismo bloqueo. Lo vendible es `cantidad - reservado`: el catálogo y el
+carrito lo leen del mismo registro, sin sumar reservas. Las reservas no
+mueven la existencia física, así que no generan movimientos en el libro. Una
+reserva vencida deja de contar en cuanto vence, aunque su fila siga: la
+lectura la descuenta de `reservado` y toda operación que bloquea productos la
+libera. El comando `liberar_reservas` solo limpia en lote las que nadie tocó.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from .models import Stock, StockUbicacion, MovimientoStock, Ubicacion, ReservaStock
+from .cache_catalogo import invalidar_catalogo
+
+
+NOMBRE_UBICACION_PRINCIPAL = 'Principal'
+
+
+class StockInsuficiente(Exception):
+    """Alguna salida de stock supera la existencia disponible"""
+
+    def __init__(self, faltantes):
+        super().__init__('Stock insuficiente')
+        # [{'producto_id', 'solicitado', 'disponible'}]
+        self.faltantes = faltantes
+
+
+# ==========================================================
+# LECTURA
+# ==========================================================
+
+def stock_disponible(producto_ids, referencia=None):
+    """
+    Existencia vendible {producto_id: cantidad}: total menos reservas vigentes
+    (0 si no hay registro). Las reservas vencidas que todavía no se liberaron
+    no cuentan. Con `referencia` se suman las reservas propias vigentes (lo
+    que ese carrito o venta puede usar).
+    """
+    producto_ids = list(producto_ids)
+    disponibles = dict.fromkeys(producto_ids, 0)
+    if not producto_ids:
+        return disponibles
+    reservado = {}
+    existencias = Stock.objects.filter(producto_id__in=producto_ids).values_list('producto_id', 'cantidad', 'reservado')
+    for producto_id, cantidad, reservado_total in existencias:
+        disponibles[producto_id] = cantidad
+        reservado[producto_id] = reservado_total
+
+    ahora = timezone.now()
+    reservas = ReservaStock.objects.filter(producto_id__in=producto_ids)
+    if referencia:
+        reservas = reservas.filter(Q(vence__lte=ahora) | Q(referencia=referencia))
+    else:
+        reservas = reservas.filter(vence__lte=ahora)
+    # Las vencidas y las propias vigentes se devuelven a lo disponible
+    for producto_id, cantidad in reservas.values_list('producto_id', 'cantidad'):
+        reservado[producto_id] = reservado.get(producto_id, 0) - cantidad
+    for producto_id, cantidad in disponibles.items():
+        disponibles[producto_id] = max(cantidad - max(reservado.get(producto_id, 0), 0), 0)
+    return disponibles
+
+
+def ubicacion_principal():
+    """Ubicación que recibe las entradas sin ubicación explícita (la de menor prioridad)"""
+    ubicacion = Ubicacion.objects.order_by('prioridad', 'id_ubicacion').first()
+    if ubicacion is None:
+        ubicacion, _ = Ubicacion.objects.get_or_create(
+            nombre=NOMBRE_UBICACION_PRINCIPAL, defaults={'prioridad': 0}
+        )
+    return ubicacion
+
+
+# ==========================================================
+# ASIGNACIÓN
+# ==========================================================
+
+def asignar_ubicaciones(existencias, cantidad):
+    """
+    Elegir de qué ubicaciones salen `cantidad` unidades.
+    existencias: [(ubicacion_id, prioridad, disponible)]
+    Devuelve [(ubicacion_id, unidades)] o None si el total no alcanza.
+
+    Se prefiere una sola ubicación que cubra todo (la de menor prioridad);
+    si ninguna alcanza, se toma por prioridad y luego por mayor existencia,
+    para repartir el pedido entre la menor cantidad posible de ubicaciones.
+    """
+    con_stock = [e for e in existencias if e[2] > 0]
+    if sum(e[2] for e in con_stock) < cantidad:
+        return None
+    if cantidad <= 0:
+        return []
+
+    completas = [e for e in con_stock if e[2] >= cantidad]
+    if completas:
+        ubicacion_id = min(completas, key=lambda e: (e[1], e[0]))[0]
+        return [(ubicacion_id, cantidad)]
+
+    asignacion, restante = [], cantidad
+    for ubicacion_id, _, disponible in sorted(con_stock, key=lambda e: (e[1], -e[2], e[0])):
+        unidades = min(disponible, restante)
+        asignacion.append((ubicacion_id, unidades))
+        restante -= unidades
+        if not restante:
+            break
+    return asignacion
+
+
+def _repartir(diferencia, existencias, ubicacion_id, principal_id):
+    """Cambios [(ubicacion_id, delta)] que suman `diferencia`, o None si no es posible"""
+    if diferencia > 0:
+        return [(ubicacion_id or principal_id, diferencia)]
+    if ubicacion_id:
+        disponible = next((e[2] for e in existencias if e[0] == ubicacion_id), 0)
+        return [(ubicacion_id, diferencia)] if disponible >= -diferencia else None
+    asignacion = asignar_ubicaciones(existencias, -diferencia)
+    return None if asignacion is None else [(u, -unidades) for u, unidades in asignacion]
+
+
+# ==========================================================
+# NÚCLEO
+# ==========================================================
+
+def _bloquear(producto_ids):
+    """Bloquear (creando los que falten) los registros de Stock de los productos"""
+    def bloquear(ids):
+        return {
+            registro.producto_id: registro
+            for registro in Stock.objects.select_for_update().filter(
+                producto_id__in=ids
+            ).order_by('producto_id')
+        }
+
+    producto_ids = sorted(set(producto_ids))
+    registros = bloquear(producto_ids)
+    faltan = [pid for pid in producto_ids if pid not in registros]
+    if faltan:
+        Stock.objects.bulk_create(
+            [Stock(producto_id=pid, cantidad=0) for pid in faltan],
+            ignore_conflicts=True,  # La restricción única evita duplicados concurrentes
+        )
+        registros.update(bloquear(faltan))
+    return registros
+
+
+def _existencias(producto_ids):
+    """{producto_id: {ubicacion_id: (prioridad, cantidad)}} de productos ya bloqueados"""
+    existencias = defaultdict(dict)
+    filas = StockUbicacion.objects.filter(producto_id__in=producto_ids).values_list(
+        'producto_id', 'ubicacion_id', 'ubicacion__prioridad', 'cantidad'
+    )
+    for producto_id, ubicacion_id, prioridad, cantidad in filas:
+        existencias[producto_id][ubicacion_id] = (prioridad, cantidad)
+    return existencias
+
+
+def _aplicar(producto_ids, calcular, tipo, referencia, ubicacion=None, reserva=None, respetar_reservas=False):
+    """
+    Núcleo común: `calcular(producto_id, actual)` devuelve el nuevo total del
+    producto. La diferencia se aplica en `ubicacion` o, si es None, las
+    entradas van a la ubicación principal y las salidas se asignan con
+    `asignar_ubicaciones`. Devuelve los movimientos registrados.
+    `reserva`: referencia cuyas reservas de estos productos se consumen;
+    `respetar_reservas`: el nuevo total no puede quedar por debajo de lo
+    reservado por otros.
+    """
+    ubicacion_id = ubicacion.pk if isinstance(ubicacion, Ubicacion) else ubicacion
+    ahora = timezone.now()
+    with transaction.atomic():
+        registros = _bloquear(producto_ids)
+        # Las reservas vencidas de estos productos se liberan antes de calcular
+        # (no esperan al comando liberar_reservas), junto con las que se consumen
+        soltar = Q(vence__lte=ahora)
+        if reserva:
+            soltar |= Q(referencia=reserva)
+        _soltar(ReservaStock.objects.filter(soltar, producto_id__in=list(registros)), registros)
+        existencias = _existencias(list(registros))
+        principal_id = None
+        movimientos, faltantes, modificados, por_ubicacion = [], [], [], []
+
+        for producto_id, registro in registros.items():
+            nuevo = calcular(producto_id, registro.cantidad)
+            minimo = registro.reservado if respetar_reservas else 0
+            if nuevo is None or nuevo < minimo:
+                faltantes.append({'producto_id': producto_id, 'disponible': max(registro.cantidad - minimo, 0)})
+                continue
+            if nuevo == registro.cantidad:
+                continue
+            del_producto = existencias[producto_id]
+            # Existencia sin ubicación (registros de Stock creados fuera de este
+            # módulo): se considera guardada en la ubicación principal
+            sin_ubicacion = registro.cantidad - sum(cantidad for _, cantidad in del_producto.values())
+            if principal_id is None and (sin_ubicacion > 0 or (nuevo > registro.cantidad and not ubicacion_id)):
+                principal = ubicacion_principal()
+                principal_id = principal.pk
+                prioridad_principal = principal.prioridad
+            if sin_ubicacion > 0:
+                anterior = del_producto.get(principal_id, (prioridad_principal, 0))[1]
+                del_producto[principal_id] = (prioridad_principal, anterior + sin_ubicacion)
+
+            cambios = _repartir(
+                nuevo - registro.cantidad,
+                [(u, prioridad, cantidad) for u, (prioridad, cantidad) in del_producto.items()],
+                ubicacion_id,
+                principal_id,
+            )
+            if cambios is None:
+                faltantes.append({'producto_id': producto_id, 'disponible': registro.cantidad})
+                continue
+
+            saldo = registro.cantidad
+            for u, delta in cambios:
+                saldo += delta
+                por_ubicacion.append(StockUbicacion(
+                    producto_id=producto_id, ubicacion_id=u,
+                    cantidad=del_producto.get(u, (0, 0))[1] + delta, fecha_actualizacion=ahora,
+                ))
+                movimientos.append(MovimientoStock(
+                    producto_id=producto_id, ubicacion_id=u, tipo=tipo, cantidad=delta,
+                    saldo=saldo, referencia=referencia,
+                ))
+            registro.cantidad = nuevo
+            registro.fecha_actualizacion = ahora  # El mismo instante que sus ubicaciones
+            modificados.append(registro)
+        if faltantes:
+            raise StockInsuficiente(faltantes)
+
+        # INSERT ... ON CONFLICT DO UPDATE sobre registros que ya existen: una
+        # fila VALUES por registro en vez del CASE por fila y campo de bulk_update
+        Stock.objects.bulk_create(
+            modificados,
+            update_conflicts=True,
+            unique_fields=['producto'],
+            update_fields=['cantidad', 'fecha_actualizacion'],
+        )
+        StockUbicacion.objects.bulk_create(
+            por_ubicacion,
+            update_conflicts=True,
+            unique_fields=['producto', 'ubicacion'],
+            update_fields=['cantidad', 'fecha_actualizacion'],
+        )
+        MovimientoStock.objects.bulk_create(movimientos)
+        if movimientos:
+            invalidar_catalogo()
+    return movimientos
+
+
+# ==========================================================
+# OPERACIONES
+# ==========================================================
+
+def descontar_stock(items, referencia='', tipo='venta', permitir_faltante=False, ubicacion=None, reserva=None):
+    """
+    Registrar salidas [(producto_id, cantidad)] de forma atómica.
+    Lanza StockInsuficiente (sin modificar nada) si alguna no alcanza, salvo con
+    `permitir_faltante`, que descuenta hasta dejar el stock en cero (ventas ya
+    cobradas: el movimiento registra lo que realmente salió).
+    Las ventas consumen las reservas de `reserva` (p. ej. el carrito que se
+    paga) y no pueden tomar unidades reservadas por otros.
+    """
+    solicitados = {}
+    for producto_id, cantidad in items:
+        solicitados[producto_id] = solicitados.get(producto_id, 0) + cantidad
+
+    if permitir_faltante:
+        calcular = lambda pid, actual: max(actual - solicitados[pid], 0)
+    else:
+        calcular = lambda pid, actual: actual - solicitados[pid]
+    try:
+        return _aplicar(
+            solicitados, calcular, tipo, referencia, ubicacion,
+            reserva=reserva, respetar_reservas=(tipo == 'venta' and not permitir_faltante),
+        )
+    except StockInsuficiente as e:
+        for faltante in e.faltantes:
+            faltante['solicitado'] = solicitados[faltante['producto_id']]
+        raise
+
+
+def reponer_stock(producto_id, cantidad, referencia='', ubicacion=None):
+    """Registrar una entrada de mercadería (en la ubicación principal si no se indica)"""
+    return _aplicar([producto_id], lambda pid, actual: actual + cantidad, 'reposicion', referencia, ubicacion)
+
+
+def fijar_stock(cantidades, referencia='', ubicacion=None):
+    """Fijar la existencia total {producto_id: cantidad} (ajuste por la diferencia)"""
+    return _aplicar(cantidades, lambda pid, actual: cantidades[pid], 'ajuste', referencia, ubicacion)
+
+
+def ajustar_stock_filtrado(productos, operacion, cantidad, referencia='', lote=1000):
+    """
+    Fijar (`operacion` 'fijar') o sumar ('sumar', puede ser negativo) `cantidad`
+    a la existencia de todos los productos del queryset, sin bajar de cero.
+    Los ids se recorren en orden y por lotes (un lote en memoria a la vez) y
+    cada lote pasa por el núcleo común: mismo bloqueo, reparto entre
+    ubicaciones y libro que el resto de las operaciones. Todo corre en una
+    transacción. Devuelve (productos cuyo stock cambió, registros de Stock creados).
+    """
+    if operacion == 'fijar':
+        cantidad = max(int(cantidad), 0)
+        calcular = lambda pid, actual: cantidad
+    else:
+        cantidad = int(cantidad)
+        calcular = lambda pid, actual: max(actual + cantidad, 0)
+
+    ids = productos.order_by('pk').values_list('pk', flat=True)
+    actualizados = creados = ultimo = 0
+    with transaction.atomic():
+        while True:
+            bloque = list(ids.filter(pk__gt=ultimo)[:lote])
+            if not bloque:
+                break
+            ultimo = bloque[-1]
+            existentes = set(Stock.objects.filter(producto_id__in=bloque).values_list('producto_id', flat=True))
+            movimientos = _aplicar(bloque, calcular, 'ajuste', referencia)
+            actualizados += len({m.producto_id for m in movimientos} & existentes)
+            creados += len(bloque) - len(existentes)
+    return actualizados, creados
+
+
+def movimientos_de_venta(venta_id):
+    """Movimientos ya registrados para una venta (evita descontar dos veces)"""
+    return MovimientoStock.objects.filter(referencia=f'venta:{venta_id}', tipo='venta')
+
+
+# ==========================================================
+# RESERVAS
+# ==========================================================
+
+def _soltar(reservas, registros):
+    """Eliminar las reservas (queryset) y restarlas de Stock.reservado; los registros deben estar bloqueados"""
+    filas = list(reservas.values_list('id', 'producto_id', 'cantidad'))
+    if not filas:
+        return 0
+    modificados = {}
+    for _, producto_id, cantidad in filas:
+        registro = registros[producto_id]
+        registro.reservado = max(registro.reservado - cantidad, 0)
+        modificados[producto_id] = registro
+    Stock.objects.bulk_update(list(modificados.values()), ['reservado'])
+    ReservaStock.objects.filter(id__in=[fila[0] for fila in filas]).delete()
+    # El catálogo muestra el stock libre de reservas
+    invalidar_catalogo()
+    return len(filas)
+
+
+def reservar_stock(referencia, cantidades, ttl, parcial=False, liberar=None):
+    """
+    Fijar la reserva de `referencia` en {producto_id: cantidad} (0 la quita)
+    por `ttl` segundos; los productos no incluidos no cambian y todas las
+    reservas de la referencia se renuevan. Lanza StockInsuficiente (sin
+    modificar nada) si alguna no alcanza; con `parcial` reserva lo que haya.
+    `liberar`: referencia cuyas reservas de estos productos se sueltan antes
+    (p. ej. pasar la reserva del carrito a la venta).
+    Devuelve {producto_id: cantidad reservada}.
+    """
+    ahora = timezone.now()
+    with transaction.atomic():
+        registros = _bloquear(cantidades)
+        vencidas = Q(vence__lte=ahora)
+        if liberar:
+            vencidas |= Q(referencia=liberar)
+        _soltar(ReservaStock.objects.filter(vencidas, producto_id__in=list(registros)), registros)
+        propias = dict(
+            ReservaStock.objects.filter(referencia=referencia, producto_id__in=list(registros))
+            .values_list('producto_id', 'cantidad')
+        )
+
+        reservadas, faltantes, modificados = {}, [], []
+        for producto_id, registro in registros.items():
+            propia = propias.get(producto_id, 0)
+            libre = max(registro.cantidad - registro.reservado + propia, 0)
+            pedida = cantidades[producto_id]
+            if pedida > libre:
+                if not parcial:
+                    faltantes.append({'producto_id': producto_id, 'solicitado': pedida, 'disponible': libre})
+                    continue
+                pedida = libre
+            reservadas[producto_id] = pedida
+            if pedida != propia:
+                registro.reservado += pedida - propia
+                modificados.append(registro)
+        if faltantes:
+            raise StockInsuficiente(faltantes)
+
+        Stock.objects.bulk_update(modificados, ['reservado'])
+        if modificados:
+            invalidar_catalogo()
+        ReservaStock.objects.bulk_create(
+            [
+                ReservaStock(producto_id=producto_id, referencia=referencia, cantidad=cantidad,
+                             vence=ahora, fecha_actualizacion=ahora)
+                for producto_id, cantidad in reservadas.items() if cantidad
+            ],
+            update_conflicts=True,
+            unique_fields=['referencia', 'producto'],
+            update_fields=['cantidad'],
+        )
+        ReservaStock.objects.filter(
+            referencia=referencia, producto_id__in=[pid for pid, cantidad in reservadas.items() if not cantidad]
+        ).delete()
+        ReservaStock.objects.filter(referencia=referencia).update(
+            vence=ahora + timedelta(seconds=ttl), fecha_actualizacion=ahora
+        )
+    return reservadas
+
+
+def liberar_stock(referencia, producto_ids=None):
+    """Soltar las reservas de `referencia` (solo de `producto_ids` si se indican). Devuelve cuántas"""
+    reservas = ReservaStock.objects.filter(referencia=referencia)
+    if producto_ids is not None:
+        reservas = reservas.filter(producto_id__in=list(producto_ids))
+    productos = set(reservas.values_list('producto_id', flat=True))
+    if not productos:
+        return 0
+    with transaction.atomic():
+        return _soltar(reservas, _bloquear(productos))
+
+
+def liberar_referencias(referencias):
+    """Soltar todas las reservas de varias referencias a la vez (p. ej. carritos eliminados). Devuelve cuántas"""
+    reservas = ReservaStock.objects.filter(referencia__in=list(referencias))
+    productos = set(reservas.values_list('producto_id', flat=True))
+    if not productos:
+        return 0
+    with transaction.atomic():
+        return _soltar(reservas, _bloquear(productos))
+
+
+def liberar_reservas_vencidas(lote=1000, ahora=None):
+    """
+    Soltar hasta `lote` reservas vencidas (las más antiguas primero, por el
+    índice de `vence`). Devuelve cuántas se liberaron; se llama en bucle hasta
+    que devuelva 0.
+    """
+    ahora = ahora or timezone.now()
+    candidatas = list(
+        ReservaStock.objects.filter(vence__lte=ahora).order_by('vence').values_list('id', 'producto_id')[:lote]
+    )
+    if not candidatas:
+        return 0
+    with transaction.atomic():
+        registros = _bloquear({producto_id for _, producto_id in candidatas})
+        # Se vuelve a filtrar con los productos bloqueados: una reserva renovada
+        # entre tanto ya no está vencida y se conserva
+        return _soltar(
+            ReservaStock.objects.filter(id__in=[pk for pk, _ in candidatas], vence__lte=ahora),
+            registros,
+        )
+
+
+def reconciliar_reservas():
+    """Recalcular Stock.reservado desde ReservaStock; devuelve los productos corregidos"""
+    with transaction.atomic():
+        sumas = dict(
+            ReservaStock.objects.values('producto_id').annotate(total=Sum('cantidad'))
+            .values_list('producto_id', 'total').order_by()
+        )
+        registros = list(Stock.objects.select_for_update().filter(
+            Q(reservado__gt=0) | Q(producto_id__in=list(sumas))
+        ).order_by('producto_id'))
+        corregidos = []
+        for registro in registros:
+            esperado = sumas.get(registro.producto_id, 0)
+            if registro.reservado != esperado:
+                registro.reservado = esperado
+                corregidos.append(registro)
+        Stock.objects.bulk_update(corregidos, ['reservado'])
+        if corregidos:
+            invalidar_catalogo()
+    return len(corregidos)
@@ -0,0 +1,89 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from productos.models import Categoria, Producto, Marca, Proveedor
+from productos.inventario import fijar_stock
+from productos.views import ProductoListView, ProductoAdminView
+
+
+class Command(BaseCommand):
+    help = 'Mide las consultas SQL del catálogo según page_size (CU4/CU6)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--productos', type=int, default=200,
+                            help='Productos de prueba a crear (se revierten al terminar)')
+        parser.add_argument('--tamanos', default='10,50,100,200',
+                            help='Lista de page_size a medir, separados por coma')
+
+    def handle(self, *args, **options):
+        try:
+            tamanos = [int(t) for t in options['tamanos'].split(',') if t.strip()]
+        except ValueError:
+            raise CommandError('--tamanos debe ser una lista de enteros')
+
+        factory = RequestFactory()
+        vistas = [
+            ('/api/productos/', ProductoListView),
+            ('/api/productos/admin/', ProductoAdminView),
+        ]
+        resultados = []
+
+        # Todo se ejecuta en una transacción que se revierte al final
+        with transaction.atomic():
+            self._crear_datos_prueba(options['productos'])
+
+            for ruta, vista_cls in vistas:
+                for tamano in tamanos:
+                    request = factory.get(ruta, {'page': 1, 'page_size': tamano})
+                    with CaptureQueriesContext(connection) as contexto:
+                        inicio = time.perf_counter()
+                        response = vista_cls.as_view()(request)
+                        duracion = (time.perf_counter() - inicio) * 1000
+
+                    payload = json.loads(response.content)
+                    resultados.append({
+                        'ruta': ruta,
+                        'page_size': tamano,
+                        'items': len(payload.get('items', [])),
+                        'consultas': len(contexto.captured_queries),
+                        'ms': duracion,
+                    })
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"{'Ruta':<24}{'page_size':>10}{'items':>8}{'consultas':>11}{'ms':>10}")
+        for r in resultados:
+            self.stdout.write(
+                f"{r['ruta']:<24}{r['page_size']:>10}{r['items']:>8}{r['consultas']:>11}{r['ms']:>10.1f}"
+            )
+
+        for ruta, _ in vistas:
+            consultas = {r['consultas'] for r in resultados if r['ruta'] == ruta}
+            if len(consultas) > 1:
+                raise CommandError(f'{ruta}: el número de consultas varía con page_size ({sorted(consultas)})')
+
+        self.stdout.write(self.style.SUCCESS('Consultas constantes para todos los page_size medidos'))
+
+    def _crear_datos_prueba(self, cantidad):
+        """Crear productos con categoría, marca, proveedor y stock"""
+        categoria, _ = Categoria.objects.get_or_create(nombre='Benchmark')
+        marca, _ = Marca.objects.get_or_create(nombre='Benchmark')
+        proveedor, _ = Proveedor.objects.get_or_create(nombre='Benchmark')
+
+        productos = Producto.objects.bulk_create([
+            Producto(
+                nombre=f'Producto benchmark {i:05d}',
+                descripcion='Producto de prueba para medir consultas',
+                precio=10 + i,
+                categoria=categoria,
+                marca=marca,
+                proveedor=proveedor,
+            )
+            for i in range(cantidad)
+        ])
+        fijar_stock({producto.id: 5 for producto in productos}, referencia='benchmark')
@@ -0,0 +1,120 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Sum
+
+from productos.models import Producto, Stock, StockUbicacion, MovimientoStock
+from productos.inventario import descontar_stock, reponer_stock, StockInsuficiente
+
+
+class Command(BaseCommand):
+    help = 'Lanza compras concurrentes sobre un mismo producto y verifica que no haya sobreventa (CU10)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stock', type=int, default=20,
+                            help='Stock inicial del producto de prueba')
+        parser.add_argument('--compradores', type=int, default=50,
+                            help='Compras simultáneas (un hilo y una conexión por compra)')
+        parser.add_argument('--cantidad', type=int, default=1,
+                            help='Unidades por compra')
+        parser.add_argument('--legado', action='store_true',
+                            help='Usar la lectura-modificación-escritura anterior (muestra la sobreventa)')
+
+    def handle(self, *args, **options):
+        if options['stock'] < 0 or options['compradores'] < 1 or options['cantidad'] < 1:
+            raise CommandError('Parámetros inválidos')
+
+        # Los datos se confirman (los hilos usan sus propias conexiones) y se borran al final
+        producto = Producto.objects.create(nombre='Producto benchmark stock', precio=1)
+        try:
+            reponer_stock(producto.id, options['stock'], referencia='benchmark')
+            resultado = self._competir(producto.id, options)
+            self._reportar(producto.id, options, resultado)
+        finally:
+            producto.delete()  # Borra en cascada Stock y MovimientoStock
+
+    def _competir(self, producto_id, options):
+        compra = self._compra_legado if options['legado'] else self._compra
+        barrera = threading.Barrier(options['compradores'])
+        resultado = {'exitosas': 0, 'rechazadas': 0, 'errores': 0}
+        lock = threading.Lock()
+
+        def comprador(numero):
+            try:
+                barrera.wait()
+                estado = 'exitosas' if compra(producto_id, options['cantidad'], numero) else 'rechazadas'
+            except Exception as e:
+                self.stderr.write(f'Compra {numero}: {e}')
+                estado = 'errores'
+            finally:
+                connection.close()
+            with lock:
+                resultado[estado] += 1
+
+        hilos = [threading.Thread(target=comprador, args=(i,)) for i in range(options['compradores'])]
+        inicio = time.perf_counter()
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        resultado['ms'] = (time.perf_counter() - inicio) * 1000
+        return resultado
+
+    @staticmethod
+    def _compra(producto_id, cantidad, numero):
+        try:
+            with transaction.atomic():
+                descontar_stock([(producto_id, cantidad)], referencia=f'benchmark:{numero}')
+            return True
+        except StockInsuficiente:
+            return False
+
+    @staticmethod
+    def _compra_legado(producto_id, cantidad, numero):
+        """Patrón anterior de CheckoutView: verificar, leer, restar y guardar"""
+        stock_obj = Stock.objects.filter(producto_id=producto_id).first()
+        if stock_obj.cantidad < cantidad:
+            return False
+        stock_obj = Stock.objects.filter(producto_id=producto_id).first()
+        stock_obj.cantidad -= cantidad
+        stock_obj.save()
+        return True
+
+    def _reportar(self, producto_id, options, resultado):
+        inicial = options['stock']
+        vendidas = resultado['exitosas'] * options['cantidad']
+        final = Stock.objects.get(producto_id=producto_id).cantidad
+        libro = MovimientoStock.objects.filter(producto_id=producto_id).aggregate(total=Sum('cantidad'))['total'] or 0
+        ubicaciones = StockUbicacion.objects.filter(producto_id=producto_id).aggregate(total=Sum('cantidad'))['total'] or 0
+
+        self.stdout.write(f"Modo:               {'legado' if options['legado'] else 'inventario'}")
+        self.stdout.write(f"Compradores:        {options['compradores']} x {options['cantidad']} u.")
+        self.stdout.write(f"Compras exitosas:   {resultado['exitosas']}")
+        self.stdout.write(f"Compras rechazadas: {resultado['rechazadas']}")
+        self.stdout.write(f"Errores:            {resultado['errores']}")
+        self.stdout.write(f"Stock inicial/final: {inicial} / {final}")
+        self.stdout.write(f"Unidades vendidas:  {vendidas}")
+        self.stdout.write(f"Saldo del libro:    {libro}")
+        self.stdout.write(f"Suma ubicaciones:   {ubicaciones}")
+        self.stdout.write(f"Tiempo:             {resultado['ms']:.1f} ms")
+
+        problemas = []
+        if vendidas > inicial:
+            problemas.append(f'sobreventa de {vendidas - inicial} unidades')
+        if final != inicial - vendidas:
+            problemas.append(f'actualizaciones perdidas: el stock final debería ser {inicial - vendidas}')
+        if not options['legado'] and libro != final:
+            problemas.append(f'el libro de movimientos ({libro}) no coincide con el stock ({final})')
+        if not options['legado'] and ubicaciones != final:
+            problemas.append(f'la suma por ubicación ({ubicaciones}) no coincide con el stock ({final})')
+        esperadas = min(options['compradores'], inicial // options['cantidad'])
+        if not options['legado'] and resultado['exitosas'] < esperadas:
+            problemas.append(f"se rechazaron compras con stock disponible ({resultado['exitosas']} de {esperadas})")
+        if resultado['errores']:
+            problemas.append(f"{resultado['errores']} compras con error")
+
+        if problemas:
+            raise CommandError('; '.join(problemas))
+        self.stdout.write(self.style.SUCCESS('Sin sobreventa: stock, ubicaciones y libro de movimientos consistentes'))
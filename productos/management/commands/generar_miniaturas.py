@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from productos.models import Producto
+from productos.miniaturas import PIL_AVAILABLE, generar_miniaturas
+
+
+class Command(BaseCommand):
+    help = 'Genera las miniaturas WebP de las imágenes del catálogo (CU6)'
+
+    def handle(self, *args, **options):
+        if not PIL_AVAILABLE:
+            self.stdout.write(self.style.ERROR('Pillow no está instalado: no se pueden generar miniaturas'))
+            return
+
+        urls = Producto.objects.exclude(imagen__isnull=True).exclude(imagen='').values_list('imagen', flat=True).distinct()
+        generadas = errores = 0
+        for url in urls.iterator():
+            try:
+                generar_miniaturas(url)
+                generadas += 1
+            except Exception as e:
+                errores += 1
+                self.stdout.write(self.style.WARNING(f'{url}: {str(e)}'))
+
+        self.stdout.write(self.style.SUCCESS(f'Imágenes procesadas: {generadas} | Con error: {errores}'))
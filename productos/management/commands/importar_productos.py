@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from productos.importacion import ImportadorProductos, ErrorImportacion, leer_filas, detectar_formato, TAMANO_LOTE
+
+
+class Command(BaseCommand):
+    help = 'Importa productos desde un archivo CSV o NDJSON (CU6)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('archivo', help='Ruta del archivo .csv o .ndjson')
+        parser.add_argument('--formato', choices=['csv', 'ndjson'],
+                            help='Formato del archivo (por defecto se deduce de la extensión)')
+        parser.add_argument('--lote', type=int, default=TAMANO_LOTE,
+                            help='Filas por lote/transacción')
+        parser.add_argument('--atomico', action='store_true',
+                            help='Importar todo en una sola transacción (todo o nada)')
+        parser.add_argument('--reporte', help='Guardar el reporte completo en este archivo JSON')
+
+    def handle(self, *args, **options):
+        formato = options['formato'] or detectar_formato(options['archivo'])
+        try:
+            with open(options['archivo'], 'rb') as archivo:
+                importador = ImportadorProductos(tamano_lote=options['lote'], atomico=options['atomico'])
+                reporte = importador.importar(leer_filas(archivo, formato))
+        except FileNotFoundError:
+            raise CommandError(f"No existe el archivo {options['archivo']}")
+        except (ErrorImportacion, UnicodeDecodeError) as e:
+            raise CommandError(str(e))
+
+        for error in reporte['errores'][:20]:
+            self.stdout.write(self.style.WARNING(f"Fila {error['fila']}: {'; '.join(error['errores'])}"))
+        if reporte['con_error'] > 20:
+            self.stdout.write(self.style.WARNING(f"... y {reporte['con_error'] - 20} filas más con error"))
+
+        if options['reporte']:
+            with open(options['reporte'], 'w', encoding='utf-8') as salida:
+                json.dump(reporte, salida, ensure_ascii=False, indent=2)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Procesadas: {reporte['procesadas']} | Creados: {reporte['creados']} | "
+            f"Actualizados: {reporte['actualizados']} | Con error: {reporte['con_error']} | "
+            f"{reporte['segundos']}s"
+        ))
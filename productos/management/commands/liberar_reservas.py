@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from productos.inventario import liberar_reservas_vencidas, reconciliar_reservas
+
+
+class Command(BaseCommand):
+    help = 'Libera en lotes las reservas de stock vencidas de carritos y pagos pendientes (CU10)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=1000,
+                            help='Reservas liberadas por transacción')
+        parser.add_argument('--reconciliar', action='store_true',
+                            help='Recalcular además el total reservado de cada producto desde las reservas')
+
+    def handle(self, *args, **options):
+        if options['lote'] < 1:
+            raise CommandError('--lote debe ser mayor a 0')
+
+        inicio = time.perf_counter()
+        liberadas = lotes = 0
+        while True:
+            cantidad = liberar_reservas_vencidas(lote=options['lote'])
+            if not cantidad:
+                break
+            liberadas += cantidad
+            lotes += 1
+            self.stdout.write(f'Lote {lotes}: {cantidad} reservas liberadas')
+
+        mensaje = f'Reservas vencidas liberadas: {liberadas} en {lotes} lotes'
+        if options['reconciliar']:
+            mensaje += f' | Productos con total reservado corregido: {reconciliar_reservas()}'
+        self.stdout.write(self.style.SUCCESS(f'{mensaje} | {time.perf_counter() - inicio:.2f} s'))
@@ -1,5 +1,7 @@
 from django.core.management.base import BaseCommand
 from productos.models import Categoria, Producto, Marca, Proveedor, Stock
+from productos.busqueda import indexar_productos
+from productos.inventario import reponer_stock
 
 
 class Command(BaseCommand):
@@ -106,6 +108,7 @@ class Command(BaseCommand):
             },
         ]
 
+        producto_ids = []
         for data in items:
             stock_cantidad = data.pop('stock')  # Remover stock de los datos del producto
             
@@ -116,13 +119,14 @@ class Command(BaseCommand):
             
             # Crear stock para el producto
             if created or not Stock.objects.filter(producto=obj).exists():
-                Stock.objects.create(
-                    producto=obj,
-                    cantidad=stock_cantidad
-                )
+                reponer_stock(obj.id, stock_cantidad, referencia='seed')
             
+            producto_ids.append(obj.id)
             self.stdout.write(self.style.SUCCESS(f"{'Creado' if created else 'Existente'}: {obj.nombre}"))
 
+        # Mantener actualizado el índice de búsqueda
+        indexar_productos(producto_ids)
+
         self.stdout.write(self.style.SUCCESS('Productos de ejemplo listos'))
 
 
@@ -0,0 +1,43 @@
+# Búsqueda de texto completo para el catálogo (CU7)
+
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import migrations
+from django.db.models import F, Func, TextField, Value
+from django.db.models.functions import Coalesce
+
+
+def poblar_search_vector(apps, schema_editor):
+    """Calcular el índice de búsqueda de los productos existentes"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    acentos = Value('áàäâéèëêíìïîóòöôúùüûñçÁÀÄÂÉÈËÊÍÌÏÎÓÒÖÔÚÙÜÛÑÇ')
+    sin_acentos = Value('aaaaeeeeiiiioooouuuuncAAAAEEEEIIIIOOOOUUUUNC')
+    nombre = Func(F('nombre'), acentos, sin_acentos, function='translate', output_field=TextField())
+    descripcion = Func(Coalesce(F('descripcion'), Value(''), output_field=TextField()), acentos, sin_acentos,
+                       function='translate', output_field=TextField())
+    Producto = apps.get_model('productos', 'Producto')
+    Producto.objects.update(search_vector=(
+        SearchVector(nombre, weight='A', config='spanish')
+        + SearchVector(descripcion, weight='B', config='spanish')
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productos', '0004_sync_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='producto',
+            name='search_vector',
+            field=SearchVectorField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='producto',
+            index=GinIndex(fields=['search_vector'], name='producto_search_gin'),
+        ),
+        migrations.RunPython(poblar_search_vector, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,75 @@
+# Libro de movimientos de stock y un único registro de Stock por producto
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def unificar_stock(apps, schema_editor):
+    """Sumar en el primer registro los productos con varios registros de Stock"""
+    Stock = apps.get_model('productos', 'Stock')
+    duplicados = Stock.objects.values('producto_id').annotate(
+        registros=Count('id_stock'), primero=Min('id_stock'), total=Sum('cantidad')
+    ).filter(registros__gt=1)
+    for fila in duplicados:
+        Stock.objects.filter(pk=fila['primero']).update(cantidad=fila['total'])
+        Stock.objects.filter(producto_id=fila['producto_id']).exclude(pk=fila['primero']).delete()
+
+
+def saldos_iniciales(apps, schema_editor):
+    """Abrir el libro con un ajuste por el stock existente de cada producto"""
+    Stock = apps.get_model('productos', 'Stock')
+    MovimientoStock = apps.get_model('productos', 'MovimientoStock')
+    MovimientoStock.objects.bulk_create(
+        (
+            MovimientoStock(producto_id=producto_id, tipo='ajuste', cantidad=cantidad,
+                            saldo=cantidad, referencia='saldo_inicial')
+            for producto_id, cantidad in Stock.objects.values_list('producto_id', 'cantidad').iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productos', '0006_producto_indices_cursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MovimientoStock',
+            fields=[
+                ('id_movimiento', models.BigAutoField(primary_key=True, serialize=False)),
+                ('tipo', models.CharField(choices=[('venta', 'Venta'), ('reposicion', 'Reposición'), ('ajuste', 'Ajuste'), ('reserva', 'Reserva'), ('liberacion', 'Liberación de reserva')], max_length=20)),
+                ('cantidad', models.IntegerField()),
+                ('saldo', models.IntegerField()),
+                ('referencia', models.CharField(blank=True, default='', max_length=100)),
+                ('fecha', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Movimiento de Stock',
+                'verbose_name_plural': 'Movimientos de Stock',
+                'db_table': 'movimiento_stock',
+            },
+        ),
+        migrations.RunPython(unificar_stock, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='stock',
+            constraint=models.UniqueConstraint(fields=('producto',), name='stock_producto_unico'),
+        ),
+        migrations.AddField(
+            model_name='movimientostock',
+            name='producto',
+            field=models.ForeignKey(db_column='id_producto', on_delete=django.db.models.deletion.CASCADE, to='productos.producto'),
+        ),
+        migrations.AddIndex(
+            model_name='movimientostock',
+            index=models.Index(fields=['producto', 'fecha'], name='movstock_producto_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='movimientostock',
+            index=models.Index(fields=['referencia'], name='movstock_referencia_idx'),
+        ),
+        migrations.RunPython(saldos_iniciales, migrations.RunPython.noop),
+    ]
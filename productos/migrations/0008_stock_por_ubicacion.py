@@ -0,0 +1,68 @@
+# Stock por ubicación: el stock existente pasa a una ubicación "Principal"
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def crear_ubicacion_principal(apps, schema_editor):
+    Ubicacion = apps.get_model('productos', 'Ubicacion')
+    Stock = apps.get_model('productos', 'Stock')
+    StockUbicacion = apps.get_model('productos', 'StockUbicacion')
+    MovimientoStock = apps.get_model('productos', 'MovimientoStock')
+
+    principal, _ = Ubicacion.objects.get_or_create(nombre='Principal', defaults={'prioridad': 0})
+    StockUbicacion.objects.bulk_create(
+        (
+            StockUbicacion(producto_id=producto_id, ubicacion=principal, cantidad=cantidad)
+            for producto_id, cantidad in Stock.objects.values_list('producto_id', 'cantidad').iterator()
+        ),
+        batch_size=1000,
+    )
+    MovimientoStock.objects.update(ubicacion=principal)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productos', '0007_stock_libro_movimientos'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Ubicacion',
+            fields=[
+                ('id_ubicacion', models.AutoField(primary_key=True, serialize=False)),
+                ('nombre', models.CharField(max_length=100, unique=True)),
+                ('direccion', models.CharField(blank=True, max_length=255, null=True)),
+                ('prioridad', models.PositiveSmallIntegerField(default=100)),
+            ],
+            options={
+                'verbose_name': 'Ubicación',
+                'verbose_name_plural': 'Ubicaciones',
+                'db_table': 'ubicacion',
+                'ordering': ['prioridad', 'id_ubicacion'],
+            },
+        ),
+        migrations.AddField(
+            model_name='movimientostock',
+            name='ubicacion',
+            field=models.ForeignKey(blank=True, db_column='id_ubicacion', null=True, on_delete=django.db.models.deletion.SET_NULL, to='productos.ubicacion'),
+        ),
+        migrations.CreateModel(
+            name='StockUbicacion',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('cantidad', models.IntegerField(default=0)),
+                ('fecha_actualizacion', models.DateTimeField(auto_now=True)),
+                ('producto', models.ForeignKey(db_column='id_producto', on_delete=django.db.models.deletion.CASCADE, to='productos.producto')),
+                ('ubicacion', models.ForeignKey(db_column='id_ubicacion', on_delete=django.db.models.deletion.PROTECT, to='productos.ubicacion')),
+            ],
+            options={
+                'verbose_name': 'Stock por Ubicación',
+                'verbose_name_plural': 'Stock por Ubicación',
+                'db_table': 'stock_ubicacion',
+                'constraints': [models.UniqueConstraint(fields=('producto', 'ubicacion'), name='stock_ubicacion_unico')],
+            },
+        ),
+        migrations.RunPython(crear_ubicacion_principal, migrations.RunPython.noop),
+    ]
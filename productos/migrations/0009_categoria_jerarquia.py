@@ -0,0 +1,39 @@
+# Jerarquía de categorías: las existentes quedan como raíces
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def rutas_iniciales(apps, schema_editor):
+    Categoria = apps.get_model('productos', 'Categoria')
+    categorias = list(Categoria.objects.all())
+    for categoria in categorias:
+        categoria.ruta = f'{categoria.pk:06d}/'
+        categoria.nivel = 0
+    Categoria.objects.bulk_update(categorias, ['ruta', 'nivel'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productos', '0008_stock_por_ubicacion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='categoria',
+            name='nivel',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='categoria',
+            name='padre',
+            field=models.ForeignKey(blank=True, db_column='id_padre', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='subcategorias', to='productos.categoria'),
+        ),
+        migrations.AddField(
+            model_name='categoria',
+            name='ruta',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=255),
+        ),
+        migrations.RunPython(rutas_iniciales, migrations.RunPython.noop),
+    ]
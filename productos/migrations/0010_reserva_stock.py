@@ -0,0 +1,37 @@
+# Reservas de stock con vencimiento y total reservado por producto
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productos', '0009_categoria_jerarquia'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stock',
+            name='reservado',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ReservaStock',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('referencia', models.CharField(max_length=100)),
+                ('cantidad', models.PositiveIntegerField()),
+                ('vence', models.DateTimeField()),
+                ('fecha_actualizacion', models.DateTimeField(auto_now=True)),
+                ('producto', models.ForeignKey(db_column='id_producto', on_delete=django.db.models.deletion.CASCADE, to='productos.producto')),
+            ],
+            options={
+                'verbose_name': 'Reserva de Stock',
+                'verbose_name_plural': 'Reservas de Stock',
+                'db_table': 'reserva_stock',
+                'indexes': [models.Index(fields=['vence'], name='reserva_vence_idx')],
+                'constraints': [models.UniqueConstraint(fields=('referencia', 'producto'), name='reserva_referencia_producto')],
+            },
+        ),
+    ]
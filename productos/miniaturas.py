@@ -0,0 +1,217 @@
+"""
+CU6: Miniaturas de imágenes de productos
+
+Las miniaturas (WebP redimensionado) se generan en segundo plano y se guardan
+en MEDIA_ROOT/miniaturas con un nombre derivado de la URL de la imagen original
+y el ancho, por lo que un cambio de imagen produce otra dirección y los archivos
+se pueden servir como inmutables.
+
+El disco usado se limita con MINIATURAS_MAX_BYTES: al superarlo se borran las
+miniaturas usadas hace más tiempo (la fecha de modificación se renueva al servirlas).
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+from .subida_imagenes import TAMANO_BLOQUE, TAMANO_MAXIMO, sesion_http
+
+# Import opcional de Pillow
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    Image = None
+    PIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+ANCHOS_PERMITIDOS = (160, 320, 640)
+ANCHO_CATALOGO = 320
+CALIDAD_WEBP = 80
+CARPETA = 'miniaturas'
+# No renovar la fecha de uso más de una vez por hora por archivo
+INTERVALO_USO = 60 * 60
+
+
+def clave_imagen(url):
+    """Hash de la URL original (identifica la imagen fuente)"""
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+
+def _directorio():
+    return os.path.join(settings.MEDIA_ROOT, CARPETA)
+
+
+def ruta_miniatura(clave, ancho):
+    return os.path.join(_directorio(), clave[:2], f'{clave}_{ancho}.webp')
+
+
+def url_miniatura(producto_id, imagen, ancho=ANCHO_CATALOGO):
+    """URL pública de la miniatura (o la imagen original si no se pueden generar)"""
+    if not imagen:
+        return ''
+    if not PIL_AVAILABLE:
+        return imagen
+    return f'/api/productos/miniaturas/{producto_id}/{ancho}/{clave_imagen(imagen)}.webp'
+
+
+# ==========================================================
+# GENERACIÓN
+# ==========================================================
+
+def _descargar_original(url, destino):
+    """Copiar la imagen original (MEDIA_ROOT local o URL remota) al archivo `destino`"""
+    if url.startswith(settings.MEDIA_URL):
+        relativa = url[len(settings.MEDIA_URL):]
+        origen = os.path.realpath(os.path.join(settings.MEDIA_ROOT, relativa))
+        if not origen.startswith(os.path.realpath(settings.MEDIA_ROOT) + os.sep):
+            raise ValueError('Ruta de imagen fuera de MEDIA_ROOT')
+        with open(origen, 'rb') as archivo:
+            for bloque in iter(lambda: archivo.read(TAMANO_BLOQUE), b''):
+                destino.write(bloque)
+        return
+
+    if urlparse(url).scheme not in ('http', 'https'):
+        raise ValueError(f'URL de imagen no soportada: {url}')
+    with sesion_http().get(url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+        total = 0
+        for bloque in response.iter_content(TAMANO_BLOQUE):
+            total += len(bloque)
+            if total > TAMANO_MAXIMO:
+                raise ValueError('Imagen original demasiado grande')
+            destino.write(bloque)
+
+
+def generar_miniaturas(url, anchos=ANCHOS_PERMITIDOS):
+    """Generar (si faltan) las miniaturas de `url` para los anchos indicados"""
+    clave = clave_imagen(url)
+    faltantes = [ancho for ancho in anchos if not os.path.exists(ruta_miniatura(clave, ancho))]
+    if not faltantes:
+        return
+
+    with tempfile.TemporaryFile() as original:
+        _descargar_original(url, original)
+        original.seek(0)
+        with Image.open(original) as imagen:
+            imagen.load()
+            if imagen.mode not in ('RGB', 'RGBA'):
+                imagen = imagen.convert('RGBA' if 'transparency' in imagen.info else 'RGB')
+
+            for ancho in faltantes:
+                copia = imagen.copy()
+                copia.thumbnail((ancho, ancho * 4), Image.LANCZOS)
+                ruta = ruta_miniatura(clave, ancho)
+                os.makedirs(os.path.dirname(ruta), exist_ok=True)
+                # Escritura atómica: nunca se sirve un archivo a medio escribir
+                descriptor, temporal = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(ruta))
+                with os.fdopen(descriptor, 'wb') as salida:
+                    copia.save(salida, 'WEBP', quality=CALIDAD_WEBP, method=4)
+                os.replace(temporal, ruta)
+                espacio.agregado(os.path.getsize(ruta))
+
+
+class EspacioMiniaturas:
+    """Controla el disco usado por las miniaturas y expulsa las menos usadas"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bytes = None
+
+    def _limite(self):
+        return getattr(settings, 'MINIATURAS_MAX_BYTES', 500 * 1024 * 1024)
+
+    def _archivos(self):
+        for raiz, _, nombres in os.walk(_directorio()):
+            for nombre in nombres:
+                if nombre.endswith('.webp'):
+                    ruta = os.path.join(raiz, nombre)
+                    try:
+                        info = os.stat(ruta)
+                    except FileNotFoundError:
+                        continue
+                    yield info.st_mtime, info.st_size, ruta
+
+    def agregado(self, tamano):
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(t for _, t, _ in self._archivos())
+            else:
+                self._bytes += tamano
+            if self._bytes > self._limite():
+                self._expulsar()
+
+    def _expulsar(self):
+        """Borrar por orden de último uso hasta quedar en el 90% del límite"""
+        archivos = sorted(self._archivos())
+        total = sum(t for _, t, _ in archivos)
+        objetivo = self._limite() * 0.9
+        for _, tamano, ruta in archivos:
+            if total <= objetivo:
+                break
+            try:
+                os.remove(ruta)
+                total -= tamano
+            except FileNotFoundError:
+                pass
+        self._bytes = total
+
+
+espacio = EspacioMiniaturas()
+
+
+def marcar_uso(ruta):
+    """Renovar la fecha de uso (base de la expulsión LRU)"""
+    try:
+        if time.time() - os.path.getmtime(ruta) > INTERVALO_USO:
+            os.utime(ruta)
+    except OSError:
+        pass
+
+
+# ==========================================================
+# COLA EN SEGUNDO PLANO
+# ==========================================================
+
+_executor = None
+_pendientes = set()
+_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'MINIATURAS_WORKERS', 2),
+            thread_name_prefix='miniaturas',
+        )
+    return _executor
+
+
+def _trabajo(url):
+    try:
+        generar_miniaturas(url)
+    except Exception as e:
+        logger.warning(f"No se pudo generar la miniatura de {url}: {str(e)}")
+    finally:
+        with _lock:
+            _pendientes.discard(url)
+
+
+def encolar_miniaturas(url):
+    """Programar la generación de miniaturas de `url` (sin duplicar trabajos en curso)"""
+    if not url or not PIL_AVAILABLE:
+        return
+    with _lock:
+        if url in _pendientes:
+            return
+        _pendientes.add(url)
+        _pool().submit(_trabajo, url)
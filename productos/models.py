@@ -1,4 +1,8 @@
 from django.db import models
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Concat, LPad
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 
 
 class Marca(models.Model):
@@ -14,10 +18,40 @@ class Marca(models.Model):
         return self.nombre
 
 
+class CategoriaQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """
+        bulk_create no pasa por save(), que arma la ruta: se completa después
+        para las creadas sin ruta (raíces y luego hijas de padres con ruta).
+        Se buscan por nombre (único): con ignore_conflicts no reciben su id.
+        """
+        objs = super().bulk_create(objs, *args, **kwargs)
+        nombres = [categoria.nombre for categoria in objs if not categoria.ruta]
+        if nombres:
+            sin_ruta = self.model.objects.filter(nombre__in=nombres, ruta='')
+            segmento = Concat(LPad(Cast('id_categoria', models.CharField()), 6, Value('0')), Value('/'))
+            sin_ruta.filter(padre__isnull=True).update(ruta=segmento, nivel=0)
+            padre = self.model.objects.filter(pk=OuterRef('padre_id'))
+            sin_ruta.filter(padre__isnull=False).exclude(padre__ruta='').update(
+                ruta=Concat(Subquery(padre.values('ruta')[:1]), segmento),
+                nivel=Subquery(padre.values('nivel')[:1]) + 1,
+            )
+        return objs
+
+
 class Categoria(models.Model):
     id_categoria = models.AutoField(primary_key=True)
     nombre = models.CharField(max_length=100, unique=True)
     descripcion = models.TextField(blank=True, null=True)
+    padre = models.ForeignKey('self', on_delete=models.PROTECT, null=True, blank=True,
+                              related_name='subcategorias', db_column='id_padre')
+    # Ruta materializada: ids de los ancestros y el propio, p. ej. '000003/000012/'.
+    # El subárbol de una categoría es un LIKE 'ruta%' (índice varchar_pattern_ops)
+    ruta = models.CharField(max_length=255, default='', blank=True, db_index=True)
+    nivel = models.PositiveSmallIntegerField(default=0)
+
+    objects = CategoriaQuerySet.as_manager()
 
     class Meta:
         db_table = 'categoria'
@@ -27,6 +61,15 @@ class Categoria(models.Model):
     def __str__(self):
         return self.nombre
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if not self.ruta:
+            # La ruta incluye el propio id: se completa después del INSERT.
+            # Los cambios de padre se hacen con categorias.mover_categoria
+            self.ruta = f"{self.padre.ruta if self.padre_id else ''}{self.pk:06d}/"
+            self.nivel = self.ruta.count('/') - 1
+            Categoria.objects.filter(pk=self.pk).update(ruta=self.ruta, nivel=self.nivel)
+
 
 class Proveedor(models.Model):
     id_proveedor = models.AutoField(primary_key=True)
@@ -57,20 +100,73 @@ class Producto(models.Model):
     marca = models.ForeignKey(Marca, on_delete=models.SET_NULL, null=True, blank=True, db_column='id_marca')
     categoria = models.ForeignKey(Categoria, on_delete=models.SET_NULL, null=True, blank=True, db_column='id_categoria')
     proveedor = models.ForeignKey(Proveedor, on_delete=models.SET_NULL, null=True, blank=True, db_column='id_proveedor')
+    # Índice de búsqueda de texto completo (nombre + descripción), ver productos/busqueda.py
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
 
     class Meta:
         db_table = 'producto'
         verbose_name = 'Producto'
         verbose_name_plural = 'Productos'
         ordering = ['nombre']
+        indexes = [
+            GinIndex(fields=['search_vector'], name='producto_search_gin'),
+            # Índices compuestos para la paginación por cursor (clave, id)
+            models.Index(fields=['nombre', 'id'], name='producto_nombre_id_idx'),
+            models.Index(fields=['precio', 'id'], name='producto_precio_id_idx'),
+        ]
 
     def __str__(self):
         return self.nombre
 
 
+class Ubicacion(models.Model):
+    """Depósito o sucursal donde se guarda mercadería"""
+    id_ubicacion = models.AutoField(primary_key=True)
+    nombre = models.CharField(max_length=100, unique=True)
+    direccion = models.CharField(max_length=255, blank=True, null=True)
+    # Menor = se usa primero al asignar una venta y recibe las entradas sin ubicación
+    prioridad = models.PositiveSmallIntegerField(default=100)
+
+    class Meta:
+        db_table = 'ubicacion'
+        verbose_name = 'Ubicación'
+        verbose_name_plural = 'Ubicaciones'
+        ordering = ['prioridad', 'id_ubicacion']
+
+    def __str__(self):
+        return self.nombre
+
+
+class StockUbicacion(models.Model):
+    """Existencia del producto en una ubicación"""
+    id = models.BigAutoField(primary_key=True)
+    producto = models.ForeignKey(Producto, on_delete=models.CASCADE, db_column='id_producto')
+    ubicacion = models.ForeignKey(Ubicacion, on_delete=models.PROTECT, db_column='id_ubicacion')
+    cantidad = models.IntegerField(default=0)
+    fecha_actualizacion = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'stock_ubicacion'
+        verbose_name = 'Stock por Ubicación'
+        verbose_name_plural = 'Stock por Ubicación'
+        constraints = [
+            models.UniqueConstraint(fields=['producto', 'ubicacion'], name='stock_ubicacion_unico'),
+        ]
+
+    def __str__(self):
+        return f"Stock {self.producto_id} en {self.ubicacion_id}: {self.cantidad}"
+
+
 class Stock(models.Model):
+    """
+    Existencia total del producto: suma de StockUbicacion y saldo materializado
+    de MovimientoStock. Es el valor que leen catálogo y carrito.
+    """
     id_stock = models.AutoField(primary_key=True)
     cantidad = models.IntegerField(default=0)
+    # Suma de ReservaStock del producto (se mantiene en productos/inventario.py);
+    # lo vendible es cantidad - reservado
+    reservado = models.IntegerField(default=0)
     fecha_actualizacion = models.DateTimeField(auto_now=True)
     producto = models.ForeignKey(Producto, on_delete=models.CASCADE, db_column='id_producto')
 
@@ -78,11 +174,76 @@ class Stock(models.Model):
         db_table = 'stock'
         verbose_name = 'Stock'
         verbose_name_plural = 'Stocks'
+        constraints = [
+            # Un único registro de stock por producto (ver productos/inventario.py)
+            models.UniqueConstraint(fields=['producto'], name='stock_producto_unico'),
+        ]
 
     def __str__(self):
         return f"Stock {self.producto.nombre}: {self.cantidad}"
 
 
+class MovimientoStock(models.Model):
+    """Libro de movimientos de stock: cada cambio de existencia queda registrado"""
+    TIPOS_MOVIMIENTO = [
+        ('venta', 'Venta'),
+        ('reposicion', 'Reposición'),
+        ('ajuste', 'Ajuste'),
+        ('reserva', 'Reserva'),
+        ('liberacion', 'Liberación de reserva'),
+    ]
+
+    id_movimiento = models.BigAutoField(primary_key=True)
+    producto = models.ForeignKey(Producto, on_delete=models.CASCADE, db_column='id_producto')
+    ubicacion = models.ForeignKey(Ubicacion, on_delete=models.SET_NULL, null=True, blank=True, db_column='id_ubicacion')
+    tipo = models.CharField(max_length=20, choices=TIPOS_MOVIMIENTO)
+    cantidad = models.IntegerField()  # Con signo: negativo = salida
+    saldo = models.IntegerField()  # Existencia total del producto tras el movimiento
+    referencia = models.CharField(max_length=100, blank=True, default='')  # p. ej. "venta:15"
+    fecha = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'movimiento_stock'
+        verbose_name = 'Movimiento de Stock'
+        verbose_name_plural = 'Movimientos de Stock'
+        indexes = [
+            models.Index(fields=['producto', 'fecha'], name='movstock_producto_fecha_idx'),
+            models.Index(fields=['referencia'], name='movstock_referencia_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_tipo_display()} {self.cantidad:+d} ({self.producto_id})"
+
+
+class ReservaStock(models.Model):
+    """
+    Unidades retenidas para un carrito o un pago pendiente hasta `vence`.
+    Una fila por referencia y producto; al vencer deja de contar y la libera
+    la siguiente operación sobre el producto o el barrido
+    (`python manage.py liberar_reservas`).
+    """
+    id = models.BigAutoField(primary_key=True)
+    producto = models.ForeignKey(Producto, on_delete=models.CASCADE, db_column='id_producto')
+    referencia = models.CharField(max_length=100)  # p. ej. "carrito:17", "venta:33"
+    cantidad = models.PositiveIntegerField()
+    vence = models.DateTimeField()
+    fecha_actualizacion = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'reserva_stock'
+        verbose_name = 'Reserva de Stock'
+        verbose_name_plural = 'Reservas de Stock'
+        constraints = [
+            models.UniqueConstraint(fields=['referencia', 'producto'], name='reserva_referencia_producto'),
+        ]
+        indexes = [
+            models.Index(fields=['vence'], name='reserva_vence_idx'),
+        ]
+
+    def __str__(self):
+        return f"Reserva {self.referencia}: {self.cantidad} de {self.producto_id}"
+
+
 class Medidas(models.Model):
     id = models.AutoField(primary_key=True)
     tipo_medida = models.CharField(max_length=50)  # peso, volumen, dimensiones, etc.
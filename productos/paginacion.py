@@ -0,0 +1,98 @@
+"""
+CU6: Paginación por cursor (keyset) del catálogo
+
+Cada página se obtiene con `WHERE (clave, id) > (último valor, último id)`
+sobre un índice compuesto, por lo que el costo no depende de la profundidad
+de la página ni requiere un COUNT. El cursor es un token opaco (base64 de JSON).
+"""
+import base64
+import binascii
+import json
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection
+from django.db.models import Q
+
+
+# Orden soportado -> (campo, descendente)
+ORDENES_CURSOR = {
+    'nombre': ('nombre', False),
+    'precio': ('precio', False),
+    '-precio': ('precio', True),
+}
+
+
+class CursorInvalido(ValueError):
+    """El token de cursor no se puede decodificar o no corresponde al orden pedido"""
+
+
+def codificar_cursor(orden, valor, producto_id):
+    datos = json.dumps({'o': orden, 'v': str(valor), 'id': producto_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(datos.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor(token, orden):
+    """Devolver (valor, id) del cursor validando que pertenezca al mismo orden"""
+    try:
+        relleno = '=' * (-len(token) % 4)
+        datos = json.loads(base64.urlsafe_b64decode(token + relleno))
+        orden_cursor = datos['o']
+        valor = datos['v']
+        producto_id = int(datos['id'])
+        if ORDENES_CURSOR[orden][0] == 'precio':
+            valor = Decimal(valor)
+    except (binascii.Error, ValueError, KeyError, TypeError, InvalidOperation):
+        raise CursorInvalido('Cursor inválido')
+
+    if orden_cursor != orden:
+        raise CursorInvalido('El cursor corresponde a otro orden')
+    return valor, producto_id
+
+
+def ordenar_para_cursor(productos, orden):
+    """Orden total (clave, id) necesario para que el cursor sea estable"""
+    campo, descendente = ORDENES_CURSOR[orden]
+    if descendente:
+        return productos.order_by(f'-{campo}', '-id')
+    return productos.order_by(campo, 'id')
+
+
+def filtrar_despues_de(productos, orden, valor, producto_id):
+    """
+    Aplicar la condición keyset. La cota redundante (>= / <=) permite a
+    PostgreSQL iniciar un range scan sobre el índice compuesto.
+    """
+    campo, descendente = ORDENES_CURSOR[orden]
+    if descendente:
+        return productos.filter(**{f'{campo}__lte': valor}).filter(
+            Q(**{f'{campo}__lt': valor}) | Q(**{campo: valor, 'id__lt': producto_id})
+        )
+    return productos.filter(**{f'{campo}__gte': valor}).filter(
+        Q(**{f'{campo}__gt': valor}) | Q(**{campo: valor, 'id__gt': producto_id})
+    )
+
+
+def cursor_siguiente(item, orden):
+    """Construir el cursor de la página siguiente a partir del último item serializado"""
+    campo = ORDENES_CURSOR[orden][0]
+    valor = item[campo]
+    if campo == 'precio':
+        # repr de un float con 2 decimales recupera exactamente el valor original
+        valor = repr(valor)
+    return codificar_cursor(orden, valor, item['id'])
+
+
+def estimar_total(productos):
+    """
+    Total aproximado según las estadísticas del planificador (sin COUNT).
+    Devuelve None si el motor no ofrece estimaciones.
+    """
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = productos.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
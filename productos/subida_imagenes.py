@@ -0,0 +1,236 @@
+"""
+Subida de imágenes de productos
+
+Pipeline:
+1. El archivo recibido se copia por bloques a un temporal en disco (spool),
+   calculando su hash, sin cargarlo completo en memoria ni codificarlo en base64.
+2. Un almacén sube el temporal:
+   - 'imgbb': multipart en streaming sobre una sesión HTTP compartida
+     (keep-alive y pool de conexiones).
+   - 'local': copia en MEDIA_ROOT, para desarrollo y pruebas sin red.
+3. En modo asíncrono la subida corre en un pool de hilos y el cliente consulta
+   el estado con el id devuelto. El estado se guarda en la caché compartida
+   IMAGENES_CACHE_ALIAS: la consulta puede llegar a otro worker.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import caches
+
+# Import opcional: permite enviar el multipart sin armarlo completo en memoria
+try:
+    from requests_toolbelt.multipart.encoder import MultipartEncoder
+    TOOLBELT_AVAILABLE = True
+except ImportError:
+    MultipartEncoder = None
+    TOOLBELT_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+TIPOS_PERMITIDOS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+}
+TAMANO_MAXIMO = 32 * 1024 * 1024  # 32MB (límite de ImgBB gratuito)
+TAMANO_BLOQUE = 64 * 1024
+
+URL_IMGBB = 'https://api.imgbb.com/1/upload'
+TTL_ESTADO = 60 * 60  # Segundos que se conserva el estado de una subida
+
+
+class ErrorSubida(Exception):
+    """Error al subir la imagen al almacén; `status` es el código HTTP de la respuesta"""
+
+    def __init__(self, mensaje, status=500):
+        super().__init__(mensaje)
+        self.status = status
+
+
+# ==========================================================
+# SPOOL A DISCO
+# ==========================================================
+
+def _directorio_spool():
+    directorio = getattr(settings, 'IMAGENES_SPOOL_DIR', None) or os.path.join(tempfile.gettempdir(), 'subidas_imagenes')
+    os.makedirs(directorio, exist_ok=True)
+    return directorio
+
+
+def guardar_temporal(archivo):
+    """Copiar el archivo subido a disco por bloques. Devuelve (ruta, sha256)"""
+    extension = TIPOS_PERMITIDOS.get(archivo.content_type, '')
+    hash_archivo = hashlib.sha256()
+    descriptor, ruta = tempfile.mkstemp(suffix=extension, dir=_directorio_spool())
+    try:
+        with os.fdopen(descriptor, 'wb') as destino:
+            for bloque in archivo.chunks(TAMANO_BLOQUE):
+                hash_archivo.update(bloque)
+                destino.write(bloque)
+    except Exception:
+        os.remove(ruta)
+        raise
+    return ruta, hash_archivo.hexdigest()
+
+
+# ==========================================================
+# ALMACENES
+# ==========================================================
+
+_sesion = None
+_sesion_lock = threading.Lock()
+
+
+def sesion_http():
+    """Sesión HTTP compartida por el proceso (reutiliza conexiones keep-alive)"""
+    global _sesion
+    if _sesion is None:
+        with _sesion_lock:
+            if _sesion is None:
+                sesion = requests.Session()
+                adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=getattr(settings, 'IMAGENES_WORKERS', 4) * 2)
+                sesion.mount('https://', adaptador)
+                sesion.mount('http://', adaptador)
+                _sesion = sesion
+    return _sesion
+
+
+class AlmacenImgBB:
+    """Sube la imagen a ImgBB como archivo binario (multipart)"""
+
+    def subir(self, ruta, nombre, content_type, sha256):
+        with open(ruta, 'rb') as archivo:
+            if TOOLBELT_AVAILABLE:
+                cuerpo = MultipartEncoder(fields={
+                    'key': settings.API_KEY_IMGBB,
+                    'image': (nombre, archivo, content_type),
+                })
+                response = sesion_http().post(
+                    URL_IMGBB, data=cuerpo, headers={'Content-Type': cuerpo.content_type}, timeout=30
+                )
+            else:
+                response = sesion_http().post(
+                    URL_IMGBB,
+                    data={'key': settings.API_KEY_IMGBB},
+                    files={'image': (nombre, archivo, content_type)},
+                    timeout=30,
+                )
+        try:
+            result = response.json()
+        except ValueError:
+            raise ErrorSubida('Respuesta inválida de ImgBB')
+        if not result.get('success'):
+            # ImgBB rechazó la imagen (clave, formato o tamaño): error de la solicitud
+            raise ErrorSubida('Error al subir imagen a ImgBB', status=400)
+        return result['data']['url']
+
+
+class AlmacenLocal:
+    """Guarda la imagen en MEDIA_ROOT (nombre por contenido: no duplica archivos)"""
+
+    carpeta = 'productos'
+
+    def subir(self, ruta, nombre, content_type, sha256):
+        relativa = os.path.join(self.carpeta, sha256 + TIPOS_PERMITIDOS.get(content_type, ''))
+        destino = os.path.join(settings.MEDIA_ROOT, relativa)
+        if not os.path.exists(destino):
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            shutil.copyfile(ruta, destino)
+        return settings.MEDIA_URL + relativa.replace(os.sep, '/')
+
+
+ALMACENES = {
+    'imgbb': AlmacenImgBB,
+    'local': AlmacenLocal,
+}
+
+
+def obtener_almacen():
+    nombre = getattr(settings, 'IMAGENES_ALMACEN', 'imgbb')
+    if nombre not in ALMACENES:
+        raise ErrorSubida(f'Almacén de imágenes desconocido: {nombre}')
+    return ALMACENES[nombre]()
+
+
+# ==========================================================
+# PROCESO SÍNCRONO / ASÍNCRONO
+# ==========================================================
+
+def procesar_subida(ruta, nombre, content_type, sha256):
+    """Subir el temporal al almacén configurado y borrarlo. Devuelve la URL"""
+    try:
+        return obtener_almacen().subir(ruta, nombre, content_type, sha256)
+    except requests.exceptions.Timeout:
+        raise ErrorSubida('Timeout al subir imagen')
+    except requests.exceptions.RequestException as e:
+        raise ErrorSubida(f'Error de conexión: {str(e)}')
+    finally:
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'IMAGENES_WORKERS', 4),
+                    thread_name_prefix='subida-imagen',
+                )
+    return _executor
+
+
+def _clave_estado(upload_id):
+    return f'subida_imagen:{upload_id}'
+
+
+def _cache():
+    return caches[getattr(settings, 'IMAGENES_CACHE_ALIAS', 'compartida')]
+
+
+def estado_subida(upload_id):
+    return _cache().get(_clave_estado(upload_id))
+
+
+def _guardar_estado(upload_id, **estado):
+    _cache().set(_clave_estado(upload_id), estado, timeout=TTL_ESTADO)
+
+
+def _subir_en_segundo_plano(upload_id, ruta, nombre, content_type, sha256):
+    _guardar_estado(upload_id, estado='procesando')
+    try:
+        url = procesar_subida(ruta, nombre, content_type, sha256)
+        _guardar_estado(upload_id, estado='completada', image_url=url)
+        from .miniaturas import encolar_miniaturas
+        encolar_miniaturas(url)
+    except ErrorSubida as e:
+        _guardar_estado(upload_id, estado='error', message=str(e))
+    except Exception as e:
+        logger.error(f"Error en subida de imagen {upload_id}: {str(e)}", exc_info=True)
+        _guardar_estado(upload_id, estado='error', message='Error interno al subir imagen')
+
+
+def encolar_subida(ruta, nombre, content_type, sha256):
+    """Programar la subida en el pool de hilos y devolver su id"""
+    upload_id = uuid.uuid4().hex
+    _guardar_estado(upload_id, estado='pendiente')
+    _pool().submit(_subir_en_segundo_plano, upload_id, ruta, nombre, content_type, sha256)
+    return upload_id
@@ -0,0 +1,265 @@
+"""
+CU7: Sugerencias de búsqueda (autocompletado)
+
+Índice en memoria del proceso con los nombres de productos, marcas y
+categorías, normalizados sin acentos:
+- prefijos de palabra: lista ordenada (palabra, clave) recorrida con bisect;
+- trigramas: para tolerar errores de tipeo cuando no alcanzan los prefijos.
+
+Se construye en la primera consulta y se actualiza de forma incremental desde
+las rutas de escritura del catálogo. Como cada worker tiene su propio índice,
+además se reconstruye en segundo plano cada SUGERENCIAS_TTL segundos para
+recoger cambios hechos en otros procesos.
+"""
+import bisect
+import heapq
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+from .busqueda import tokenizar
+from .models import Producto, Categoria, Marca
+
+
+LIMITE_SUGERENCIAS = 8
+SIMILITUD_MINIMA = 0.4
+# Cotas para prefijos muy cortos o trigramas muy comunes (mantienen la consulta < 1 ms)
+MAX_CANDIDATOS = 1000
+MAX_CLAVES_TRIGRAMA = 2000
+
+# Orden de presentación a igual coincidencia
+PRIORIDAD_TIPO = {'categoria': 0, 'marca': 1, 'producto': 2}
+
+
+def trigramas(texto):
+    texto = f'  {texto} '
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+
+class IndiceSugerencias:
+    """Índice clave (tipo, id) -> nombre con búsqueda por prefijo y por trigramas"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._construido = False
+        self._reconstruyendo = False
+        self._construido_en = 0.0
+        self._vaciar()
+
+    def _vaciar(self):
+        self._nombres = {}
+        self._normalizados = {}
+        self._palabras_por_clave = {}
+        # Pares (palabra, clave) ordenados; categorías y marcas van aparte para
+        # recorrerlas completas aunque el prefijo coincida con miles de productos
+        self._palabras = {'producto': [], 'otros': []}
+        self._trigramas = defaultdict(set)
+
+    @staticmethod
+    def _grupo(clave):
+        return 'producto' if clave[0] == 'producto' else 'otros'
+
+    # ------------------------------------------------------
+    # Construcción
+    # ------------------------------------------------------
+
+    def _entradas_bd(self):
+        for pk, nombre in Categoria.objects.values_list('id_categoria', 'nombre').iterator():
+            yield ('categoria', pk), nombre
+        for pk, nombre in Marca.objects.values_list('id_marca', 'nombre').iterator():
+            yield ('marca', pk), nombre
+        for pk, nombre in Producto.objects.values_list('id', 'nombre').iterator():
+            yield ('producto', pk), nombre
+
+    def _construir(self):
+        nuevo = IndiceSugerencias()
+        for clave, nombre in self._entradas_bd():
+            nuevo._palabras[self._grupo(clave)].extend(nuevo._registrar(clave, nombre))
+        for pares in nuevo._palabras.values():
+            pares.sort()
+        return nuevo
+
+    def _instalar(self, nuevo):
+        self._nombres = nuevo._nombres
+        self._normalizados = nuevo._normalizados
+        self._palabras_por_clave = nuevo._palabras_por_clave
+        self._trigramas = nuevo._trigramas
+        self._palabras = nuevo._palabras
+        self._construido = True
+        self._construido_en = time.monotonic()
+
+    def _asegurar_construido(self):
+        if not self._construido:
+            with self._lock:
+                if not self._construido:
+                    self._instalar(self._construir())
+            return
+        ttl = getattr(settings, 'SUGERENCIAS_TTL', 600)
+        if ttl and time.monotonic() - self._construido_en > ttl and not self._reconstruyendo:
+            self._reconstruyendo = True
+            threading.Thread(target=self._reconstruir, daemon=True).start()
+
+    def _reconstruir(self):
+        """Reconstrucción completa sin bloquear las consultas (se reemplaza al terminar)"""
+        try:
+            nuevo = self._construir()
+            with self._lock:
+                self._instalar(nuevo)
+        finally:
+            self._reconstruyendo = False
+
+    def _registrar(self, clave, nombre):
+        """Agregar la entrada a nombres y trigramas; devuelve sus pares (palabra, clave)"""
+        normalizado = ' '.join(tokenizar(nombre))
+        palabras = tuple(sorted(set(normalizado.split())))
+        self._nombres[clave] = nombre
+        self._normalizados[clave] = normalizado
+        self._palabras_por_clave[clave] = palabras
+        for trigrama in trigramas(normalizado):
+            self._trigramas[trigrama].add(clave)
+        return [(palabra, clave) for palabra in palabras]
+
+    def _quitar(self, clave):
+        if clave not in self._nombres:
+            return
+        pares = self._palabras[self._grupo(clave)]
+        for palabra in self._palabras_por_clave.pop(clave):
+            posicion = bisect.bisect_left(pares, (palabra, clave))
+            if posicion < len(pares) and pares[posicion] == (palabra, clave):
+                del pares[posicion]
+        for trigrama in trigramas(self._normalizados.pop(clave)):
+            claves = self._trigramas.get(trigrama)
+            if claves is not None:
+                claves.discard(clave)
+                if not claves:
+                    del self._trigramas[trigrama]
+        del self._nombres[clave]
+
+    # ------------------------------------------------------
+    # Actualización incremental
+    # ------------------------------------------------------
+
+    def actualizar(self, entradas):
+        """Reemplazar entradas [(clave, nombre)]; nombre None elimina la entrada"""
+        if not self._construido:
+            return  # Se cargarán al construir el índice
+        with self._lock:
+            for clave, nombre in entradas:
+                if self._nombres.get(clave) == nombre:
+                    continue
+                self._quitar(clave)
+                if nombre:
+                    for par in self._registrar(clave, nombre):
+                        bisect.insort(self._palabras[self._grupo(clave)], par)
+
+    # ------------------------------------------------------
+    # Consulta
+    # ------------------------------------------------------
+
+    @staticmethod
+    def _rango(pares, token):
+        """Posiciones [inicio, fin) de las palabras que empiezan con `token`"""
+        return bisect.bisect_left(pares, (token,)), bisect.bisect_left(pares, (token + '\uffff',))
+
+    def _por_prefijo(self, tokens):
+        # Se recorre el token más selectivo y el resto se verifica por entrada
+        productos = self._palabras['producto']
+        tokens = sorted(set(tokens), key=lambda t: self._rango(productos, t)[1] - self._rango(productos, t)[0])
+        primero, resto = tokens[0], tokens[1:]
+
+        candidatos = set()
+        for grupo, pares in self._palabras.items():
+            inicio, fin = self._rango(pares, primero)
+            if grupo == 'producto':
+                fin = min(fin, inicio + MAX_CANDIDATOS)
+            candidatos.update(clave for _, clave in pares[inicio:fin])
+        if resto:
+            candidatos = {
+                clave for clave in candidatos
+                if all(any(p.startswith(t) for p in self._palabras_por_clave[clave]) for t in resto)
+            }
+        return candidatos
+
+    def _por_trigramas(self, texto):
+        buscados = trigramas(texto)
+        coincidencias = defaultdict(int)
+        for trigrama in buscados:
+            claves = self._trigramas.get(trigrama, ())
+            if len(claves) > MAX_CLAVES_TRIGRAMA:
+                continue  # Demasiado común para discriminar (cuenta como no coincidente)
+            for clave in claves:
+                coincidencias[clave] += 1
+        return {
+            clave: cantidad / len(buscados)
+            for clave, cantidad in coincidencias.items()
+            if cantidad / len(buscados) >= SIMILITUD_MINIMA
+        }
+
+    def buscar(self, texto, limite=LIMITE_SUGERENCIAS):
+        self._asegurar_construido()
+        tokens = tokenizar(texto)
+        if not tokens:
+            return []
+        consulta = ' '.join(tokens)
+
+        with self._lock:
+            candidatos = self._por_prefijo(tokens)
+            resultados = heapq.nsmallest(
+                limite,
+                candidatos,
+                key=lambda c: (
+                    not self._normalizados[c].startswith(consulta),
+                    PRIORIDAD_TIPO[c[0]],
+                    len(self._normalizados[c]),
+                    self._normalizados[c],
+                ),
+            )
+
+            # Tolerancia a errores de tipeo si faltan resultados
+            if len(resultados) < limite and len(consulta) >= 3:
+                similares = self._por_trigramas(consulta)
+                extra = sorted(
+                    (c for c in similares if c not in candidatos),
+                    key=lambda c: (-similares[c], PRIORIDAD_TIPO[c[0]], len(self._normalizados[c])),
+                )
+                resultados.extend(extra[:limite - len(resultados)])
+
+            return [
+                {'tipo': tipo, 'id': pk, 'texto': self._nombres[(tipo, pk)]}
+                for tipo, pk in resultados
+            ]
+
+
+indice_sugerencias = IndiceSugerencias()
+
+
+# ==========================================================
+# API PÚBLICA (rutas de escritura)
+# ==========================================================
+
+def refrescar_productos(producto_ids):
+    """Actualizar productos (y sus marcas/categorías) tras crearlos o editarlos"""
+    if not indice_sugerencias._construido:
+        return
+    entradas = []
+    filas = Producto.objects.filter(pk__in=list(producto_ids)).values(
+        'id', 'nombre', 'marca_id', 'marca__nombre', 'categoria_id', 'categoria__nombre'
+    )
+    for fila in filas:
+        entradas.append((('producto', fila['id']), fila['nombre']))
+        if fila['marca_id']:
+            entradas.append((('marca', fila['marca_id']), fila['marca__nombre']))
+        if fila['categoria_id']:
+            entradas.append((('categoria', fila['categoria_id']), fila['categoria__nombre']))
+    indice_sugerencias.actualizar(entradas)
+
+
+def quitar_productos(producto_ids):
+    indice_sugerencias.actualizar([(('producto', pk), None) for pk in producto_ids])
+
+
+def refrescar_categoria(categoria_id, nombre=None):
+    """Actualizar (o quitar, con nombre None) una categoría"""
+    indice_sugerencias.actualizar([(('categoria', categoria_id), nombre)])
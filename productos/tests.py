@@ -1,3 +1,351 @@
-from django.test import TestCase
+import json
+import threading
+from datetime import timedelta
 
-# Create your tests here.
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import Sum
+from django.test import Client, TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.utils import timezone
+
+from .actualizacion_masiva import actualizar_items, actualizar_por_filtro
+from .cache_catalogo import invalidar_catalogo
+from .catalogo import anotar_stock
+from .categorias import ErrorCategoria, buscar_categoria, filtrar_por_categoria, mover_categoria, subarbol
+from .importacion import ImportadorProductos
+from .inventario import (
+    StockInsuficiente, descontar_stock, fijar_stock, liberar_reservas_vencidas, liberar_stock, movimientos_de_venta,
+    reconciliar_reservas, reponer_stock, reservar_stock, stock_disponible,
+)
+from .models import Categoria, MovimientoStock, Producto, ReservaStock, Stock, StockUbicacion, Ubicacion
+
+
+# ==========================================================
+# CATEGORÍAS (ruta materializada)
+# ==========================================================
+
+class RutaCategoriaTests(TestCase):
+
+    def test_importacion_crea_categorias_con_ruta(self):
+        ImportadorProductos().importar([
+            (2, {'nombre': 'Lavadora', 'precio': '100', 'stock': '3', 'categoria': 'Línea blanca'}),
+            (3, {'nombre': 'Secadora', 'precio': '90', 'stock': '1', 'categoria': 'Línea blanca'}),
+        ])
+        categoria = Categoria.objects.get(nombre='Línea blanca')
+        self.assertEqual(categoria.ruta, f'{categoria.pk:06d}/')
+        self.assertEqual(categoria.nivel, 0)
+        self.assertEqual(filtrar_por_categoria(Producto.objects.all(), 'Línea blanca').count(), 2)
+
+    def test_mover_reescribe_el_subarbol(self):
+        hogar = Categoria.objects.create(nombre='Hogar')
+        cocina = Categoria.objects.create(nombre='Cocina', padre=hogar)
+        hornos = Categoria.objects.create(nombre='Hornos', padre=cocina)
+        electro = Categoria.objects.create(nombre='Electro')
+
+        mover_categoria(cocina, electro)
+
+        hornos.refresh_from_db()
+        self.assertEqual(hornos.ruta, f'{electro.pk:06d}/{cocina.pk:06d}/{hornos.pk:06d}/')
+        self.assertEqual(hornos.nivel, 2)
+        self.assertEqual(set(subarbol(electro)), {electro, cocina, hornos})
+        self.assertEqual(list(subarbol(hogar)), [hogar])
+
+    def test_no_se_mueve_dentro_de_si_misma(self):
+        hogar = Categoria.objects.create(nombre='Hogar')
+        cocina = Categoria.objects.create(nombre='Cocina', padre=hogar)
+        with self.assertRaises(ErrorCategoria):
+            mover_categoria(hogar, cocina)
+
+    def test_ruta_vacia_no_filtra_todo(self):
+        Categoria.objects.create(nombre='Hogar')
+        sin_ruta = Categoria.objects.create(nombre='Rota')
+        Categoria.objects.filter(pk=sin_ruta.pk).update(ruta='')
+        sin_ruta.refresh_from_db()
+        with self.assertRaises(ErrorCategoria):
+            subarbol(sin_ruta)
+        with self.assertRaises(ErrorCategoria):
+            filtrar_por_categoria(Producto.objects.all(), 'Rota')
+
+    def test_bulk_create_completa_la_ruta(self):
+        hogar = Categoria.objects.create(nombre='Hogar')
+        Categoria.objects.bulk_create([Categoria(nombre='Jardín'), Categoria(nombre='Cocina', padre=hogar)])
+        jardin = Categoria.objects.get(nombre='Jardín')
+        cocina = Categoria.objects.get(nombre='Cocina')
+        self.assertEqual((jardin.ruta, jardin.nivel), (f'{jardin.pk:06d}/', 0))
+        self.assertEqual((cocina.ruta, cocina.nivel), (f'{hogar.pk:06d}/{cocina.pk:06d}/', 1))
+
+    def test_categoria_es_siempre_un_nombre(self):
+        numerica = Categoria.objects.create(nombre='2024')
+        otra = Categoria.objects.create(nombre='Otra')
+        Producto.objects.create(nombre='Agenda', precio=10, categoria=numerica)
+        Producto.objects.create(nombre='Mesa', precio=10, categoria=otra)
+        http = Client()
+
+        # ?categoria=<dígitos> busca por nombre aunque exista una categoría con ese id
+        respuesta = http.get('/api/productos/', {'categoria': '2024'})
+        self.assertEqual([p['nombre'] for p in respuesta.json()['items']], ['Agenda'])
+        respuesta = http.get('/api/productos/', {'categoria': str(otra.pk)})
+        self.assertEqual(respuesta.json()['items'], [])
+        respuesta = http.get('/api/productos/', {'categoria_id': str(otra.pk)})
+        self.assertEqual([p['nombre'] for p in respuesta.json()['items']], ['Mesa'])
+        self.assertEqual(http.get('/api/productos/', {'categoria_id': 'x'}).status_code, 400)
+
+    def test_padre_invalido(self):
+        categoria = Categoria.objects.create(nombre='Hogar')
+        http = Client()
+        respuesta = http.put(
+            '/api/productos/categorias/', json.dumps({'id': categoria.pk, 'padre': 'abc'}),
+            content_type='application/json',
+        )
+        self.assertEqual(respuesta.status_code, 400)
+        respuesta = http.post(
+            '/api/productos/categorias/', json.dumps({'nombre': 'Cocina', 'padre': [1]}),
+            content_type='application/json',
+        )
+        self.assertEqual(respuesta.status_code, 400)
+        self.assertEqual(buscar_categoria(categoria_id=categoria.pk), categoria)
+
+
+# ==========================================================
+# PAGINACIÓN POR CURSOR (con ?fields=)
+# ==========================================================
+
+class PaginacionCursorTests(TestCase):
+
+    def setUp(self):
+        # Precios repetidos: el desempate por id no debe saltar ni repetir filas
+        self.productos = [
+            Producto.objects.create(nombre=nombre, precio=precio)
+            for nombre, precio in [('Mesa', 100), ('Silla', 40), ('Banco', 40), ('Sofá', 800), ('Puff', 40)]
+        ]
+        self.http = Client()
+
+    def _recorrer(self, orden, campos):
+        vistos, paginas = [], []
+        parametros = {'paginacion': 'cursor', 'order': orden, 'page_size': 2, 'fields': campos}
+        while True:
+            respuesta = self.http.get('/api/productos/', parametros)
+            self.assertEqual(respuesta.status_code, 200)
+            datos = respuesta.json()
+            paginas.append(datos['items'])
+            vistos.extend(datos['items'])
+            if not datos['has_more']:
+                return vistos, paginas
+            parametros = {'cursor': datos['next_cursor'], 'order': orden, 'page_size': 2, 'fields': campos}
+
+    def test_recorre_todo_sin_repetir_y_solo_con_los_campos_pedidos(self):
+        vistos, paginas = self._recorrer('precio', 'id,nombre')
+
+        esperados = sorted(self.productos, key=lambda producto: (producto.precio, producto.pk))
+        self.assertEqual([item['id'] for item in vistos], [producto.pk for producto in esperados])
+        self.assertEqual(len(paginas), 3)
+        # La clave de orden (precio) se usa para el cursor pero no se devuelve
+        for item in vistos:
+            self.assertEqual(set(item), {'id', 'nombre'})
+
+    def test_orden_descendente(self):
+        vistos, _ = self._recorrer('-precio', 'nombre')
+        self.assertEqual([item['nombre'] for item in vistos][:2], ['Sofá', 'Mesa'])
+        self.assertEqual(len(vistos), len(self.productos))
+        # `id` siempre acompaña a los campos pedidos
+        self.assertTrue(all(set(item) == {'id', 'nombre'} for item in vistos))
+
+    def test_cursor_invalido(self):
+        respuesta = self.http.get('/api/productos/', {'cursor': 'basura', 'fields': 'id'})
+        self.assertEqual(respuesta.status_code, 400)
+
+    def test_cursor_de_otro_orden(self):
+        respuesta = self.http.get('/api/productos/', {'paginacion': 'cursor', 'order': 'precio', 'page_size': 2})
+        cursor = respuesta.json()['next_cursor']
+        respuesta = self.http.get('/api/productos/', {'cursor': cursor, 'order': 'nombre'})
+        self.assertEqual(respuesta.status_code, 400)
+
+
+# ==========================================================
+# RESERVAS DE STOCK
+# ==========================================================
+
+class CacheCatalogoTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.producto = Producto.objects.create(nombre='Lavarropas', precio=800)
+        with self.captureOnCommitCallbacks(execute=True):
+            fijar_stock({self.producto.pk: 5})
+        self.http = Client()
+
+    def _etag(self):
+        respuesta = self.http.get('/api/productos/')
+        self.assertEqual(respuesta.status_code, 200)
+        return respuesta['ETag']
+
+    def test_invalidacion_llega_a_todos_los_workers(self):
+        etag = self._etag()
+        self.assertEqual(self.http.get('/api/productos/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # La versión vive en la caché compartida, no en la local de cada worker
+        version = caches['compartida'].get('catalogo:version')
+        self.assertIsNotNone(version)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidar_catalogo()
+        self.assertNotEqual(caches['compartida'].get('catalogo:version'), version)
+        self.assertEqual(self.http.get('/api/productos/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertNotEqual(self._etag(), etag)
+
+    def test_reservas_invalidan_el_listado(self):
+        def stock_listado():
+            return self.http.get('/api/productos/').json()['items'][0]['stock']
+
+        self.assertEqual(stock_listado(), 5)
+        with self.captureOnCommitCallbacks(execute=True):
+            reservar_stock('carrito:1', {self.producto.pk: 2}, ttl=600)
+        self.assertEqual(stock_listado(), 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            liberar_stock('carrito:1')
+        self.assertEqual(stock_listado(), 5)
+
+
+class ReservaStockTests(TestCase):
+
+    def setUp(self):
+        self.producto = Producto.objects.create(nombre='Heladera', precio=500)
+        fijar_stock({self.producto.pk: 5})
+
+    def _vencer(self, referencia):
+        ReservaStock.objects.filter(referencia=referencia).update(vence=timezone.now() - timedelta(seconds=1))
+
+    def test_reserva_vigente_descuenta_lo_vendible(self):
+        reservar_stock('carrito:1', {self.producto.pk: 4}, ttl=600)
+        self.assertEqual(stock_disponible([self.producto.pk]), {self.producto.pk: 1})
+        self.assertEqual(stock_disponible([self.producto.pk], 'carrito:1'), {self.producto.pk: 5})
+        with self.assertRaises(StockInsuficiente):
+            descontar_stock([(self.producto.pk, 2)], referencia='venta:1')
+
+    def test_reserva_vencida_no_cuenta_sin_barrido(self):
+        reservar_stock('carrito:1', {self.producto.pk: 4}, ttl=600)
+        self._vencer('carrito:1')
+        self.assertEqual(stock_disponible([self.producto.pk]), {self.producto.pk: 5})
+        self.assertEqual(anotar_stock(Producto.objects.filter(pk=self.producto.pk)).get().stock_actual, 5)
+
+        # La venta libera la reserva vencida del producto bajo el bloqueo
+        descontar_stock([(self.producto.pk, 5)], referencia='venta:1')
+        self.assertFalse(ReservaStock.objects.exists())
+        stock = Stock.objects.get(producto=self.producto)
+        self.assertEqual((stock.cantidad, stock.reservado), (0, 0))
+
+    def test_liberar_reservas_vencidas(self):
+        reservar_stock('carrito:1', {self.producto.pk: 2}, ttl=600)
+        reservar_stock('carrito:2', {self.producto.pk: 1}, ttl=600)
+        self._vencer('carrito:1')
+        self.assertEqual(liberar_reservas_vencidas(), 1)
+        self.assertEqual(Stock.objects.get(producto=self.producto).reservado, 1)
+        self.assertEqual(reconciliar_reservas(), 0)
+
+
+# ==========================================================
+# LIBRO DE MOVIMIENTOS Y STOCK POR UBICACIÓN
+# ==========================================================
+
+def _saldos(producto):
+    """(Stock.cantidad, suma por ubicación, suma del libro, saldo del último movimiento)"""
+    movimientos = MovimientoStock.objects.filter(producto=producto)
+    return (
+        Stock.objects.get(producto=producto).cantidad,
+        StockUbicacion.objects.filter(producto=producto).aggregate(total=Sum('cantidad'))['total'] or 0,
+        movimientos.aggregate(total=Sum('cantidad'))['total'] or 0,
+        movimientos.order_by('-id_movimiento').values_list('saldo', flat=True).first() or 0,
+    )
+
+
+class LibroStockTests(TestCase):
+
+    def setUp(self):
+        self.deposito = Ubicacion.objects.create(nombre='Depósito', prioridad=0)
+        self.tienda = Ubicacion.objects.create(nombre='Tienda', prioridad=1)
+        self.producto = Producto.objects.create(nombre='Sofá', precio=800)
+        reponer_stock(self.producto.pk, 3, ubicacion=self.deposito)
+        reponer_stock(self.producto.pk, 4, ubicacion=self.tienda)
+
+    def test_venta_sin_stock_suficiente_no_modifica_nada(self):
+        with self.assertRaises(StockInsuficiente) as error:
+            descontar_stock([(self.producto.pk, 8)], referencia='venta:1')
+        self.assertEqual(error.exception.faltantes[0]['disponible'], 7)
+        self.assertEqual(_saldos(self.producto), (7, 7, 7, 7))
+        self.assertFalse(movimientos_de_venta(1).exists())
+
+    def test_venta_reparte_entre_ubicaciones_y_cuadra_el_libro(self):
+        descontar_stock([(self.producto.pk, 5)], referencia='venta:1')
+        self.assertEqual(_saldos(self.producto), (2, 2, 2, 2))
+        # Ninguna cubre 5: primero la de menor prioridad, luego la otra
+        salidas = dict(movimientos_de_venta(1).values_list('ubicacion_id', 'cantidad'))
+        self.assertEqual(salidas, {self.deposito.pk: -3, self.tienda.pk: -2})
+
+    def test_venta_ya_cobrada_descuenta_hasta_cero(self):
+        descontar_stock([(self.producto.pk, 9)], referencia='venta:1', permitir_faltante=True)
+        self.assertEqual(_saldos(self.producto), (0, 0, 0, 0))
+
+    def test_ajuste_por_filtro_cuadra_el_libro(self):
+        otro = Producto.objects.create(nombre='Sillón', precio=300)
+        filtro = {'ids': [self.producto.pk, otro.pk]}
+
+        resultado = actualizar_por_filtro(filtro, ajuste_stock='-5')
+        self.assertEqual((resultado['stocks_actualizados'], resultado['stocks_creados']), (1, 1))
+        self.assertEqual(_saldos(self.producto), (2, 2, 2, 2))
+        # Ninguna ubicación cubre 5: se vacía el depósito (menor prioridad) y el resto sale de la tienda
+        self.assertEqual(StockUbicacion.objects.get(producto=self.producto, ubicacion=self.tienda).cantidad, 2)
+
+        actualizar_por_filtro(filtro, ajuste_stock='=6')
+        self.assertEqual(_saldos(self.producto), (6, 6, 6, 6))
+        self.assertEqual(_saldos(otro), (6, 6, 6, 6))
+
+        actualizar_por_filtro(filtro, ajuste_stock='+2')
+        self.assertEqual(_saldos(otro), (8, 8, 8, 8))
+
+    def test_conteos_solo_incluyen_stock_modificado(self):
+        otro = Producto.objects.create(nombre='Sillón', precio=300)
+        reponer_stock(otro.pk, 2)
+
+        resultado = actualizar_por_filtro({'ids': [self.producto.pk, otro.pk]}, ajuste_stock='=7')
+        self.assertEqual((resultado['stocks_actualizados'], resultado['stocks_creados']), (1, 0))
+        resultado = actualizar_items([{'id': self.producto.pk, 'stock': 7}, {'id': otro.pk, 'stock': 3}])
+        self.assertEqual((resultado['stocks_actualizados'], resultado['stocks_creados']), (1, 0))
+
+    def test_ajuste_por_categoria_usa_una_ubicacion_que_cubra(self):
+        categoria = Categoria.objects.create(nombre='Living')
+        Producto.objects.filter(pk=self.producto.pk).update(categoria=categoria)
+
+        actualizar_por_filtro({'categoria': 'Living'}, ajuste_stock='-4')
+        # Solo la tienda cubre 4: sale todo de ahí aunque el depósito tenga menor prioridad
+        ubicaciones = dict(StockUbicacion.objects.filter(producto=self.producto).values_list('ubicacion_id', 'cantidad'))
+        self.assertEqual(ubicaciones, {self.deposito.pk: 3, self.tienda.pk: 0})
+        self.assertEqual(_saldos(self.producto), (3, 3, 3, 3))
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class VentaConcurrenteTests(TransactionTestCase):
+    """Dos ventas simultáneas del último ítem: solo una puede descontarlo"""
+
+    def test_no_se_vende_dos_veces(self):
+        producto = Producto.objects.create(nombre='Lámpara', precio=50)
+        reponer_stock(producto.pk, 1)
+        barrera = threading.Barrier(2)
+        resultados = []
+
+        def vender(numero):
+            try:
+                barrera.wait()
+                descontar_stock([(producto.pk, 1)], referencia=f'venta:{numero}')
+                resultados.append('ok')
+            except StockInsuficiente:
+                resultados.append('sin stock')
+            finally:
+                connection.close()
+
+        hilos = [threading.Thread(target=vender, args=(numero,)) for numero in (1, 2)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+
+        self.assertEqual(sorted(resultados), ['ok', 'sin stock'])
+        self.assertEqual(_saldos(producto), (0, 0, 0, 0))
@@ -5,8 +5,17 @@ app_name = 'productos'
 
 urlpatterns = [
     path('', views.ProductoListView.as_view(), name='list_products'),
+    path('sugerencias/', views.SugerenciasView.as_view(), name='sugerencias'),
     path('admin/', views.ProductoAdminView.as_view(), name='admin_products'),
+    path('admin/importar/', views.ProductoImportView.as_view(), name='import_products'),
+    path('admin/masivo/', views.ProductoBulkUpdateView.as_view(), name='bulk_update_products'),
     path('upload-image/', views.UploadImageView.as_view(), name='upload_image'),
+    path('upload-image/<str:upload_id>/', views.UploadImageStatusView.as_view(), name='upload_image_status'),
     path('categorias/', views.CategoriaListView.as_view(), name='list_categorias'),
+    path('categorias/arbol/', views.CategoriaArbolView.as_view(), name='arbol_categorias'),
+    path('categorias/<int:categoria_id>/migas/', views.CategoriaMigasView.as_view(), name='migas_categoria'),
+    path('ubicaciones/', views.UbicacionesView.as_view(), name='ubicaciones'),
+    path('miniaturas/<int:producto_id>/<int:ancho>/<str:clave>.webp', views.MiniaturaView.as_view(), name='miniatura'),
+    path('cache/', views.CacheCatalogoView.as_view(), name='cache_catalogo'),
 ]
 
@@ -1,16 +1,39 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, FileResponse, Http404, HttpResponseRedirect
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from django.db.models import Q
 from django.views.decorators.http import require_http_methods
-from django.conf import settings
+from django.utils.cache import get_conditional_response
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
 import json
-import requests
-import base64
 import logging
-
-from .models import Producto, Categoria, Marca, Proveedor, Stock
+import os
+
+from .models import Producto, Categoria, Marca, Proveedor, Stock, StockUbicacion, Ubicacion
+from .catalogo import CAMPOS_PRODUCTO, serializar_productos
+from .campos import CamposInvalidos, campos_solicitados, recortar
+from .busqueda import buscar_productos, indexar_productos, eliminar_productos
+from .cache_catalogo import (
+    respuesta_cacheada, respuesta_condicional, etag_datos, invalidar_catalogo,
+    estadisticas_cache, reiniciar_estadisticas,
+)
+from .importacion import ImportadorProductos, ErrorImportacion, leer_filas, detectar_formato, TAMANO_LOTE
+from .actualizacion_masiva import ErrorActualizacion, actualizar_items, actualizar_por_filtro
+from .subida_imagenes import (
+    TIPOS_PERMITIDOS, TAMANO_MAXIMO, ErrorSubida, guardar_temporal, procesar_subida,
+    encolar_subida, estado_subida,
+)
+from .miniaturas import ANCHOS_PERMITIDOS, clave_imagen, ruta_miniatura, url_miniatura, marcar_uso, encolar_miniaturas
+from .facetas import calcular_facetas, facetas_solicitadas
+from .sugerencias import LIMITE_SUGERENCIAS, indice_sugerencias, refrescar_productos, quitar_productos, refrescar_categoria
+from .inventario import reponer_stock, fijar_stock, StockInsuficiente
+from .categorias import ErrorCategoria, filtrar_por_categoria, mover_categoria, eliminar_categoria, migas, arbol
+from .paginacion import (
+    ORDENES_CURSOR, CursorInvalido, decodificar_cursor, filtrar_despues_de,
+    ordenar_para_cursor, cursor_siguiente, estimar_total,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -19,21 +42,37 @@ logger = logging.getLogger(__name__)
 class ProductoListView(View):
     """CU6: Listado público de productos"""
     def get(self, request):
+        etag = etag_datos('productos', request, 'catalogo')
+        return respuesta_condicional(request, etag, lambda: respuesta_cacheada(
+            'productos', request, lambda: self._listar(request)
+        ))
+
+    def _listar(self, request):
         try:
-            productos = Producto.objects.all().select_related('categoria', 'marca', 'proveedor')
+            # Claves a devolver (?fields=id,nombre,precio); sin el parámetro, todas
+            try:
+                campos = campos_solicitados(request, CAMPOS_PRODUCTO)
+            except CamposInvalidos as e:
+                return JsonResponse({'success': False, 'message': str(e)}, status=400)
+
+            productos = Producto.objects.all()
 
             # Filtros CU7
             query = request.GET.get('q')
             categoria_nombre = request.GET.get('categoria')
+            categoria_id = request.GET.get('categoria_id')
             min_precio = request.GET.get('min')
             max_precio = request.GET.get('max')
-            order_by = request.GET.get('order', 'nombre') # Default order
+            order_by = request.GET.get('order')
 
             if query:
-                productos = productos.filter(Q(nombre__icontains=query) | Q(descripcion__icontains=query))
+                productos = buscar_productos(productos, query)
             
-            if categoria_nombre and categoria_nombre != 'Todos':
-                productos = productos.filter(categoria__nombre__iexact=categoria_nombre)
+            # Incluye las subcategorías (prefijo de la ruta materializada)
+            if categoria_id:
+                productos = filtrar_por_categoria(productos, categoria_id=categoria_id)
+            elif categoria_nombre and categoria_nombre != 'Todos':
+                productos = filtrar_por_categoria(productos, categoria_nombre)
             
             if min_precio:
                 try:
@@ -47,11 +86,26 @@ class ProductoListView(View):
                 except ValueError:
                     pass
             
-            # Ordenamiento
+            # Facetas (?facets=categoria,marca,precio) sobre el mismo conjunto filtrado
+            facetas = calcular_facetas(productos, facetas_solicitadas(request.GET.get('facets')))
+
+            # Paginación por cursor (opcional): páginas de costo constante y sin COUNT
+            cursor = request.GET.get('cursor')
+            if cursor is not None or request.GET.get('paginacion') == 'cursor':
+                return self._listar_por_cursor(request, productos, order_by or 'nombre', cursor, facetas, campos)
+
+            # Ordenamiento (con búsqueda, por defecto se ordena por relevancia)
             if order_by in ['nombre', 'precio', '-precio']:
                 productos = productos.order_by(order_by)
+            elif order_by == 'popularidad':
+                # Contadores de ventas (PopularidadProducto); sin ventas van al final
+                productos = productos.order_by(
+                    F('popularidad__unidades_vendidas').desc(nulls_last=True), 'nombre', 'id'
+                )
+            elif query and order_by in (None, 'relevancia'):
+                productos = productos.order_by('-relevancia', 'nombre')
             else:
-                productos = productos.order_by('nombre') # Default fallback
+                productos = productos.order_by('nombre')
 
             # Paginación (simple, se puede mejorar con Django Paginator)
             try:
@@ -67,65 +121,21 @@ class ProductoListView(View):
             total_items = productos.count()
             productos = productos[start:end]
 
-            data = []
-            for p in productos:
-                try:
-                    # Obtener stock actual de forma segura
-                    stock_cantidad = 0
-                    try:
-                        stock_obj = Stock.objects.filter(producto=p).first()
-                        if stock_obj:
-                            stock_cantidad = stock_obj.cantidad
-                    except Exception:
-                        pass
-                    
-                    # Acceso seguro a relaciones
-                    categoria_nombre = None
-                    try:
-                        if p.categoria:
-                            categoria_nombre = p.categoria.nombre
-                    except Exception:
-                        pass
-                    
-                    marca_nombre = None
-                    try:
-                        if p.marca:
-                            marca_nombre = p.marca.nombre
-                    except Exception:
-                        pass
-                    
-                    proveedor_nombre = None
-                    try:
-                        if p.proveedor:
-                            proveedor_nombre = p.proveedor.nombre
-                    except Exception:
-                        pass
-                    
-                    data.append({
-                        'id': p.id,
-                        'nombre': p.nombre or '',
-                        'descripcion': p.descripcion or '',
-                        'precio': float(p.precio) if p.precio else 0.0,
-                        'stock': stock_cantidad,
-                        'imagen': p.imagen or '',
-                        'categoria': categoria_nombre,
-                        'marca': marca_nombre,
-                        'proveedor': proveedor_nombre,
-                        'estado': True,
-                    })
-                except Exception as e:
-                    # Si hay error con un producto, continuar con los demás
-                    logger.error(f"Error procesando producto {p.id}: {str(e)}", exc_info=True)
-                    continue
+            data = serializar_productos(productos, campos)
             
-            return JsonResponse({
+            respuesta = {
                 'success': True,
                 'items': data,
                 'total': total_items,
                 'page': page,
                 'page_size': page_size,
-            }, status=200)
+            }
+            if facetas:
+                respuesta['facets'] = facetas
+            return JsonResponse(respuesta, status=200)
 
+        except ErrorCategoria as e:
+            return JsonResponse({'success': False, 'message': str(e)}, status=400)
         except Exception as e:
             logger.error(f"Error en ProductoListView: {str(e)}", exc_info=True)
             return JsonResponse({
@@ -133,6 +143,54 @@ class ProductoListView(View):
                 'message': f'Error al obtener productos: {str(e)}'
             }, status=500)
 
+    def _listar_por_cursor(self, request, productos, orden, cursor, facetas=None, campos=None):
+        """Listado para scroll infinito: ?paginacion=cursor y luego ?cursor=<next_cursor>"""
+        if orden not in ORDENES_CURSOR:
+            return JsonResponse({
+                'success': False,
+                'message': f"Orden no soportado con cursor. Use: {', '.join(ORDENES_CURSOR)}"
+            }, status=400)
+
+        try:
+            page_size = int(request.GET.get('page_size', 10))
+        except ValueError:
+            page_size = 10
+        page_size = max(1, min(page_size, 100))
+
+        if request.GET.get('total') == 'estimado':
+            total_estimado = estimar_total(productos)
+        else:
+            total_estimado = None
+
+        if cursor:
+            try:
+                valor, producto_id = decodificar_cursor(cursor, orden)
+            except CursorInvalido as e:
+                return JsonResponse({'success': False, 'message': str(e)}, status=400)
+            productos = filtrar_despues_de(productos, orden, valor, producto_id)
+
+        # Se pide un elemento extra para saber si hay página siguiente. El
+        # cursor necesita la clave de orden aunque no se haya pedido en `fields`
+        serializados = campos | {ORDENES_CURSOR[orden][0]} if campos is not None else None
+        data = serializar_productos(ordenar_para_cursor(productos, orden)[:page_size + 1], serializados)
+        has_more = len(data) > page_size
+        data = data[:page_size]
+        next_cursor = cursor_siguiente(data[-1], orden) if has_more else None
+        if campos is not None:
+            data = [recortar(item, campos) for item in data]
+
+        respuesta = {
+            'success': True,
+            'items': data,
+            'page_size': page_size,
+            'next_cursor': next_cursor,
+            'has_more': has_more,
+            'total_estimado': total_estimado,
+        }
+        if facetas:
+            respuesta['facets'] = facetas
+        return JsonResponse(respuesta, status=200)
+
 
 @method_decorator(csrf_exempt, name='dispatch')
 class ProductoAdminView(View):
@@ -141,22 +199,28 @@ class ProductoAdminView(View):
     def get(self, request):
         """Listar todos los productos para administración"""
         try:
-            productos = Producto.objects.all().select_related('categoria', 'marca', 'proveedor')
+            productos = Producto.objects.all()
             
             # Filtros administrativos
             query = request.GET.get('q')
             categoria_nombre = request.GET.get('categoria')
-            order_by = request.GET.get('order', 'nombre')
+            categoria_id = request.GET.get('categoria_id')
+            order_by = request.GET.get('order')
 
             if query:
-                productos = productos.filter(Q(nombre__icontains=query) | Q(descripcion__icontains=query))
+                productos = buscar_productos(productos, query)
             
-            if categoria_nombre and categoria_nombre != 'Todos':
-                productos = productos.filter(categoria__nombre__iexact=categoria_nombre)
+            # Incluye las subcategorías (prefijo de la ruta materializada)
+            if categoria_id:
+                productos = filtrar_por_categoria(productos, categoria_id=categoria_id)
+            elif categoria_nombre and categoria_nombre != 'Todos':
+                productos = filtrar_por_categoria(productos, categoria_nombre)
             
-            # Ordenamiento
+            # Ordenamiento (con búsqueda, por defecto se ordena por relevancia)
             if order_by in ['nombre', 'precio', '-precio']:
                 productos = productos.order_by(order_by)
+            elif query and order_by in (None, 'relevancia'):
+                productos = productos.order_by('-relevancia', 'nombre')
             else:
                 productos = productos.order_by('nombre')
 
@@ -174,56 +238,7 @@ class ProductoAdminView(View):
             total_items = productos.count()
             productos = productos[start:end]
 
-            data = []
-            for p in productos:
-                try:
-                    # Obtener stock actual de forma segura
-                    stock_cantidad = 0
-                    try:
-                        stock_obj = Stock.objects.filter(producto=p).first()
-                        if stock_obj:
-                            stock_cantidad = stock_obj.cantidad
-                    except Exception:
-                        pass
-                    
-                    # Acceso seguro a relaciones
-                    categoria_nombre = None
-                    try:
-                        if p.categoria:
-                            categoria_nombre = p.categoria.nombre
-                    except Exception:
-                        pass
-                    
-                    marca_nombre = None
-                    try:
-                        if p.marca:
-                            marca_nombre = p.marca.nombre
-                    except Exception:
-                        pass
-                    
-                    proveedor_nombre = None
-                    try:
-                        if p.proveedor:
-                            proveedor_nombre = p.proveedor.nombre
-                    except Exception:
-                        pass
-                    
-                    data.append({
-                        'id': p.id,
-                        'nombre': p.nombre or '',
-                        'descripcion': p.descripcion or '',
-                        'precio': float(p.precio) if p.precio else 0.0,
-                        'stock': stock_cantidad,
-                        'imagen': p.imagen or '',
-                        'categoria': categoria_nombre,
-                        'marca': marca_nombre,
-                        'proveedor': proveedor_nombre,
-                        'estado': True,
-                    })
-                except Exception as e:
-                    # Si hay error con un producto, continuar con los demás
-                    logger.error(f"Error procesando producto {p.id}: {str(e)}", exc_info=True)
-                    continue
+            data = serializar_productos(productos)
             
             return JsonResponse({
                 'success': True,
@@ -233,6 +248,8 @@ class ProductoAdminView(View):
                 'page_size': page_size,
             }, status=200)
 
+        except ErrorCategoria as e:
+            return JsonResponse({'success': False, 'message': str(e)}, status=400)
         except Exception as e:
             logger.error(f"Error en ProductoAdminView: {str(e)}", exc_info=True)
             return JsonResponse({
@@ -251,6 +268,9 @@ class ProductoAdminView(View):
             
             if not data.get('precio'):
                 return JsonResponse({'success': False, 'message': 'El precio es obligatorio'}, status=400)
+            ubicacion = data.get('ubicacion')
+            if ubicacion and not Ubicacion.objects.filter(pk=ubicacion).exists():
+                return JsonResponse({'success': False, 'message': 'Ubicación no encontrada'}, status=404)
 
             # Obtener o crear categoría
             categoria = None
@@ -277,14 +297,15 @@ class ProductoAdminView(View):
                 marca=marca,
                 proveedor=proveedor
             )
+            indexar_productos([producto.id])
+            refrescar_productos([producto.id])
+            invalidar_catalogo()
+            encolar_miniaturas(producto.imagen)
 
             # Crear stock inicial
             stock_cantidad = data.get('stock', 0)
             if stock_cantidad > 0:
-                Stock.objects.create(
-                    producto=producto,
-                    cantidad=stock_cantidad
-                )
+                reponer_stock(producto.id, stock_cantidad, referencia='alta_producto', ubicacion=ubicacion)
 
             return JsonResponse({
                 'success': True,
@@ -311,6 +332,12 @@ class ProductoAdminView(View):
             except Producto.DoesNotExist:
                 return JsonResponse({'success': False, 'message': 'Producto no encontrado'}, status=404)
 
+            if 'stock' in data and int(data['stock']) < 0:
+                return JsonResponse({'success': False, 'message': 'El stock no puede ser negativo'}, status=400)
+            ubicacion = data.get('ubicacion')
+            if ubicacion and not Ubicacion.objects.filter(pk=ubicacion).exists():
+                return JsonResponse({'success': False, 'message': 'Ubicación no encontrada'}, status=404)
+
             # Actualizar campos
             if 'nombre' in data:
                 producto.nombre = data['nombre']
@@ -320,6 +347,7 @@ class ProductoAdminView(View):
                 producto.precio = data['precio']
             if 'imagen' in data:
                 producto.imagen = data['imagen']
+                encolar_miniaturas(producto.imagen)
 
             # Actualizar relaciones
             if 'categoria' in data:
@@ -344,12 +372,22 @@ class ProductoAdminView(View):
                     producto.proveedor = None
 
             producto.save()
+            if 'nombre' in data or 'descripcion' in data:
+                indexar_productos([producto.id])
+            refrescar_productos([producto.id])
 
-            # Actualizar stock
+            # Actualizar stock (total del producto; la diferencia se aplica en
+            # `ubicacion` si se indica, si no en la principal o por asignación)
             if 'stock' in data:
-                stock_obj, created = Stock.objects.get_or_create(producto=producto)
-                stock_obj.cantidad = data['stock']
-                stock_obj.save()
+                try:
+                    fijar_stock({producto.id: int(data['stock'])}, referencia='edicion_producto', ubicacion=ubicacion)
+                except StockInsuficiente:
+                    return JsonResponse({
+                        'success': False,
+                        'message': 'La ubicación no tiene stock suficiente para ese ajuste'
+                    }, status=400)
+
+            invalidar_catalogo()
 
             return JsonResponse({
                 'success': True,
@@ -378,7 +416,11 @@ class ProductoAdminView(View):
             Stock.objects.filter(producto=producto).delete()
             
             # Eliminar producto
+            producto_pk = producto.pk
             producto.delete()
+            eliminar_productos([producto_pk])
+            quitar_productos([producto_pk])
+            invalidar_catalogo()
 
             return JsonResponse({
                 'success': True,
@@ -389,12 +431,133 @@ class ProductoAdminView(View):
             return JsonResponse({'success': False, 'message': str(e)}, status=500)
 
 
+class SugerenciasView(View):
+    """CU7: Sugerencias para el buscador (autocompletado sin consultar la BD)"""
+
+    def get(self, request):
+        texto = request.GET.get('q', '')
+        try:
+            limite = max(1, min(int(request.GET.get('limit', LIMITE_SUGERENCIAS)), 20))
+        except ValueError:
+            limite = LIMITE_SUGERENCIAS
+
+        try:
+            return JsonResponse({
+                'success': True,
+                'q': texto,
+                'sugerencias': indice_sugerencias.buscar(texto, limite),
+            }, status=200)
+        except Exception as e:
+            logger.error(f"Error en SugerenciasView: {str(e)}", exc_info=True)
+            return JsonResponse({
+                'success': False,
+                'message': f'Error al obtener sugerencias: {str(e)}'
+            }, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ProductoImportView(View):
+    """
+    CU6: Importación masiva de productos
+    Acepta un archivo CSV/NDJSON en `archivo` (multipart) o directamente en el body
+    (Content-Type text/csv o application/x-ndjson). Parámetros GET opcionales:
+    formato (csv|ndjson), lote (filas por transacción) y atomico=1 (todo o nada).
+    """
+
+    def post(self, request):
+        try:
+            try:
+                tamano_lote = int(request.GET.get('lote', TAMANO_LOTE))
+            except ValueError:
+                return JsonResponse({'success': False, 'message': 'lote debe ser un entero'}, status=400)
+
+            archivo = request.FILES.get('archivo')
+            if archivo is not None:
+                lineas = archivo
+                formato = request.GET.get('formato') or detectar_formato(archivo.name, archivo.content_type)
+            elif request.content_type and not request.content_type.startswith('multipart/'):
+                # El body se lee línea a línea sin cargarlo completo en memoria
+                lineas = request
+                formato = request.GET.get('formato') or detectar_formato(content_type=request.content_type)
+            else:
+                return JsonResponse({'success': False, 'message': 'No se envió archivo'}, status=400)
+
+            importador = ImportadorProductos(
+                tamano_lote=tamano_lote,
+                atomico=request.GET.get('atomico') in ('1', 'true'),
+            )
+            reporte = importador.importar(leer_filas(lineas, formato))
+
+            return JsonResponse({'success': True, 'reporte': reporte}, status=200)
+
+        except ErrorImportacion as e:
+            return JsonResponse({'success': False, 'message': str(e)}, status=400)
+        except UnicodeDecodeError:
+            return JsonResponse({'success': False, 'message': 'El archivo debe estar codificado en UTF-8'}, status=400)
+        except Exception as e:
+            logger.error(f"Error en ProductoImportView: {str(e)}", exc_info=True)
+            return JsonResponse({'success': False, 'message': f'Error al importar productos: {str(e)}'}, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ProductoBulkUpdateView(View):
+    """
+    CU6: Actualización masiva de precios y stock
+    - {"items": [{"id": 1, "precio": 99.9, "stock": 10}, ...]}
+    - {"filtro": {"categoria": "Hogar"}, "precio": "+5%", "stock": "+10"}
+    """
+
+    def post(self, request):
+        try:
+            data = json.loads(request.body)
+            if not isinstance(data, dict):
+                return JsonResponse({'success': False, 'message': 'JSON inválido'}, status=400)
+
+            if 'items' in data:
+                resultado = actualizar_items(data['items'])
+            else:
+                resultado = actualizar_por_filtro(data.get('filtro'), data.get('precio'), data.get('stock'))
+
+            return JsonResponse({
+                'success': True,
+                'message': 'Actualización masiva aplicada',
+                **resultado
+            }, status=200)
+
+        except json.JSONDecodeError:
+            return JsonResponse({'success': False, 'message': 'JSON inválido'}, status=400)
+        except ErrorActualizacion as e:
+            respuesta = {'success': False, 'message': str(e)}
+            if e.errores:
+                respuesta['errores'] = e.errores
+            return JsonResponse(respuesta, status=400)
+        except Exception as e:
+            logger.error(f"Error en ProductoBulkUpdateView: {str(e)}", exc_info=True)
+            return JsonResponse({'success': False, 'message': f'Error en la actualización masiva: {str(e)}'}, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class CacheCatalogoView(View):
+    """Estadísticas de aciertos/fallos de la caché del catálogo"""
+
+    def get(self, request):
+        return JsonResponse({'success': True, 'cache': estadisticas_cache()}, status=200)
+
+    def delete(self, request):
+        """Reiniciar los contadores de aciertos y fallos"""
+        reiniciar_estadisticas()
+        return JsonResponse({'success': True, 'message': 'Estadísticas reiniciadas'}, status=200)
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class UploadImageView(View):
-    """Nueva funcionalidad: Subir imágenes a ImgBB"""
+    """
+    Nueva funcionalidad: Subir imágenes (ImgBB o almacén local)
+    Con ?async=1 responde 202 con un upload_id y la subida sigue en segundo plano.
+    """
     
     def post(self, request):
-        """Subir imagen a ImgBB y devolver URL"""
+        """Subir imagen y devolver URL (o id de subida en modo asíncrono)"""
         try:
             # Obtener archivo del frontend
             file = request.FILES.get('image')
@@ -405,63 +568,195 @@ class UploadImageView(View):
                 }, status=400)
             
             # Validar tipo de archivo
-            allowed_types = ['image/jpeg', 'image/png', 'image/gif', 'image/webp']
-            if file.content_type not in allowed_types:
+            if file.content_type not in TIPOS_PERMITIDOS:
                 return JsonResponse({
                     'success': False, 
                     'message': 'Tipo de archivo no válido. Solo se permiten: JPEG, PNG, GIF, WebP'
                 }, status=400)
             
             # Validar tamaño (32MB máximo para ImgBB gratuito)
-            if file.size > 32 * 1024 * 1024:
+            if file.size > TAMANO_MAXIMO:
                 return JsonResponse({
                     'success': False, 
                     'message': 'Archivo demasiado grande. Máximo 32MB'
                 }, status=400)
             
-            # Convertir a base64
-            file_data = file.read()
-            base64_data = base64.b64encode(file_data).decode('utf-8')
-            
-            # Subir a ImgBB
-            url = 'https://api.imgbb.com/1/upload'
-            data = {
-                'key': settings.API_KEY_IMGBB,
-                'image': base64_data
-            }
-            
-            response = requests.post(url, data=data, timeout=30)
-            result = response.json()
+            # Copiar a disco por bloques (el archivo del request se descarta al responder)
+            ruta, sha256 = guardar_temporal(file)
             
-            if result.get('success'):
-                image_url = result['data']['url']
+            if request.GET.get('async') in ('1', 'true'):
+                upload_id = encolar_subida(ruta, file.name, file.content_type, sha256)
                 return JsonResponse({
                     'success': True,
-                    'image_url': image_url,
-                    'message': 'Imagen subida exitosamente'
-                })
-            else:
-                return JsonResponse({
-                    'success': False,
-                    'message': 'Error al subir imagen a ImgBB'
-                }, status=400)
+                    'upload_id': upload_id,
+                    'estado': 'pendiente',
+                    'status_url': f'/api/productos/upload-image/{upload_id}/',
+                    'message': 'Imagen recibida, subida en proceso'
+                }, status=202)
+            
+            image_url = procesar_subida(ruta, file.name, file.content_type, sha256)
+            encolar_miniaturas(image_url)
+            return JsonResponse({
+                'success': True,
+                'image_url': image_url,
+                'message': 'Imagen subida exitosamente'
+            })
                 
-        except requests.exceptions.Timeout:
+        except ErrorSubida as e:
             return JsonResponse({
                 'success': False,
-                'message': 'Timeout al subir imagen'
-            }, status=500)
-        except requests.exceptions.RequestException as e:
+                'message': str(e)
+            }, status=e.status)
+        except Exception as e:
             return JsonResponse({
                 'success': False,
-                'message': f'Error de conexión: {str(e)}'
+                'message': f'Error interno: {str(e)}'
             }, status=500)
+
+
+class UploadImageStatusView(View):
+    """Estado de una subida asíncrona de imagen"""
+
+    def get(self, request, upload_id):
+        estado = estado_subida(upload_id)
+        if estado is None:
+            return JsonResponse({
+                'success': False,
+                'message': 'Subida no encontrada o expirada'
+            }, status=404)
+
+        return JsonResponse({
+            'success': estado['estado'] != 'error',
+            'upload_id': upload_id,
+            **estado
+        }, status=200)
+
+
+class MiniaturaView(View):
+    """
+    Miniatura WebP de la imagen de un producto. La URL incluye el hash de la
+    imagen original, así que la respuesta se puede cachear como inmutable.
+    Si aún no existe se encola su generación y se redirige a la original.
+    """
+
+    def get(self, request, producto_id, ancho, clave):
+        if ancho not in ANCHOS_PERMITIDOS:
+            raise Http404('Ancho no permitido')
+
+        imagen = Producto.objects.filter(pk=producto_id).values_list('imagen', flat=True).first()
+        if not imagen:
+            raise Http404('Producto sin imagen')
+
+        if clave != clave_imagen(imagen):
+            # La imagen cambió desde que se generó el enlace
+            return HttpResponseRedirect(url_miniatura(producto_id, imagen, ancho))
+
+        ruta = ruta_miniatura(clave, ancho)
+        etag = f'"{clave}_{ancho}"'
+        if os.path.exists(ruta):
+            marcar_uso(ruta)
+            no_modificado = get_conditional_response(request, etag=etag)
+            if no_modificado is not None:
+                no_modificado['ETag'] = etag
+                return no_modificado
+            response = FileResponse(open(ruta, 'rb'), content_type='image/webp')
+            response['Cache-Control'] = 'public, max-age=31536000, immutable'
+            response['ETag'] = etag
+            return response
+
+        encolar_miniaturas(imagen)
+        response = HttpResponseRedirect(imagen)
+        response['Cache-Control'] = 'no-store'
+        return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class UbicacionesView(View):
+    """CU6: Ubicaciones de stock (depósitos/sucursales)"""
+
+    def get(self, request):
+        """Listar ubicaciones con sus unidades; con ?producto_id= el desglose de ese producto"""
+        try:
+            producto_id = request.GET.get('producto_id')
+            if producto_id:
+                filas = StockUbicacion.objects.filter(producto_id=producto_id).order_by(
+                    'ubicacion__prioridad', 'ubicacion__nombre'
+                ).values('ubicacion_id', 'ubicacion__nombre', 'cantidad')
+                total, reservado = Stock.objects.filter(producto_id=producto_id).values_list(
+                    'cantidad', 'reservado'
+                ).first() or (0, 0)
+                return JsonResponse({
+                    'success': True,
+                    'producto_id': int(producto_id),
+                    'total': total,
+                    'reservado': reservado,
+                    'ubicaciones': [
+                        {'id': f['ubicacion_id'], 'nombre': f['ubicacion__nombre'], 'cantidad': f['cantidad']}
+                        for f in filas
+                    ],
+                }, status=200)
+
+            ubicaciones = Ubicacion.objects.annotate(
+                unidades=Coalesce(Sum('stockubicacion__cantidad'), 0),
+                productos=Count('stockubicacion', filter=Q(stockubicacion__cantidad__gt=0)),
+            )
+            return JsonResponse({
+                'success': True,
+                'ubicaciones': [
+                    {
+                        'id': u.id_ubicacion,
+                        'nombre': u.nombre,
+                        'direccion': u.direccion or '',
+                        'prioridad': u.prioridad,
+                        'unidades': u.unidades,
+                        'productos': u.productos,
+                    }
+                    for u in ubicaciones
+                ],
+            }, status=200)
+        except ValueError:
+            return JsonResponse({'success': False, 'message': 'producto_id inválido'}, status=400)
         except Exception as e:
+            logger.error(f"Error en UbicacionesView.get: {str(e)}", exc_info=True)
             return JsonResponse({
                 'success': False,
-                'message': f'Error interno: {str(e)}'
+                'message': f'Error al obtener ubicaciones: {str(e)}'
             }, status=500)
 
+    def post(self, request):
+        """Crear ubicación"""
+        try:
+            data = json.loads(request.body)
+            if not data.get('nombre'):
+                return JsonResponse({'success': False, 'message': 'El nombre es obligatorio'}, status=400)
+            if Ubicacion.objects.filter(nombre__iexact=data['nombre']).exists():
+                return JsonResponse({'success': False, 'message': 'Ya existe una ubicación con ese nombre'}, status=400)
+
+            ubicacion = Ubicacion.objects.create(
+                nombre=data['nombre'],
+                direccion=data.get('direccion', ''),
+                prioridad=int(data.get('prioridad', 100)),
+            )
+            return JsonResponse({
+                'success': True,
+                'message': 'Ubicación creada exitosamente',
+                'id': ubicacion.id_ubicacion
+            }, status=201)
+
+        except (json.JSONDecodeError, ValueError):
+            return JsonResponse({'success': False, 'message': 'Datos inválidos'}, status=400)
+        except Exception as e:
+            return JsonResponse({'success': False, 'message': str(e)}, status=500)
+
+
+def _id_padre(valor):
+    """Id de la categoría padre enviada (vacío: raíz). ValueError si no es un entero"""
+    if valor in (None, ''):
+        return None
+    if isinstance(valor, bool) or not str(valor).strip().isdigit():
+        raise ValueError('padre debe ser el id de una categoría')
+    return int(valor) or None
+
 
 @method_decorator(csrf_exempt, name='dispatch')
 class CategoriaListView(View):
@@ -469,6 +764,12 @@ class CategoriaListView(View):
     
     def get(self, request):
         """Obtener lista de todas las categorías disponibles"""
+        etag = etag_datos('categorias', request, 'catalogo')
+        return respuesta_condicional(request, etag, lambda: respuesta_cacheada(
+            'categorias', request, self._listar
+        ))
+
+    def _listar(self):
         try:
             categorias = Categoria.objects.all().order_by('nombre')
             data = []
@@ -477,7 +778,9 @@ class CategoriaListView(View):
                     data.append({
                         'id': cat.id_categoria,
                         'nombre': cat.nombre or '',
-                        'descripcion': cat.descripcion or ''
+                        'descripcion': cat.descripcion or '',
+                        'padre_id': cat.padre_id,
+                        'nivel': cat.nivel,
                     })
                 except Exception as e:
                     # Si hay error con una categoría, continuar con las demás
@@ -508,10 +811,24 @@ class CategoriaListView(View):
             if Categoria.objects.filter(nombre__iexact=data['nombre']).exists():
                 return JsonResponse({'success': False, 'message': 'Ya existe una categoría con ese nombre'}, status=400)
             
+            try:
+                padre_id = _id_padre(data.get('padre'))
+            except ValueError as e:
+                return JsonResponse({'success': False, 'message': str(e)}, status=400)
+            padre = None
+            if padre_id:
+                try:
+                    padre = Categoria.objects.get(id_categoria=padre_id)
+                except Categoria.DoesNotExist:
+                    return JsonResponse({'success': False, 'message': 'Categoría padre no encontrada'}, status=404)
+
             categoria = Categoria.objects.create(
                 nombre=data['nombre'],
-                descripcion=data.get('descripcion', '')
+                descripcion=data.get('descripcion', ''),
+                padre=padre
             )
+            invalidar_catalogo()
+            refrescar_categoria(categoria.id_categoria, categoria.nombre)
             
             return JsonResponse({
                 'success': True,
@@ -547,7 +864,28 @@ class CategoriaListView(View):
             if 'descripcion' in data:
                 categoria.descripcion = data['descripcion']
             
-            categoria.save()
+            # Cambio de padre (null la deja como raíz): se mueve todo el subárbol
+            try:
+                padre_id = _id_padre(data.get('padre'))
+            except ValueError as e:
+                return JsonResponse({'success': False, 'message': str(e)}, status=400)
+            mover = 'padre' in data and padre_id != categoria.padre_id
+            padre = None
+            if mover and padre_id:
+                try:
+                    padre = Categoria.objects.get(id_categoria=padre_id)
+                except Categoria.DoesNotExist:
+                    return JsonResponse({'success': False, 'message': 'Categoría padre no encontrada'}, status=404)
+
+            try:
+                with transaction.atomic():
+                    categoria.save(update_fields=['nombre', 'descripcion'])
+                    if mover:
+                        mover_categoria(categoria, padre)
+            except ErrorCategoria as e:
+                return JsonResponse({'success': False, 'message': str(e)}, status=400)
+            invalidar_catalogo()
+            refrescar_categoria(categoria.id_categoria, categoria.nombre)
             
             return JsonResponse({
                 'success': True,
@@ -580,7 +918,10 @@ class CategoriaListView(View):
                     'message': f'No se puede eliminar la categoría porque tiene {productos_count} producto(s) asociado(s)'
                 }, status=400)
             
-            categoria.delete()
+            # Las subcategorías pasan a depender del padre de la eliminada
+            categoria_pk = categoria.id_categoria
+            eliminar_categoria(categoria)
+            refrescar_categoria(categoria_pk)
             
             return JsonResponse({
                 'success': True,
@@ -590,3 +931,56 @@ class CategoriaListView(View):
         except Exception as e:
             return JsonResponse({'success': False, 'message': str(e)}, status=500)
 
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class CategoriaArbolView(View):
+    """CU7: Árbol de categorías con conteo de productos (cacheado por versión del catálogo)"""
+
+    def get(self, request):
+        etag = etag_datos('categorias_arbol', request, 'catalogo')
+        return respuesta_condicional(request, etag, lambda: respuesta_cacheada(
+            'categorias_arbol', request, self._arbol
+        ))
+
+    def _arbol(self):
+        try:
+            return JsonResponse({'success': True, 'categorias': arbol()}, status=200)
+        except Exception as e:
+            logger.error(f"Error en CategoriaArbolView.get: {str(e)}", exc_info=True)
+            return JsonResponse({
+                'success': False,
+                'message': f'Error al obtener el árbol de categorías: {str(e)}'
+            }, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class CategoriaMigasView(View):
+    """CU7: Migas de pan de una categoría (de la raíz a la categoría)"""
+
+    def get(self, request, categoria_id):
+        vista = f'categorias_migas:{categoria_id}'
+        etag = etag_datos(vista, request, 'catalogo')
+        return respuesta_condicional(request, etag, lambda: respuesta_cacheada(
+            vista, request, lambda: self._migas(categoria_id)
+        ))
+
+    def _migas(self, categoria_id):
+        try:
+            categoria = Categoria.objects.filter(id_categoria=categoria_id).first()
+            if categoria is None:
+                return JsonResponse({'success': False, 'message': 'Categoría no encontrada'}, status=404)
+            return JsonResponse({
+                'success': True,
+                'categoria': {'id': categoria.id_categoria, 'nombre': categoria.nombre, 'nivel': categoria.nivel},
+                'migas': migas(categoria),
+                'subcategorias': list(
+                    categoria.subcategorias.order_by('nombre').values('id_categoria', 'nombre')
+                ),
+            }, status=200)
+        except Exception as e:
+            logger.error(f"Error en CategoriaMigasView.get: {str(e)}", exc_info=True)
+            return JsonResponse({
+                'success': False,
+                'message': f'Error al obtener la categoría: {str(e)}'
+            }, status=500)
@@ -5,10 +5,11 @@ from django.http import JsonResponse, HttpResponse, FileResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.views import View
-from django.db.models import Q, Sum, Count, Avg, Max, Min
+from django.db.models import Q, F, Sum, Count, Avg, Max, Min
 from django.utils import timezone
 from django.conf import settings
 from datetime import datetime, timedelta
+from collections import defaultdict
 import json
 import logging
 import os
@@ -22,9 +23,11 @@ from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 
 from .models import Reporte, ModeloIA, PrediccionVenta
 from .interpreter import ReporteInterpreter
-from ventas_carrito.models import Venta, DetalleVenta
+from ventas_carrito.models import Venta, DetalleVenta, PopularidadProducto
 from productos.models import Producto, Categoria
+from productos.cache_catalogo import etag_datos, respuesta_condicional
 from autenticacion_usuarios.models import Usuario, Cliente
+from autenticacion_usuarios.contexto import cliente_de, es_admin as es_administrador
 
 logger = logging.getLogger(__name__)
 
@@ -47,23 +50,21 @@ class SolicitarReporteView(View):
                     'message': 'Debe iniciar sesión para generar reportes'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            if not user_id:
+            if not request.session.get('user_id'):
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no autenticado'
                 }, status=401)
             
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-            except Usuario.DoesNotExist:
+            usuario = request.usuario
+            if not usuario:
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
                 }, status=404)
             
             # Verificar rol del usuario
-            es_admin = usuario.id_rol and usuario.id_rol.nombre.lower() == 'administrador'
+            es_admin = es_administrador(usuario)
             
             # Obtener datos
             data = json.loads(request.body)
@@ -657,7 +658,23 @@ class GeneradorReporte:
         if 'nombre' in filtros:
             query = query.filter(nombre__icontains=filtros['nombre'])
         
-        productos = query.order_by('nombre')[:200]  # Aumentado a 200
+        agrupacion = parametros.get('agrupacion', [])
+        tipo_reporte = str(parametros.get('tipo_reporte', '')).lower()
+        por_ventas = (
+            'ventas' in agrupacion or 'popularidad' in agrupacion
+            or 'más vendidos' in tipo_reporte or 'mas vendidos' in tipo_reporte
+        )
+        if por_ventas and not ('categoria' in agrupacion or 'precio' in agrupacion
+                               or 'monto' in agrupacion or 'stock' in agrupacion):
+            # Los 200 más vendidos del catálogo (no solo de los primeros 200 por nombre)
+            orden = [F('popularidad__unidades_vendidas').desc(nulls_last=True), 'nombre']
+        else:
+            orden = ['nombre']
+        productos = list(query.order_by(*orden)[:200])  # Aumentado a 200
+        # Stock total y contadores de ventas de la página, una consulta cada uno
+        from productos.models import Stock
+        stocks = {stock.producto_id: stock for stock in Stock.objects.filter(producto__in=productos)}
+        contadores = PopularidadProducto.objects.in_bulk([producto.id for producto in productos])
         
         datos = []
         total_productos = query.count()
@@ -665,15 +682,14 @@ class GeneradorReporte:
         productos_bajo_stock = 0
         
         for producto in productos:
-            from productos.models import Stock
-            stock = Stock.objects.filter(producto=producto).first()
+            stock = stocks.get(producto.id)
             stock_cantidad = stock.cantidad if stock else 0
             
-            # Obtener estadísticas de ventas del producto
-            ventas_producto = DetalleVenta.objects.filter(producto=producto)
-            cantidad_vendida = ventas_producto.aggregate(Sum('cantidad'))['cantidad__sum'] or 0
-            monto_total_vendido = float(ventas_producto.aggregate(Sum('subtotal'))['subtotal__sum'] or 0)
-            veces_vendido = ventas_producto.values('venta').distinct().count()
+            # Estadísticas de ventas del producto (contadores de ventas completadas)
+            contador = contadores.get(producto.id)
+            cantidad_vendida = contador.unidades_vendidas if contador else 0
+            monto_total_vendido = float(contador.ingresos) if contador else 0.0
+            veces_vendido = contador.pedidos if contador else 0
             
             if stock_cantidad == 0:
                 productos_sin_stock += 1
@@ -704,8 +720,6 @@ class GeneradorReporte:
             })
         
         # Ordenar según solicitud
-        agrupacion = parametros.get('agrupacion', [])
-        
         # Si se solicita agrupación por categoría, agrupar realmente
         if 'categoria' in agrupacion:
             # Agrupar por categoría manteniendo todos los productos
@@ -715,7 +729,7 @@ class GeneradorReporte:
             datos.sort(key=lambda x: x.get('precio_numero', 0), reverse=True)
         elif 'stock' in agrupacion:
             datos.sort(key=lambda x: x['stock'])
-        elif 'ventas' in agrupacion or 'popularidad' in agrupacion or 'más vendidos' in str(parametros.get('tipo_reporte', '')).lower() or 'mas vendidos' in str(parametros.get('tipo_reporte', '')).lower():
+        elif por_ventas:
             # Ordenar por cantidad vendida (productos más vendidos)
             datos.sort(key=lambda x: x.get('cantidad_vendida', 0), reverse=True)
         else:
@@ -884,12 +898,20 @@ class GeneradorReporte:
     
     def _generar_reporte_inventario(self, parametros: dict, usuario: Usuario) -> dict:
         """Generar reporte de inventario"""
-        from productos.models import Stock
+        from productos.models import Stock, StockUbicacion
         
         query = Stock.objects.select_related('producto', 'producto__categoria')
         
         # Filtrar solo stocks con productos válidos y ordenar
-        stocks = query.filter(producto__isnull=False).order_by('producto__nombre')[:100]
+        stocks = list(query.filter(producto__isnull=False).order_by('producto__nombre')[:100])
+
+        # Desglose por ubicación de toda la página en una consulta
+        por_ubicacion = defaultdict(list)
+        filas = StockUbicacion.objects.filter(
+            producto_id__in=[stock.producto_id for stock in stocks]
+        ).order_by('ubicacion__prioridad', 'ubicacion__nombre').values_list('producto_id', 'ubicacion__nombre', 'cantidad')
+        for producto_id, ubicacion, cantidad in filas:
+            por_ubicacion[producto_id].append({'ubicacion': ubicacion, 'cantidad': cantidad})
         
         datos = []
         for stock in stocks:
@@ -900,13 +922,14 @@ class GeneradorReporte:
                     'producto_nombre': stock.producto.nombre or 'Producto sin nombre',
                     'categoria': stock.producto.categoria.nombre if stock.producto.categoria else 'Sin categoría',
                     'cantidad': stock.cantidad,
+                    'ubicaciones': por_ubicacion[stock.producto_id],
                     'fecha_actualizacion': stock.fecha_actualizacion.isoformat()
                 })
             else:
                 # Si el producto fue eliminado
                 datos.append({
                     'producto_id': None,
-                    'producto_nombre': f'Producto eliminado (Stock ID: {stock.id})',
+                    'producto_nombre': f'Producto eliminado (Stock ID: {stock.id_stock})',
                     'categoria': 'Sin categoría',
                     'cantidad': stock.cantidad,
                     'fecha_actualizacion': stock.fecha_actualizacion.isoformat()
@@ -1002,27 +1025,22 @@ class GeneradorReporte:
     def _generar_reporte_mis_compras(self, parametros: dict, usuario: Usuario) -> dict:
         """Generar reporte de compras del cliente con datos completos"""
         try:
-            # Intentar obtener el cliente usando el id del usuario
-            try:
-                cliente = Cliente.objects.get(id=usuario)
-            except Cliente.DoesNotExist:
-                # Si no existe como Cliente, intentar buscar por id_usuario
-                try:
-                    cliente = Cliente.objects.get(id_usuario=usuario)
-                except Cliente.DoesNotExist:
-                    logger.warning(f"Cliente no encontrado para usuario {usuario.id}")
-                    return {
-                        'tipo': 'mis_compras',
-                        'datos': [],
-                        'resumen': {
-                            'total_general': 0,
-                            'total_general_formateado': '$0.00',
-                            'cantidad_compras': 0,
-                            'promedio_compra': 0,
-                            'promedio_compra_formateado': '$0.00',
-                            'mensaje': 'No se encontró información de cliente. Asegúrate de tener compras registradas.'
-                        }
+            # Cliente del usuario (cargado junto con el usuario de la petición)
+            cliente = cliente_de(usuario)
+            if cliente is None:
+                logger.warning(f"Cliente no encontrado para usuario {usuario.id}")
+                return {
+                    'tipo': 'mis_compras',
+                    'datos': [],
+                    'resumen': {
+                        'total_general': 0,
+                        'total_general_formateado': '$0.00',
+                        'cantidad_compras': 0,
+                        'promedio_compra': 0,
+                        'promedio_compra_formateado': '$0.00',
+                        'mensaje': 'No se encontró información de cliente. Asegúrate de tener compras registradas.'
                     }
+                }
         except Exception as e:
             logger.error(f"Error al obtener cliente para usuario {usuario.id}: {str(e)}", exc_info=True)
             return {
@@ -2135,8 +2153,7 @@ class FiltrosInteligentesView(View):
                     'razon': f'Se registraron {ventas_semana} ventas en la última semana'
                 })
             
-            # Categorías más vendidas
-            from django.db.models import Sum
+            # Categorías más vendidas en la última semana (ingresos del período)
             categorias_vendidas = DetalleVenta.objects.filter(
                 venta__fecha_venta__gte=semana_pasada,
                 producto__categoria__isnull=False
@@ -2172,16 +2189,27 @@ class OpcionesFiltrosView(View):
                     'message': 'Debe iniciar sesión'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-                is_admin = usuario.id_rol and usuario.id_rol.nombre.lower() == 'administrador'
-            except Usuario.DoesNotExist:
+            usuario = request.usuario
+            if not usuario:
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
                 }, status=404)
+            is_admin = es_administrador(usuario)
+            
+            # ETag a partir de las versiones de categorías y clientes: 304 sin consultar listas
+            etag = etag_datos('opciones-filtros', request, 'catalogo', 'clientes', extra=f'admin={bool(is_admin)}')
+            return respuesta_condicional(request, etag, lambda: self._opciones(is_admin))
             
+        except Exception as e:
+            logger.error(f"Error en OpcionesFiltrosView.get: {str(e)}", exc_info=True)
+            return JsonResponse({
+                'success': False,
+                'message': f'Error interno: {str(e)}'
+            }, status=500)
+    
+    def _opciones(self, is_admin):
+        try:
             response_data = {
                 'success': True,
                 'is_admin': is_admin
@@ -2246,16 +2274,14 @@ class ListarReportesView(View):
                     'message': 'Debe iniciar sesión'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            if not user_id:
+            if not request.session.get('user_id'):
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no autenticado'
                 }, status=401)
             
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-            except Usuario.DoesNotExist:
+            usuario = request.usuario
+            if not usuario:
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
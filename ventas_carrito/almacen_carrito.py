@@ -0,0 +1,560 @@
+"""
+CU8/CU9: Almacenamiento del carrito
+
+- Clientes autenticados: Carrito / ItemCarrito en la BD, como siempre.
+- Visitantes anónimos: el carrito vive en la caché CARRITO_CACHE_ALIAS
+  (Redis o la tabla de caché de la BD, ver settings) bajo una cookie
+  aleatoria. No se crea sesión ni filas de Carrito, y el carrito expira solo
+  tras CARRITO_ANONIMO_TTL segundos sin uso. Cada escritura relee las líneas
+  bajo un bloqueo por carrito (`add` atómico de la caché), así dos pestañas no
+  pierden lo que agregó la otra. Se escribe en Carrito únicamente al iniciar
+  sesión (o al fusionar o pagar): sus items se suman al carrito del cliente.
+
+Las fusiones bloquean los carritos involucrados y suman todos los items en una
+sentencia, recortando cada cantidad al stock disponible.
+
+Cada línea reserva su stock (ReservaStock con referencia "carrito:<id>" o
+"anonimo:<hash del token>") por RESERVA_CARRITO_TTL segundos desde el último
+cambio; quitar o vaciar la libera y el checkout la consume.
+
+Las vistas usan la misma interfaz para ambos casos (CarritoBD / CarritoAnonimo).
+"""
+import hashlib
+import secrets
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.utils import timezone
+
+from productos.models import Producto
+from productos.inventario import liberar_stock, reservar_stock, stock_disponible
+from autenticacion_usuarios.contexto import cliente_de, es_cliente
+from .models import Carrito, ItemCarrito
+
+
+COOKIE_CARRITO = 'carrito_anonimo'
+LARGO_TOKEN = 32
+# Segundos que dura el bloqueo de escritura de un carrito anónimo (si el
+# proceso que lo tomó muere, vence solo) y pausa entre intentos
+BLOQUEO_CARRITO = 5
+ESPERA_BLOQUEO = 0.02
+
+
+def _cache():
+    return caches[getattr(settings, 'CARRITO_CACHE_ALIAS', 'carritos')]
+
+
+def _ttl():
+    return getattr(settings, 'CARRITO_ANONIMO_TTL', 7 * 24 * 3600)
+
+
+def _ttl_reserva():
+    return getattr(settings, 'RESERVA_CARRITO_TTL', 15 * 60)
+
+
+def _clave(token):
+    return f'carrito:anonimo:{token}'
+
+
+class CarritoOcupado(Exception):
+    """Otra petición mantiene bloqueado el carrito anónimo más de BLOQUEO_CARRITO segundos"""
+
+
+@contextmanager
+def _bloqueo_carrito(token):
+    """
+    Bloqueo por carrito anónimo con un `add` atómico de la caché. La clave
+    guarda una marca propia: al terminar solo se borra si sigue siendo la
+    nuestra (si el bloqueo venció y lo tomó otra petición, no se le quita).
+    """
+    cache = _cache()
+    bloqueo = _clave(token) + ':bloqueo'
+    marca = secrets.token_hex(16)
+    limite = time.monotonic() + BLOQUEO_CARRITO
+    while not cache.add(bloqueo, marca, timeout=BLOQUEO_CARRITO):
+        if time.monotonic() >= limite:
+            raise CarritoOcupado()
+        time.sleep(ESPERA_BLOQUEO)
+    try:
+        yield
+    finally:
+        if cache.get(bloqueo) == marca:
+            cache.delete(bloqueo)
+
+
+def referencia_carrito(carrito_id):
+    """Referencia de las reservas de stock de un carrito de la BD"""
+    return f'carrito:{carrito_id}'
+
+
+def _referencia_anonima(token):
+    # El token es la credencial del carrito: en la BD solo se guarda su hash
+    return 'anonimo:' + hashlib.sha256(token.encode()).hexdigest()[:40]
+
+
+def precio_con_descuento(precio, porcentaje):
+    return (precio * (100 - Decimal(str(porcentaje))) / 100).quantize(Decimal('0.01'))
+
+
+def _token_valido(token):
+    return bool(token) and len(token) <= 64 and token.replace('-', '').replace('_', '').isalnum()
+
+
+# ==========================================================
+# RESERVAS DE LAS LÍNEAS
+# ==========================================================
+
+class _ReservasCarrito:
+    """Reserva del stock de las líneas (lanza StockInsuficiente si no alcanza)"""
+    referencia = None
+
+    def disponibles(self, producto_ids):
+        """Stock que este carrito puede usar: lo libre más lo que ya reservó"""
+        return stock_disponible(producto_ids, self.referencia)
+
+    def _reservar(self, cantidades):
+        if _ttl_reserva():
+            reservar_stock(self.referencia, cantidades, _ttl_reserva())
+
+    def _liberar(self, producto_ids=None):
+        if self.referencia:
+            liberar_stock(self.referencia, producto_ids)
+
+
+# ==========================================================
+# CARRITO EN LA BD (clientes autenticados)
+# ==========================================================
+
+class CarritoBD(_ReservasCarrito):
+    """Carrito persistido (Carrito / ItemCarrito)"""
+    anonimo = False
+
+    def __init__(self, carrito):
+        self.carrito = carrito
+        self.id_carrito = carrito.id_carrito
+        self.referencia = referencia_carrito(carrito.id_carrito)
+
+    def _tocar(self):
+        # Los cambios de items no pasan por Carrito.save(): sin esto fecha_actualizacion
+        # no refleja el uso y la purga tomaría el carrito por abandonado
+        Carrito.objects.filter(pk=self.id_carrito).update(fecha_actualizacion=timezone.now())
+
+    def items(self):
+        return list(ItemCarrito.objects.filter(carrito=self.carrito).select_related('producto'))
+
+    def item(self, item_id):
+        return ItemCarrito.objects.filter(carrito=self.carrito, id_item=item_id).select_related('producto').first()
+
+    def cantidad_de(self, producto_id):
+        return ItemCarrito.objects.filter(
+            carrito=self.carrito, producto_id=producto_id
+        ).values_list('cantidad', flat=True).first() or 0
+
+    def fijar(self, producto, cantidad):
+        """Fijar la cantidad del producto (el precio se toma al agregarlo por primera vez)"""
+        with transaction.atomic():
+            self._reservar({producto.id: cantidad})
+            ItemCarrito.objects.update_or_create(
+                carrito=self.carrito,
+                producto=producto,
+                defaults={'cantidad': cantidad},
+                create_defaults={'cantidad': cantidad, 'precio_unitario': producto.precio},
+            )
+            self._tocar()
+
+    def cantidades_de(self, producto_ids):
+        return dict(
+            ItemCarrito.objects.filter(carrito=self.carrito, producto_id__in=producto_ids)
+            .values_list('producto_id', 'cantidad')
+        )
+
+    def fijar_varios(self, cantidades):
+        """Fijar {producto: cantidad} con un único INSERT ... ON CONFLICT sobre (carrito, producto)"""
+        with transaction.atomic():
+            self._reservar({producto.id: cantidad for producto, cantidad in cantidades.items()})
+            ItemCarrito.objects.bulk_create(
+                [
+                    ItemCarrito(carrito=self.carrito, producto=producto, cantidad=cantidad,
+                                precio_unitario=producto.precio)
+                    for producto, cantidad in cantidades.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['carrito', 'producto'],
+                update_fields=['cantidad'],
+            )
+            self._tocar()
+
+    def quitar(self, item):
+        item.delete()
+        self._tocar()
+        self._liberar([item.producto_id])
+
+    def vaciar(self):
+        ItemCarrito.objects.filter(carrito=self.carrito).delete()
+        self._tocar()
+        self._liberar()
+
+    def descontar(self, porcentaje):
+        """Precio de cada item = precio de lista con el descuento; devuelve los items afectados"""
+        items = self.items()
+        for item in items:
+            item.precio_unitario = precio_con_descuento(item.producto.precio, porcentaje)
+        ItemCarrito.objects.bulk_update(items, ['precio_unitario'])
+        if items:
+            self._tocar()
+        return len(items)
+
+    def totales(self):
+        total_items, total_precio = self.carrito.get_totales()
+        return {'total_items': total_items, 'total_precio': float(total_precio)}
+
+
+# ==========================================================
+# CARRITO EN CACHÉ (visitantes anónimos)
+# ==========================================================
+
+class ItemAnonimo:
+    """Item de un carrito anónimo con la misma forma que ItemCarrito (id_item = id de producto)"""
+
+    def __init__(self, producto, cantidad, precio_unitario):
+        self.id_item = producto.id
+        self.producto = producto
+        self.producto_id = producto.id
+        self.cantidad = cantidad
+        self.precio_unitario = precio_unitario
+
+    def get_subtotal(self):
+        return self.cantidad * self.precio_unitario
+
+
+class CarritoAnonimo(_ReservasCarrito):
+    """
+    Carrito guardado en la caché como {producto_id: [cantidad, precio_unitario]}.
+    El token (y la cookie) se crean en la primera escritura.
+    """
+    anonimo = True
+    id_carrito = None
+
+    def __init__(self, token=None):
+        self.token = token if _token_valido(token) else None
+        self.modificado = False
+        self.lineas = {}
+        if self.token:
+            self.lineas = _cache().get(_clave(self.token)) or {}
+
+    @property
+    def referencia(self):
+        return _referencia_anonima(self.token) if self.token else None
+
+    @contextmanager
+    def _escritura(self):
+        """
+        Releer las líneas con el carrito bloqueado, modificarlas y guardarlas.
+        Sin el bloqueo, dos escrituras simultáneas leerían el mismo dict y la
+        segunda borraría lo que agregó la primera.
+        """
+        cache = _cache()
+        with _bloqueo_carrito(self.token):
+            self.lineas = cache.get(_clave(self.token)) or {}
+            yield self.lineas
+            # Cada escritura renueva el plazo: solo expiran los carritos sin uso
+            cache.set(_clave(self.token), self.lineas, timeout=_ttl())
+            self.modificado = True
+
+    def items(self):
+        productos = Producto.objects.in_bulk([int(pid) for pid in self.lineas])
+        return [
+            ItemAnonimo(productos[int(pid)], cantidad, Decimal(precio))
+            for pid, (cantidad, precio) in self.lineas.items()
+            if int(pid) in productos
+        ]
+
+    def item(self, item_id):
+        linea = self.lineas.get(str(item_id))
+        if linea is None:
+            return None
+        producto = Producto.objects.filter(pk=item_id).first()
+        return ItemAnonimo(producto, linea[0], Decimal(linea[1])) if producto else None
+
+    def cantidad_de(self, producto_id):
+        return self.lineas.get(str(producto_id), (0, None))[0]
+
+    def fijar(self, producto, cantidad):
+        self.fijar_varios({producto: cantidad})
+
+    def cantidades_de(self, producto_ids):
+        return {pid: self.cantidad_de(pid) for pid in producto_ids if str(pid) in self.lineas}
+
+    def fijar_varios(self, cantidades):
+        if not self.token:
+            self.token = secrets.token_urlsafe(LARGO_TOKEN)
+        self._reservar({producto.id: cantidad for producto, cantidad in cantidades.items()})
+        with self._escritura() as lineas:
+            for producto, cantidad in cantidades.items():
+                anterior = lineas.get(str(producto.id))
+                lineas[str(producto.id)] = [cantidad, anterior[1] if anterior else str(producto.precio)]
+
+    def quitar(self, item):
+        with self._escritura() as lineas:
+            lineas.pop(str(item.producto_id), None)
+        self._liberar([item.producto_id])
+
+    def vaciar(self):
+        self.lineas = {}
+        if self.token:
+            _cache().delete(_clave(self.token))
+            self.modificado = True
+            self._liberar()
+
+    def descontar(self, porcentaje):
+        items = self.items()
+        if not items:
+            return 0
+        precios = {str(item.producto_id): str(precio_con_descuento(item.producto.precio, porcentaje)) for item in items}
+        with self._escritura() as lineas:
+            for producto_id, precio in precios.items():
+                if producto_id in lineas:
+                    lineas[producto_id][1] = precio
+        return len(items)
+
+    def totales(self):
+        total_items = sum(cantidad for cantidad, _ in self.lineas.values())
+        total_precio = sum(cantidad * Decimal(precio) for cantidad, precio in self.lineas.values())
+        return {'total_items': total_items, 'total_precio': float(total_precio)}
+
+
+# ==========================================================
+# SELECCIÓN DEL CARRITO
+# ==========================================================
+
+def cliente_de_sesion(request):
+    """Cliente autenticado de la sesión, o None (visitante o administrador)"""
+    usuario = request.usuario
+    return cliente_de(usuario) if es_cliente(usuario) else None
+
+
+def _carrito_de_sesion(request):
+    """Carrito anónimo en la BD por session_key (cuando CARRITO_ANONIMO_CACHE está desactivado)"""
+    session_key = request.session.session_key
+    if not session_key:
+        request.session.create()
+        session_key = request.session.session_key
+    carrito, _ = Carrito.objects.get_or_create(
+        session_key=session_key,
+        activo=True,
+        defaults={'cliente': None}
+    )
+    return carrito
+
+
+def carrito_de_cliente(cliente):
+    carrito, _ = Carrito.objects.get_or_create(
+        cliente=cliente,
+        activo=True,
+        defaults={'session_key': None}
+    )
+    return carrito
+
+
+def obtener_carrito(request):
+    """Carrito del cliente autenticado (BD) o del visitante (caché)"""
+    cliente = cliente_de_sesion(request)
+    if cliente is not None:
+        return CarritoBD(carrito_de_cliente(cliente))
+
+    if not getattr(settings, 'CARRITO_ANONIMO_CACHE', True):
+        return CarritoBD(_carrito_de_sesion(request))
+
+    carrito = CarritoAnonimo(request.COOKIES.get(COOKIE_CARRITO))
+    request._carrito_anonimo = carrito  # Para fijar la cookie en la respuesta
+    return carrito
+
+
+def aplicar_cookie(request, response):
+    """Fijar, renovar o borrar la cookie del carrito anónimo según lo ocurrido en la vista"""
+    if getattr(request, '_borrar_cookie_carrito', False):
+        response.delete_cookie(COOKIE_CARRITO)
+        return response
+    carrito = getattr(request, '_carrito_anonimo', None)
+    if carrito is not None and carrito.modificado:
+        if carrito.lineas:
+            response.set_cookie(
+                COOKIE_CARRITO, carrito.token, max_age=_ttl(), httponly=True, samesite='Lax',
+                secure=request.is_secure(),
+            )
+        else:
+            response.delete_cookie(COOKIE_CARRITO)
+    return response
+
+
+class CookieCarritoMixin:
+    """Vistas que pueden crear o modificar el carrito anónimo"""
+
+    def dispatch(self, request, *args, **kwargs):
+        return aplicar_cookie(request, super().dispatch(request, *args, **kwargs))
+
+
+# ==========================================================
+# FUSIÓN Y PERSISTENCIA (inicio de sesión, fusión, checkout)
+# ==========================================================
+
+# Suma los items de `origen` (id_producto, cantidad, precio_unitario) al carrito
+# destino en una sola sentencia. Cada cantidad queda en min(destino + origen,
+# stock disponible para el destino: lo libre más lo que ya reservó; las reservas
+# vencidas no cuentan) y nunca por
+# debajo de lo que el destino ya tenía; el precio de los productos que el
+# destino ya tenía no cambia.
+_SQL_SUMAR_ITEMS = """
+WITH fuente AS (
+    SELECT o.id_producto, o.precio_unitario,
+           o.cantidad + COALESCE(d.cantidad, 0) AS pedido,
+           COALESCE(d.cantidad, 0) AS actual,
+           GREATEST(COALESCE(s.cantidad - GREATEST(s.reservado - COALESCE(v.cantidad, 0), 0), 0), 0)
+               + COALESCE(r.cantidad, 0) AS stock
+    FROM ({origen}) AS o (id_producto, cantidad, precio_unitario)
+    LEFT JOIN item_carrito d ON d.id_carrito = %s AND d.id_producto = o.id_producto
+    LEFT JOIN stock s ON s.id_producto = o.id_producto
+    LEFT JOIN reserva_stock r ON r.referencia = %s AND r.id_producto = o.id_producto AND r.vence > NOW()
+    LEFT JOIN LATERAL (
+        SELECT SUM(x.cantidad) AS cantidad FROM reserva_stock x
+        WHERE x.id_producto = o.id_producto AND x.vence <= NOW()
+    ) v ON TRUE
+), escritos AS (
+    INSERT INTO item_carrito (id_carrito, id_producto, cantidad, precio_unitario, fecha_agregado)
+    SELECT %s, id_producto, LEAST(pedido, stock), precio_unitario, NOW()
+    FROM fuente
+    WHERE LEAST(pedido, stock) > actual
+    ORDER BY id_producto
+    ON CONFLICT (id_carrito, id_producto) DO UPDATE SET cantidad = EXCLUDED.cantidad
+    RETURNING id_producto
+)
+SELECT (SELECT COUNT(*) FROM escritos), (SELECT COUNT(*) FROM fuente WHERE pedido > stock)
+"""
+
+_ITEMS_DE_CARRITO = 'SELECT id_producto, cantidad, precio_unitario FROM item_carrito WHERE id_carrito = %s'
+
+
+def _sumar_items(destino_id, origen, parametros, resultado):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            _SQL_SUMAR_ITEMS.format(origen=origen),
+            [*parametros, destino_id, referencia_carrito(destino_id), destino_id],
+        )
+        movidos, limitados = cursor.fetchone()
+    resultado['movidos'] += movidos
+    resultado['limitados'] += limitados
+    return resultado
+
+
+def _reservar_carrito(carrito_id):
+    """Reservar lo que haya de cada línea del carrito tras una fusión"""
+    if _ttl_reserva():
+        cantidades = dict(ItemCarrito.objects.filter(carrito_id=carrito_id).values_list('producto_id', 'cantidad'))
+        reservar_stock(referencia_carrito(carrito_id), cantidades, _ttl_reserva(), parcial=True)
+
+
+def _bloquear(*carrito_ids):
+    """SELECT ... FOR UPDATE de los carritos, siempre en orden de id para no provocar interbloqueos"""
+    list(Carrito.objects.select_for_update().filter(pk__in=carrito_ids).order_by('pk').values_list('pk', flat=True))
+
+
+def fusionar_carritos(origen, destino):
+    """
+    Pasar los items del carrito `origen` al carrito del request (`destino`,
+    CarritoBD o CarritoAnonimo) y eliminar el origen.
+    Devuelve {'movidos', 'limitados'} (items escritos / recortados por stock).
+    """
+    resultado = {'movidos': 0, 'limitados': 0}
+    with transaction.atomic():
+        if not destino.anonimo:
+            _bloquear(origen.pk, destino.id_carrito)
+            liberar_stock(referencia_carrito(origen.pk))
+            _sumar_items(destino.id_carrito, _ITEMS_DE_CARRITO, [origen.pk], resultado)
+            origen.delete()
+            _reservar_carrito(destino.id_carrito)
+            return resultado
+
+        # Visitante: el mismo cálculo sobre el carrito en caché
+        _bloquear(origen.pk)
+        liberar_stock(referencia_carrito(origen.pk))
+        items = list(ItemCarrito.objects.filter(carrito=origen).select_related('producto'))
+        disponibles = destino.disponibles(item.producto_id for item in items)
+        actuales = destino.cantidades_de([item.producto_id for item in items])
+        nuevas = {}
+        for item in items:
+            actual = actuales.get(item.producto_id, 0)
+            pedido = actual + item.cantidad
+            cantidad = min(pedido, disponibles[item.producto_id])
+            resultado['limitados'] += pedido > cantidad
+            if cantidad > actual:
+                nuevas[item.producto] = cantidad
+        if nuevas:
+            destino.fijar_varios(nuevas)
+        resultado['movidos'] = len(nuevas)
+        origen.delete()
+    return resultado
+
+
+def _reclamar_lineas(token):
+    """Leer y borrar las líneas del carrito anónimo bajo su bloqueo (solo una petición las obtiene)"""
+    cache = _cache()
+    with _bloqueo_carrito(token):
+        lineas = cache.get(_clave(token))
+        if lineas:
+            cache.delete(_clave(token))
+    return lineas
+
+
+def persistir_carrito_anonimo(request, cliente):
+    """
+    Sumar al carrito del cliente lo que armó como visitante: el carrito en
+    caché de la cookie y el carrito por session_key de la sesión actual (los
+    creados antes del carrito en caché o con CARRITO_ANONIMO_CACHE desactivado).
+    Se llama al iniciar sesión, al fusionar y al pagar.
+    Devuelve {'movidos', 'limitados'}.
+    """
+    resultado = {'movidos': 0, 'limitados': 0}
+    token = request.COOKIES.get(COOKIE_CARRITO)
+    token = token if _token_valido(token) else None
+    session_key = request.session.session_key
+    de_sesion = (
+        Carrito.objects.filter(session_key=session_key, cliente__isnull=True).first()
+        if session_key else None
+    )
+    if not token and de_sesion is None:
+        return resultado
+
+    # Las líneas se reclaman (leer y borrar bajo el bloqueo del carrito) antes
+    # de sumarlas: si dos inicios de sesión o pagos llegan a la vez, solo uno
+    # las encuentra. Si la fusión falla se devuelven a la caché.
+    lineas = _reclamar_lineas(token) if token else None
+    destino = carrito_de_cliente(cliente)
+    try:
+        with transaction.atomic():
+            _bloquear(destino.pk, *([de_sesion.pk] if de_sesion else []))
+            if token:
+                liberar_stock(_referencia_anonima(token))
+            if de_sesion is not None:
+                liberar_stock(referencia_carrito(de_sesion.pk))
+            if lineas:
+                valores = ', '.join(['(%s::integer, %s::integer, %s::numeric)'] * len(lineas))
+                parametros = [
+                    valor for pid, (cantidad, precio) in lineas.items() for valor in (int(pid), cantidad, precio)
+                ]
+                _sumar_items(destino.pk, f'VALUES {valores}', parametros, resultado)
+            if de_sesion is not None:
+                _sumar_items(destino.pk, _ITEMS_DE_CARRITO, [de_sesion.pk], resultado)
+                de_sesion.delete()
+            _reservar_carrito(destino.pk)
+    except Exception:
+        if lineas:
+            # add(): si el visitante volvió a agregar algo entre tanto, se conserva
+            _cache().add(_clave(token), lineas, timeout=_ttl())
+        raise
+    if token:
+        request._borrar_cookie_carrito = True
+    return resultado
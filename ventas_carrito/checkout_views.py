@@ -2,9 +2,16 @@ from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.views import View
+from django.db import transaction
 import json
 
 from .models import Carrito, ItemCarrito, Venta, DetalleVenta
+from .recomendaciones import programar_actualizacion
+from .popularidad import registrar_venta
+from .almacen_carrito import CarritoOcupado, CookieCarritoMixin, persistir_carrito_anonimo, referencia_carrito
+from .views import respuesta_carrito_ocupado
+from productos.inventario import descontar_stock, liberar_stock, StockInsuficiente
+from autenticacion_usuarios.contexto import cliente_de
 
 
 # ==========================================================
@@ -12,7 +19,7 @@ from .models import Carrito, ItemCarrito, Venta, DetalleVenta
 # ==========================================================
 
 @method_decorator(csrf_exempt, name='dispatch')
-class CheckoutView(View):
+class CheckoutView(CookieCarritoMixin, View):
     """
     CU10: Realizar Compra (Checkout)
     Permite a clientes autenticados realizar compras desde su carrito
@@ -57,17 +64,17 @@ class CheckoutView(View):
                 }, status=400)
             
             # Obtener cliente autenticado
-            user_id = request.session.get('user_id')
-            try:
-                from autenticacion_usuarios.models import Usuario, Cliente
-                usuario = Usuario.objects.get(id=user_id)
-                cliente = Cliente.objects.get(id=usuario)
-            except (Usuario.DoesNotExist, Cliente.DoesNotExist):
+            usuario = request.usuario
+            cliente = cliente_de(usuario)
+            if cliente is None:
                 return JsonResponse({
                     'success': False,
                     'message': 'Cliente no encontrado'
                 }, status=404)
             
+            # Lo agregado como visitante en este navegador también se compra
+            persistir_carrito_anonimo(request, cliente)
+            
             # Obtener carrito del cliente
             try:
                 carrito = Carrito.objects.get(cliente=cliente, activo=True)
@@ -85,74 +92,55 @@ class CheckoutView(View):
                     'message': 'El carrito está vacío'
                 }, status=400)
             
-            # Calcular total
-            total = sum(item.get_subtotal() for item in items_carrito)
-            
-            # Crear venta
-            venta = Venta.objects.create(
-                cliente=cliente,
-                total=total,
-                estado='pendiente',
-                metodo_pago=metodo_pago,
-                direccion_entrega=direccion_entrega,
-                notas=notas
-            )
-            
-            # Crear detalles de venta y actualizar stock
-            from productos.models import Stock
             import logging
             logger = logging.getLogger(__name__)
-            
-            detalles_creados = []
-            productos_sin_stock = []
-            
-            # Primero verificar todo el stock disponible
-            for item in items_carrito.select_related('producto'):
-                stock_obj = Stock.objects.filter(producto=item.producto).first()
-                stock_disponible = stock_obj.cantidad if stock_obj else 0
-                
-                if stock_disponible < item.cantidad:
-                    productos_sin_stock.append({
-                        'producto': item.producto.nombre,
-                        'solicitado': item.cantidad,
-                        'disponible': stock_disponible
-                    })
-            
-            # Si hay productos sin stock, cancelar la venta
-            if productos_sin_stock:
-                venta.delete()
+            items = list(items_carrito.select_related('producto'))
+
+            # Calcular total
+            total = sum(item.get_subtotal() for item in items)
+
+            # Crear venta, detalles y descontar stock en una sola transacción:
+            # si algún producto no alcanza no queda nada registrado
+            try:
+                with transaction.atomic():
+                    venta = Venta.objects.create(
+                        cliente=cliente,
+                        total=total,
+                        estado='pendiente',
+                        metodo_pago=metodo_pago,
+                        direccion_entrega=direccion_entrega,
+                        notas=notas
+                    )
+                    detalles_creados = [
+                        DetalleVenta.objects.create(
+                            venta=venta,
+                            producto=item.producto,
+                            cantidad=item.cantidad,
+                            precio_unitario=item.precio_unitario
+                        )
+                        for item in items
+                    ]
+                    descontar_stock(
+                        [(item.producto_id, item.cantidad) for item in items],
+                        referencia=f'venta:{venta.id_venta}',
+                        reserva=referencia_carrito(carrito.id_carrito)
+                    )
+
+                    # Marcar venta como completada y sumar los contadores de popularidad
+                    venta.estado = 'completada'
+                    venta.save()
+                    registrar_venta(venta.id_venta)
+            except StockInsuficiente as e:
+                nombres = {item.producto_id: item.producto.nombre for item in items}
                 mensaje = 'Stock insuficiente para los siguientes productos: '
-                mensaje += ', '.join([f"{p['producto']} (solicitado: {p['solicitado']}, disponible: {p['disponible']})" 
-                                    for p in productos_sin_stock])
+                mensaje += ', '.join([f"{nombres[p['producto_id']]} (solicitado: {p['solicitado']}, disponible: {p['disponible']})"
+                                    for p in e.faltantes])
                 return JsonResponse({
                     'success': False,
                     'message': mensaje
                 }, status=400)
-            
-            # Si todo está bien, crear detalles y actualizar stock
-            for item in items_carrito.select_related('producto'):
-                # Crear detalle de venta
-                detalle = DetalleVenta.objects.create(
-                    venta=venta,
-                    producto=item.producto,
-                    cantidad=item.cantidad,
-                    precio_unitario=item.precio_unitario
-                )
-                detalles_creados.append(detalle)
-                
-                # Actualizar stock del producto
-                stock_obj = Stock.objects.filter(producto=item.producto).first()
-                if stock_obj:
-                    stock_obj.cantidad -= item.cantidad
-                    if stock_obj.cantidad < 0:
-                        stock_obj.cantidad = 0
-                    stock_obj.save()
-                else:
-                    logger.warning(f"Producto {item.producto.id} no tiene registro de stock")
-            
-            # Marcar venta como completada
-            venta.estado = 'completada'
-            venta.save()
+
+            programar_actualizacion()
             
             # CU12: Generar comprobante automáticamente
             comprobante_data = None
@@ -169,9 +157,10 @@ class CheckoutView(View):
                 logger.warning(f"Error al generar comprobante automático: {str(e)}")
                 # No fallar la venta si el comprobante falla
             
-            # Limpiar carrito
+            # Limpiar carrito (y sus reservas que no se hayan consumido)
             items_carrito.delete()
             carrito.delete()
+            liberar_stock(referencia_carrito(carrito.id_carrito))
             
             # Registrar en bitácora
             from autenticacion_usuarios.models import Bitacora
@@ -203,6 +192,8 @@ class CheckoutView(View):
             
             return JsonResponse(response_data, status=201)
             
+        except CarritoOcupado:
+            return respuesta_carrito_ocupado()
         except json.JSONDecodeError:
             return JsonResponse({
                 'success': False,
@@ -5,7 +5,8 @@ from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.views import View
-from django.db.models import Q, Sum, Count, Avg, Max, Min
+from django.db.models import Q, Sum, Count, Avg, Max, Min, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
 from productos.models import Producto, Categoria
 from django.core.paginator import Paginator
 from django.utils import timezone
@@ -14,11 +15,110 @@ import json
 import logging
 
 from .models import Venta, DetalleVenta, VentaHistorico
-from autenticacion_usuarios.models import Usuario, Cliente, Bitacora
+from .popularidad import mas_vendidos
+from productos.campos import CamposInvalidos, campos_solicitados, columnas
+from autenticacion_usuarios.models import Cliente, Bitacora
+from autenticacion_usuarios.contexto import cliente_de, es_admin, es_cliente
 
 logger = logging.getLogger(__name__)
 
 
+# ==========================================================
+# SERIALIZACIÓN DEL HISTORIAL (fields= / include=)
+# ==========================================================
+
+CAMPOS_VENTA = (
+    'id', 'cliente', 'fecha', 'total', 'estado', 'metodo_pago', 'direccion_entrega', 'productos_count',
+)
+ANIDADOS_VENTA = ('productos', 'comprobante', 'pago_online')
+
+# Clave de la API -> columnas de Venta (y de relaciones a uno) que necesita
+COLUMNAS_VENTA = {
+    'cliente': ('cliente__id__id', 'cliente__id__nombre', 'cliente__id__apellido', 'cliente__id__email'),
+    'fecha': ('fecha_venta',),
+    'total': ('total',),
+    'estado': ('estado',),
+    'metodo_pago': ('metodo_pago',),
+    'direccion_entrega': ('direccion_entrega',),
+    'comprobante': ('comprobante__id_comprobante', 'comprobante__nro'),
+    'pago_online': ('pago_online__id_pago', 'pago_online__estado', 'pago_online__referencia'),
+}
+RELACIONES_VENTA = {
+    'cliente': 'cliente__id',
+    'comprobante': 'comprobante',
+    'pago_online': 'pago_online',
+}
+
+
+def consulta_historial(ventas, campos):
+    """Limitar columnas y relaciones de la consulta a las claves pedidas"""
+    ventas = ventas.select_related(*[RELACIONES_VENTA[c] for c in RELACIONES_VENTA if c in campos])
+    ventas = ventas.only(*columnas(campos, COLUMNAS_VENTA, fijas=('id_venta',)))
+    if 'productos' in campos:
+        ventas = ventas.prefetch_related(Prefetch(
+            'detalles',
+            queryset=DetalleVenta.objects.select_related('producto').only(
+                'venta_id', 'producto_id', 'producto__nombre', 'cantidad', 'precio_unitario', 'subtotal'
+            ),
+        ))
+    elif 'productos_count' in campos:
+        ventas = ventas.annotate(productos_count=Coalesce(Subquery(
+            DetalleVenta.objects.filter(venta=OuterRef('pk')).order_by()
+            .values('venta').annotate(cantidad=Count('*')).values('cantidad')
+        ), 0))
+    return ventas
+
+
+def serializar_venta(venta, campos):
+    """Venta del historial con solo las claves pedidas"""
+    datos = {'id': venta.id_venta}
+    if 'cliente' in campos:
+        usuario = venta.cliente.id
+        datos['cliente'] = {
+            'id': usuario.id,
+            'nombre': f"{usuario.nombre} {usuario.apellido or ''}".strip(),
+            'email': usuario.email
+        }
+    if 'fecha' in campos:
+        datos['fecha'] = venta.fecha_venta.isoformat()
+    if 'total' in campos:
+        datos['total'] = float(venta.total)
+    for campo in ('estado', 'metodo_pago', 'direccion_entrega'):
+        if campo in campos:
+            datos[campo] = getattr(venta, campo)
+    if 'productos' in campos:
+        detalles = venta.detalles.all()
+        datos['productos_count'] = len(detalles)
+        datos['productos'] = [
+            {
+                'id': detalle.producto.id if detalle.producto else detalle.producto_id,
+                'nombre': detalle.producto.nombre if detalle.producto else f"Producto #{detalle.producto_id}",
+                'cantidad': detalle.cantidad,
+                'precio_unitario': float(detalle.precio_unitario),
+                'subtotal': float(detalle.subtotal)
+            }
+            for detalle in detalles
+        ]
+        if 'productos_count' not in campos:
+            del datos['productos_count']
+    elif 'productos_count' in campos:
+        datos['productos_count'] = venta.productos_count
+    if 'comprobante' in campos:
+        # Relaciones cargadas con select_related: hasattr no consulta la BD
+        datos['comprobante'] = {
+            'existe': True,
+            'numero': venta.comprobante.nro,
+            'pdf_url': f'/api/ventas/comprobantes/{venta.id_venta}/pdf/'
+        } if hasattr(venta, 'comprobante') else None
+    if 'pago_online' in campos:
+        datos['pago_online'] = {
+            'existe': True,
+            'estado': venta.pago_online.estado,
+            'referencia': venta.pago_online.referencia
+        } if hasattr(venta, 'pago_online') else None
+    return datos
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class HistorialVentasView(View):
     """
@@ -47,37 +147,40 @@ class HistorialVentasView(View):
             cliente_id = request.GET.get('cliente_id')
             page = int(request.GET.get('page', 1))
             page_size = int(request.GET.get('page_size', 20))
+
+            # Claves a devolver (?fields=...&include=productos,comprobante,pago_online)
+            try:
+                campos = campos_solicitados(request, CAMPOS_VENTA, ANIDADOS_VENTA)
+            except CamposInvalidos as e:
+                return JsonResponse({'success': False, 'message': str(e)}, status=400)
             
             # Obtener usuario y cliente
-            user_id = request.session.get('user_id')
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-                
-                # Si es cliente, solo puede ver sus propias ventas
-                if usuario.id_rol.nombre.lower() == 'cliente':
-                    try:
-                        cliente = Cliente.objects.get(id=usuario)
-                        ventas_query = Venta.objects.filter(cliente=cliente)
-                    except Cliente.DoesNotExist:
-                        return JsonResponse({
-                            'success': False,
-                            'message': 'Cliente no encontrado'
-                        }, status=404)
-                else:
-                    # Admin puede ver todas las ventas o filtrar por cliente
-                    ventas_query = Venta.objects.all()
-                    if cliente_id:
-                        try:
-                            cliente = Cliente.objects.get(id=cliente_id)
-                            ventas_query = ventas_query.filter(cliente=cliente)
-                        except Cliente.DoesNotExist:
-                            pass
-            except Usuario.DoesNotExist:
+            usuario = request.usuario
+            if not usuario:
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
                 }, status=404)
             
+            # Si es cliente, solo puede ver sus propias ventas
+            if es_cliente(usuario):
+                cliente = cliente_de(usuario)
+                if cliente is None:
+                    return JsonResponse({
+                        'success': False,
+                        'message': 'Cliente no encontrado'
+                    }, status=404)
+                ventas_query = Venta.objects.filter(cliente=cliente)
+            else:
+                # Admin puede ver todas las ventas o filtrar por cliente
+                ventas_query = Venta.objects.all()
+                if cliente_id:
+                    try:
+                        cliente = Cliente.objects.get(id=cliente_id)
+                        ventas_query = ventas_query.filter(cliente=cliente)
+                    except Cliente.DoesNotExist:
+                        pass
+            
             # Aplicar filtros
             if fecha_desde:
                 try:
@@ -120,12 +223,10 @@ class HistorialVentasView(View):
                 ).distinct()
             
             # Ordenar por fecha descendente
-            ventas_query = ventas_query.select_related('cliente', 'cliente__id').prefetch_related(
-                'detalles', 'detalles__producto'
-            ).order_by('-fecha_venta')
+            ventas_query = ventas_query.order_by('-fecha_venta')
             
             # Paginación
-            paginator = Paginator(ventas_query, page_size)
+            paginator = Paginator(consulta_historial(ventas_query, campos), page_size)
             total_pages = paginator.num_pages
             total_ventas = paginator.count
             
@@ -134,44 +235,8 @@ class HistorialVentasView(View):
             
             ventas_page = paginator.get_page(page)
             
-            # Serializar ventas
-            ventas_data = []
-            for venta in ventas_page:
-                detalles = venta.detalles.all()
-                ventas_data.append({
-                    'id': venta.id_venta,
-                    'cliente': {
-                        'id': venta.cliente.id.id,
-                        'nombre': f"{venta.cliente.id.nombre} {venta.cliente.id.apellido or ''}".strip(),
-                        'email': venta.cliente.id.email
-                    },
-                    'fecha': venta.fecha_venta.isoformat(),
-                    'total': float(venta.total),
-                    'estado': venta.estado,
-                    'metodo_pago': venta.metodo_pago,
-                    'direccion_entrega': venta.direccion_entrega,
-                    'productos_count': detalles.count(),
-                    'productos': [
-                        {
-                            'id': detalle.producto.id if detalle.producto else detalle.producto_id,
-                            'nombre': detalle.producto.nombre if detalle.producto else f"Producto #{detalle.producto_id}",
-                            'cantidad': detalle.cantidad,
-                            'precio_unitario': float(detalle.precio_unitario),
-                            'subtotal': float(detalle.subtotal)
-                        }
-                        for detalle in detalles
-                    ],
-                    'comprobante': {
-                        'existe': hasattr(venta, 'comprobante'),
-                        'numero': venta.comprobante.nro if hasattr(venta, 'comprobante') else None,
-                        'pdf_url': f'/api/ventas/comprobantes/{venta.id_venta}/pdf/' if hasattr(venta, 'comprobante') else None
-                    } if hasattr(venta, 'comprobante') else None,
-                    'pago_online': {
-                        'existe': hasattr(venta, 'pago_online'),
-                        'estado': venta.pago_online.estado if hasattr(venta, 'pago_online') else None,
-                        'referencia': venta.pago_online.referencia if hasattr(venta, 'pago_online') else None
-                    } if hasattr(venta, 'pago_online') else None
-                })
+            # Serializar ventas (solo las claves pedidas)
+            ventas_data = [serializar_venta(venta, campos) for venta in ventas_page]
             
             # Calcular estadísticas
             estadisticas = {
@@ -225,15 +290,13 @@ class HistorialFiltrosView(View):
                     'message': 'Debe iniciar sesión'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-                is_admin = usuario.id_rol.nombre.lower() == 'administrador'
-            except Usuario.DoesNotExist:
+            usuario = request.usuario
+            if not usuario:
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
                 }, status=404)
+            is_admin = es_admin(usuario)
             
             response_data = {
                 'success': True,
@@ -316,10 +379,7 @@ class HistorialAgregadoView(View):
                     'message': 'Debe iniciar sesión'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            usuario = Usuario.objects.get(id=user_id)
-            
-            if usuario.id_rol.nombre.lower() != 'administrador':
+            if not es_admin(request.usuario):
                 return JsonResponse({
                     'success': False,
                     'message': 'Solo administradores pueden ver historial agregado'
@@ -399,10 +459,8 @@ class SincronizarHistorialView(View):
                     'message': 'Debe iniciar sesión'
                 }, status=401)
             
-            user_id = request.session.get('user_id')
-            usuario = Usuario.objects.get(id=user_id)
-            
-            if usuario.id_rol.nombre.lower() != 'administrador':
+            usuario = request.usuario
+            if not es_admin(usuario):
                 return JsonResponse({
                     'success': False,
                     'message': 'Solo administradores pueden sincronizar historial'
@@ -490,24 +548,14 @@ class DashboardStatsView(View):
                     'message': 'Sesión inválida. Por favor, inicie sesión nuevamente.'
                 }, status=401)
             
-            try:
-                usuario = Usuario.objects.select_related('id_rol').get(id=user_id)
-                rol_nombre = usuario.id_rol.nombre.lower() if usuario.id_rol else None
-                is_admin = rol_nombre == 'administrador'
-            except Usuario.DoesNotExist:
+            if not request.usuario:
                 logger.error(f"DashboardStatsView: Usuario con id {user_id} no encontrado")
                 return JsonResponse({
                     'success': False,
                     'message': 'Usuario no encontrado'
                 }, status=404)
-            except Exception as e:
-                logger.error(f"DashboardStatsView: Error al obtener usuario: {str(e)}")
-                return JsonResponse({
-                    'success': False,
-                    'message': f'Error al verificar usuario: {str(e)}'
-                }, status=500)
             
-            if not is_admin:
+            if not es_admin(request.usuario):
                 return JsonResponse({
                     'success': False,
                     'message': 'Solo administradores pueden ver estadísticas del dashboard'
@@ -593,24 +641,15 @@ class DashboardStatsView(View):
                     logger.warning(f"Error procesando venta {venta.id_venta}: {str(e)}")
                     continue
             
-            # Productos más vendidos (top 4)
-            productos_top = DetalleVenta.objects.filter(
-                producto__isnull=False
-            ).values(
-                'producto__nombre', 'producto__precio'
-            ).annotate(
-                total_vendido=Sum('cantidad'),
-                monto_total=Sum('subtotal')
-            ).order_by('-total_vendido')[:4]
-            
-            top_products_data = []
-            for prod in productos_top:
-                if prod.get('producto__nombre'):
-                    top_products_data.append({
-                        'name': prod['producto__nombre'],
-                        'sales': prod.get('total_vendido', 0),
-                        'revenue': float(prod.get('monto_total') or 0)
-                    })
+            # Productos más vendidos (top 4): contadores precalculados, sin agrupar DetalleVenta
+            top_products_data = [
+                {
+                    'name': contador.producto.nombre,
+                    'sales': contador.unidades_vendidas,
+                    'revenue': float(contador.ingresos or 0)
+                }
+                for contador in mas_vendidos(4)
+            ]
             
             # Ventas mensuales para gráfico (últimos 12 meses)
             ventas_mensuales = []
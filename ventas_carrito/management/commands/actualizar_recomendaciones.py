@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ventas_carrito.recomendaciones import TAMANO_LOTE, actualizar_recomendaciones, reconstruir_recomendaciones
+
+
+class Command(BaseCommand):
+    help = 'Suma las ventas completadas nuevas a las recomendaciones "comprados juntos" (CU10)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--completo', action='store_true',
+                            help='Descartar las tablas y reprocesar todas las ventas completadas')
+        parser.add_argument('--lote', type=int, default=TAMANO_LOTE,
+                            help='Ventas por transacción')
+
+    def handle(self, *args, **options):
+        inicio = time.perf_counter()
+        if options['completo']:
+            resumen = reconstruir_recomendaciones(options['lote'])
+        else:
+            resumen = actualizar_recomendaciones(options['lote'])
+        segundos = time.perf_counter() - inicio
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Ventas procesadas: {resumen['ventas']} | Pares actualizados: {resumen['pares']} | "
+            f"Productos recalculados: {resumen['productos']} | {segundos:.2f} s"
+        ))
@@ -0,0 +1,158 @@
+import time
+from datetime import timedelta
+
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from productos.inventario import liberar_referencias
+from ventas_carrito.almacen_carrito import referencia_carrito
+from ventas_carrito.models import Carrito, ItemCarrito
+
+
+class Command(BaseCommand):
+    help = (
+        'Elimina en lotes los carritos de visitantes abandonados (con sus items) y las sesiones '
+        'vencidas (CU8/CU9). Cada lote es una transacción corta, así que se puede programar y '
+        'correr con el sistema en uso'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dias', type=int, default=30,
+                            help='Días sin cambios ni items agregados tras los que un carrito de visitante se considera '
+                                 'abandonado (los de sesiones vencidas o inexistentes se eliminan siempre)')
+        parser.add_argument('--lote', type=int, default=500,
+                            help='Carritos o sesiones por transacción')
+        parser.add_argument('--pausa', type=float, default=0.0,
+                            help='Segundos de espera entre lotes (para no competir con el tráfico)')
+        parser.add_argument('--simular', '--dry-run', dest='simular', action='store_true',
+                            help='Solo contar lo que se eliminaría y estimar el espacio, sin borrar')
+        parser.add_argument('--sin-sesiones', action='store_true',
+                            help='No eliminar las sesiones vencidas')
+
+    def handle(self, *args, **options):
+        if options['dias'] < 0 or options['lote'] < 1 or options['pausa'] < 0:
+            raise CommandError('Parámetros inválidos')
+
+        ahora = timezone.now()
+        carritos = self._carritos_abandonados(ahora, options['dias'])
+        sesiones = None if options['sin_sesiones'] else Session.objects.filter(expire_date__lt=ahora)
+
+        if options['simular']:
+            self._simular(carritos, sesiones)
+            return
+
+        inicio = time.perf_counter()
+        total_carritos, total_items = self._purgar_carritos(carritos, options)
+        total_sesiones = self._purgar_sesiones(sesiones, options) if sesiones is not None else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Eliminados: {total_carritos} carritos, {total_items} items, {total_sesiones} sesiones '
+            f'| {time.perf_counter() - inicio:.2f} s'
+        ))
+
+    @staticmethod
+    def _carritos_abandonados(ahora, dias):
+        """
+        Carritos sin cliente cuya sesión venció (o ya no existe) o sin actividad
+        desde hace `dias` días: ni cambios en el carrito ni items agregados
+        (las escrituras de items renuevan fecha_actualizacion desde
+        almacen_carrito, pero los carritos anteriores solo tienen la fecha del item).
+        """
+        limite = ahora - timedelta(days=dias)
+        sesion_vigente = Session.objects.filter(session_key=OuterRef('session_key'), expire_date__gte=ahora)
+        item_reciente = ItemCarrito.objects.filter(carrito=OuterRef('pk'), fecha_adicion__gte=limite)
+        return Carrito.objects.filter(
+            (Q(fecha_actualizacion__lt=limite) & ~Exists(item_reciente)) | ~Exists(sesion_vigente),
+            cliente__isnull=True,
+        )
+
+    # ==========================================================
+    # BORRADO POR LOTES
+    # ==========================================================
+
+    def _purgar_carritos(self, carritos, options):
+        total_carritos = total_items = lote = 0
+        while True:
+            with transaction.atomic():
+                # SKIP LOCKED: un carrito que se está usando (fusión, checkout) queda para otra corrida
+                ids = list(
+                    carritos.select_for_update(skip_locked=True).order_by('pk')
+                    .values_list('pk', flat=True)[:options['lote']]
+                )
+                if not ids:
+                    break
+                # Sus reservas de stock se sueltan ya, sin esperar a que venzan
+                liberar_referencias(referencia_carrito(pk) for pk in ids)
+                items, _ = ItemCarrito.objects.filter(carrito_id__in=ids).delete()
+                Carrito.objects.filter(pk__in=ids).delete()
+            lote += 1
+            total_carritos += len(ids)
+            total_items += items
+            self.stdout.write(f'Carritos, lote {lote}: {len(ids)} carritos y {items} items (acumulado {total_carritos})')
+            if len(ids) < options['lote']:
+                break
+            time.sleep(options['pausa'])
+        return total_carritos, total_items
+
+    def _purgar_sesiones(self, sesiones, options):
+        total = lote = 0
+        while True:
+            with transaction.atomic():
+                claves = list(sesiones.order_by('expire_date').values_list('session_key', flat=True)[:options['lote']])
+                if not claves:
+                    break
+                borradas, _ = Session.objects.filter(session_key__in=claves, expire_date__lt=timezone.now()).delete()
+            lote += 1
+            total += borradas
+            self.stdout.write(f'Sesiones, lote {lote}: {borradas} (acumulado {total})')
+            if len(claves) < options['lote']:
+                break
+            time.sleep(options['pausa'])
+        return total
+
+    # ==========================================================
+    # SIMULACIÓN
+    # ==========================================================
+
+    def _simular(self, carritos, sesiones):
+        cantidades = [
+            ('Carritos', Carrito, carritos.count()),
+            ('Items de carrito', ItemCarrito, ItemCarrito.objects.filter(carrito__in=carritos).count()),
+        ]
+        if sesiones is not None:
+            cantidades.append(('Sesiones vencidas', Session, sesiones.count()))
+
+        total_bytes = 0
+        for nombre, modelo, filas in cantidades:
+            estimado = self._bytes_estimados(modelo, filas)
+            total_bytes += estimado or 0
+            tamano = f' (~{self._legible(estimado)} con índices)' if estimado is not None else ''
+            self.stdout.write(f'{nombre} a eliminar: {filas}{tamano}')
+        self.stdout.write(self.style.WARNING(
+            f'Simulación: no se eliminó nada. Espacio estimado a liberar: ~{self._legible(total_bytes)}'
+        ))
+
+    @staticmethod
+    def _bytes_estimados(modelo, filas):
+        """Tamaño de la tabla (con índices) por fila según las estadísticas de PostgreSQL, por `filas`"""
+        if not filas or connection.vendor != 'postgresql':
+            return 0 if not filas else None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_total_relation_size(c.oid), c.reltuples FROM pg_class c WHERE c.oid = %s::regclass',
+                [modelo._meta.db_table],
+            )
+            total, tuplas = cursor.fetchone()
+        if tuplas <= 0:  # Tabla sin ANALYZE: se cuenta
+            tuplas = modelo.objects.count()
+        return int(total / max(tuplas, 1) * filas)
+
+    @staticmethod
+    def _legible(cantidad):
+        for unidad in ('B', 'KB', 'MB', 'GB'):
+            if cantidad < 1024:
+                return f'{cantidad:.0f} {unidad}'
+            cantidad /= 1024
+        return f'{cantidad:.1f} TB'
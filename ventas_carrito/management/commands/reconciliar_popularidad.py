@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ventas_carrito.popularidad import reconciliar_popularidad
+
+
+class Command(BaseCommand):
+    help = 'Recalcula los contadores de popularidad desde las ventas completadas y corrige diferencias (CU10)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verificar', action='store_true',
+                            help='Solo informar las diferencias, sin corregirlas')
+        parser.add_argument('--detalle', type=int, default=20,
+                            help='Cantidad máxima de diferencias a listar')
+
+    def handle(self, *args, **options):
+        inicio = time.perf_counter()
+        resumen = reconciliar_popularidad(aplicar=not options['verificar'])
+        segundos = time.perf_counter() - inicio
+
+        for diferencia in resumen['diferencias'][:options['detalle']]:
+            self.stdout.write(
+                f"Producto {diferencia['producto_id']}: actual {diferencia['actual']} -> "
+                f"esperado {diferencia['esperado']} (unidades, ingresos, ventas)"
+            )
+
+        accion = 'a corregir' if options['verificar'] else 'corregidos'
+        mensaje = (
+            f"Productos con ventas: {resumen['productos']} | Contadores {accion}: {resumen['corregidos']} | "
+            f"Sin ventas (sobrantes): {resumen['eliminados']} | {segundos:.2f} s"
+        )
+        if options['verificar'] and (resumen['corregidos'] or resumen['eliminados']):
+            self.stdout.write(self.style.WARNING(mensaje))
+        else:
+            self.stdout.write(self.style.SUCCESS(mensaje))
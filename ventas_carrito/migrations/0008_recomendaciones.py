@@ -0,0 +1,60 @@
+# Tablas precalculadas de "comprados juntos" (ver ventas_carrito/recomendaciones.py)
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productos', '0007_stock_libro_movimientos'),
+        ('ventas_carrito', '0007_add_stripe_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VentaRecomendacion',
+            fields=[
+                ('venta', models.OneToOneField(db_column='id_venta', on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='recomendacion', serialize=False, to='ventas_carrito.venta')),
+                ('fecha_proceso', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Venta procesada para recomendaciones',
+                'verbose_name_plural': 'Ventas procesadas para recomendaciones',
+                'db_table': 'venta_recomendacion',
+            },
+        ),
+        migrations.CreateModel(
+            name='CoocurrenciaProducto',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('veces', models.PositiveIntegerField(default=0)),
+                ('producto', models.ForeignKey(db_column='id_producto', on_delete=django.db.models.deletion.CASCADE, related_name='+', to='productos.producto')),
+                ('relacionado', models.ForeignKey(db_column='id_relacionado', on_delete=django.db.models.deletion.CASCADE, related_name='+', to='productos.producto')),
+            ],
+            options={
+                'verbose_name': 'Coocurrencia de Productos',
+                'verbose_name_plural': 'Coocurrencias de Productos',
+                'db_table': 'coocurrencia_producto',
+                'indexes': [models.Index(fields=['producto', '-veces'], name='coocurrencia_producto_veces')],
+                'constraints': [models.UniqueConstraint(fields=('producto', 'relacionado'), name='coocurrencia_par_unico')],
+            },
+        ),
+        migrations.CreateModel(
+            name='RecomendacionProducto',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('veces', models.PositiveIntegerField()),
+                ('posicion', models.PositiveSmallIntegerField()),
+                ('producto', models.ForeignKey(db_column='id_producto', on_delete=django.db.models.deletion.CASCADE, related_name='+', to='productos.producto')),
+                ('relacionado', models.ForeignKey(db_column='id_relacionado', on_delete=django.db.models.deletion.CASCADE, related_name='+', to='productos.producto')),
+            ],
+            options={
+                'verbose_name': 'Recomendación de Producto',
+                'verbose_name_plural': 'Recomendaciones de Productos',
+                'db_table': 'recomendacion_producto',
+                'ordering': ['producto', 'posicion'],
+                'constraints': [models.UniqueConstraint(fields=('producto', 'posicion'), name='recomendacion_posicion_unica')],
+            },
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Contadores de popularidad por producto
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+
+
+def contadores_iniciales(apps, schema_editor):
+    DetalleVenta = apps.get_model('ventas_carrito', 'DetalleVenta')
+    PopularidadProducto = apps.get_model('ventas_carrito', 'PopularidadProducto')
+    filas = (
+        DetalleVenta.objects.filter(venta__estado='completada', producto__isnull=False)
+        .values('producto_id')
+        .annotate(
+            unidades=Sum('cantidad'),
+            ingresos=Sum('subtotal'),
+            pedidos=Count('venta', distinct=True),
+            ultima=Max('venta__fecha_venta'),
+        )
+        .order_by()
+    )
+    PopularidadProducto.objects.bulk_create(
+        (
+            PopularidadProducto(
+                producto_id=fila['producto_id'], unidades_vendidas=fila['unidades'],
+                ingresos=fila['ingresos'] or 0, pedidos=fila['pedidos'], ultima_venta=fila['ultima'],
+            )
+            for fila in filas.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productos', '0009_categoria_jerarquia'),
+        ('ventas_carrito', '0008_recomendaciones'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopularidadProducto',
+            fields=[
+                ('producto', models.OneToOneField(db_column='id_producto', on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='popularidad', serialize=False, to='productos.producto')),
+                ('unidades_vendidas', models.PositiveIntegerField(default=0)),
+                ('ingresos', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('pedidos', models.PositiveIntegerField(default=0)),
+                ('ultima_venta', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Popularidad de Producto',
+                'verbose_name_plural': 'Popularidad de Productos',
+                'db_table': 'popularidad_producto',
+                'indexes': [models.Index(fields=['-unidades_vendidas'], name='popularidad_unidades_idx')],
+            },
+        ),
+        migrations.RunPython(contadores_iniciales, migrations.RunPython.noop),
+    ]
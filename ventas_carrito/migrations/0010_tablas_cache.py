@@ -0,0 +1,23 @@
+# Tablas de las cachés en la BD (carritos anónimos, compartida, revocados)
+#
+# Sin REDIS_URL esas cachés usan DatabaseCache; crear sus tablas aquí evita un
+# paso extra de despliegue (`manage.py createcachetable`). Las tablas que ya
+# existen se dejan como están y, con Redis, no se crea ninguna.
+
+from django.core.management import call_command
+from django.db import migrations
+
+
+def crear_tablas_cache(apps, schema_editor):
+    call_command('createcachetable', database=schema_editor.connection.alias, verbosity=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ventas_carrito', '0009_popularidad_producto'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_tablas_cache, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,5 @@
+from decimal import Decimal
+
 from django.db import models
 from django.conf import settings
 from productos.models import Producto
@@ -21,12 +23,22 @@ class Carrito(models.Model):
             return f"Carrito de {self.cliente.id.nombre}"
         return f"Carrito (sesión: {self.session_key[:5]}...)"
 
+    def get_totales(self):
+        """(unidades, total) del carrito con una sola consulta agregada"""
+        totales = self.items.aggregate(
+            total_items=models.Sum('cantidad'),
+            total_precio=models.Sum(
+                models.F('cantidad') * models.F('precio_unitario'),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2),
+            ),
+        )
+        return totales['total_items'] or 0, totales['total_precio'] or Decimal('0')
+
     def get_total_items(self):
-        return self.items.aggregate(total_cantidad=models.Sum('cantidad'))['total_cantidad'] or 0
+        return self.get_totales()[0]
 
     def get_total_precio(self):
-        total = sum(item.get_subtotal() for item in self.items.all())
-        return total
+        return self.get_totales()[1]
 
 class ItemCarrito(models.Model):
     id_item = models.AutoField(primary_key=True)
@@ -187,4 +199,86 @@ class VentaHistorico(models.Model):
     
     def __str__(self):
         cat = self.categoria.nombre if self.categoria else "General"
-        return f"Historial {self.fecha} - {cat} - {self.ventas_count} ventas - ${self.monto_total}"
\ No newline at end of file
+        return f"Historial {self.fecha} - {cat} - {self.ventas_count} ventas - ${self.monto_total}"
+
+# ==========================================================
+# RECOMENDACIONES: "COMPRADOS JUNTOS" (ver recomendaciones.py)
+# ==========================================================
+
+class CoocurrenciaProducto(models.Model):
+    """Cantidad de ventas completadas que incluyen a ambos productos (un registro por sentido)"""
+    id = models.BigAutoField(primary_key=True)
+    producto = models.ForeignKey(Producto, related_name='+', on_delete=models.CASCADE, db_column='id_producto')
+    relacionado = models.ForeignKey(Producto, related_name='+', on_delete=models.CASCADE, db_column='id_relacionado')
+    veces = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        db_table = 'coocurrencia_producto'
+        verbose_name = 'Coocurrencia de Productos'
+        verbose_name_plural = 'Coocurrencias de Productos'
+        constraints = [
+            models.UniqueConstraint(fields=['producto', 'relacionado'], name='coocurrencia_par_unico'),
+        ]
+        indexes = [
+            models.Index(fields=['producto', '-veces'], name='coocurrencia_producto_veces'),
+        ]
+
+    def __str__(self):
+        return f"{self.producto_id} + {self.relacionado_id}: {self.veces}"
+
+
+class RecomendacionProducto(models.Model):
+    """Top-K de productos comprados junto a cada producto (se lee con una consulta indexada)"""
+    id = models.BigAutoField(primary_key=True)
+    producto = models.ForeignKey(Producto, related_name='+', on_delete=models.CASCADE, db_column='id_producto')
+    relacionado = models.ForeignKey(Producto, related_name='+', on_delete=models.CASCADE, db_column='id_relacionado')
+    veces = models.PositiveIntegerField()
+    posicion = models.PositiveSmallIntegerField()
+
+    class Meta:
+        db_table = 'recomendacion_producto'
+        verbose_name = 'Recomendación de Producto'
+        verbose_name_plural = 'Recomendaciones de Productos'
+        ordering = ['producto', 'posicion']
+        constraints = [
+            models.UniqueConstraint(fields=['producto', 'posicion'], name='recomendacion_posicion_unica'),
+        ]
+
+    def __str__(self):
+        return f"{self.producto_id} -> {self.relacionado_id} (#{self.posicion})"
+
+
+class VentaRecomendacion(models.Model):
+    """Ventas completadas ya sumadas a las coocurrencias (procesamiento incremental)"""
+    venta = models.OneToOneField(Venta, primary_key=True, related_name='recomendacion',
+                                 on_delete=models.CASCADE, db_column='id_venta')
+    fecha_proceso = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'venta_recomendacion'
+        verbose_name = 'Venta procesada para recomendaciones'
+        verbose_name_plural = 'Ventas procesadas para recomendaciones'
+
+    def __str__(self):
+        return f"Venta #{self.venta_id} procesada"
+
+
+class PopularidadProducto(models.Model):
+    """Contadores de ventas completadas por producto (se incrementan al completar cada venta)"""
+    producto = models.OneToOneField(Producto, primary_key=True, related_name='popularidad',
+                                    on_delete=models.CASCADE, db_column='id_producto')
+    unidades_vendidas = models.PositiveIntegerField(default=0)
+    ingresos = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    pedidos = models.PositiveIntegerField(default=0)
+    ultima_venta = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'popularidad_producto'
+        verbose_name = 'Popularidad de Producto'
+        verbose_name_plural = 'Popularidad de Productos'
+        indexes = [
+            models.Index(fields=['-unidades_vendidas'], name='popularidad_unidades_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.producto_id}: {self.unidades_vendidas} u. en {self.pedidos} ventas"
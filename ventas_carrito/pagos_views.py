@@ -6,6 +6,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.utils import timezone
+from django.db import transaction
 import json
 import hashlib
 import secrets
@@ -13,7 +14,11 @@ import logging
 from datetime import datetime
 
 from .models import Venta, PagoOnline, MetodoPago
-from autenticacion_usuarios.models import Usuario, Cliente, Bitacora
+from .recomendaciones import programar_actualizacion
+from .popularidad import registrar_venta
+from productos.inventario import descontar_stock, liberar_stock, movimientos_de_venta
+from autenticacion_usuarios.models import Bitacora
+from autenticacion_usuarios.contexto import cliente_de
 
 logger = logging.getLogger(__name__)
 
@@ -94,21 +99,18 @@ class PagoOnlineView(View):
                 }, status=404)
             
             # Verificar que la venta pertenezca al cliente autenticado
-            user_id = request.session.get('user_id')
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-                cliente = Cliente.objects.get(id=usuario)
-                
-                if venta.cliente != cliente:
-                    return JsonResponse({
-                        'success': False,
-                        'message': 'No tiene permiso para pagar esta venta'
-                    }, status=403)
-            except (Usuario.DoesNotExist, Cliente.DoesNotExist):
+            usuario = request.usuario
+            cliente = cliente_de(usuario)
+            if cliente is None:
                 return JsonResponse({
                     'success': False,
                     'message': 'Cliente no encontrado'
                 }, status=404)
+            if venta.cliente_id != cliente.pk:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'No tiene permiso para pagar esta venta'
+                }, status=403)
             
             # Verificar que la venta esté pendiente
             if venta.estado != 'pendiente':
@@ -142,20 +144,32 @@ class PagoOnlineView(View):
             ultimos_4 = numero_tarjeta[-4:]
             hash_tarjeta = hashlib.sha256(f"{numero_tarjeta}{secrets.token_hex(8)}".encode()).hexdigest()
             
-            pago_online = PagoOnline.objects.create(
-                venta=venta,
-                monto=venta.total,
-                estado=resultado_pago['estado'],
-                referencia=referencia,
-                metodo_pago=metodo_pago,
-                datos_tarjeta_hash=hash_tarjeta
-            )
-            
-            # Si el pago fue exitoso, actualizar estado de la venta
-            if resultado_pago['estado'] == 'exitoso':
-                venta.estado = 'completada'
-                venta.metodo_pago = 'tarjeta_credito'
-                venta.save()
+            with transaction.atomic():
+                pago_online = PagoOnline.objects.create(
+                    venta=venta,
+                    monto=venta.total,
+                    estado=resultado_pago['estado'],
+                    referencia=referencia,
+                    metodo_pago=metodo_pago,
+                    datos_tarjeta_hash=hash_tarjeta
+                )
+                
+                # Si el pago fue exitoso, actualizar estado de la venta y sus contadores;
+                # el stock reservado para la venta se descuenta
+                if resultado_pago['estado'] == 'exitoso':
+                    venta.estado = 'completada'
+                    venta.metodo_pago = 'tarjeta_credito'
+                    venta.save()
+                    registrar_venta(venta.id_venta)
+                    programar_actualizacion()
+                    if not movimientos_de_venta(venta.id_venta).exists():
+                        descontar_stock(
+                            [(d.producto_id, d.cantidad) for d in venta.detalles.all() if d.producto_id],
+                            referencia=f'venta:{venta.id_venta}', permitir_faltante=True,
+                            reserva=f'venta:{venta.id_venta}'
+                        )
+                elif resultado_pago['estado'] == 'fallido':
+                    liberar_stock(f'venta:{venta.id_venta}')
             
             # Registrar en bitácora
             Bitacora.objects.create(
@@ -300,19 +314,12 @@ class EstadoPagoView(View):
             pago = PagoOnline.objects.get(id_pago=pago_id)
             
             # Verificar permisos
-            if request.session.get('is_authenticated'):
-                user_id = request.session.get('user_id')
-                try:
-                    usuario = Usuario.objects.get(id=user_id)
-                    cliente = Cliente.objects.get(id=usuario)
-                    
-                    if pago.venta.cliente != cliente:
-                        return JsonResponse({
-                            'success': False,
-                            'message': 'No tiene permiso para ver este pago'
-                        }, status=403)
-                except:
-                    pass
+            cliente = cliente_de(request.usuario)
+            if cliente is not None and pago.venta.cliente_id != cliente.pk:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'No tiene permiso para ver este pago'
+                }, status=403)
             
             return JsonResponse({
                 'success': True,
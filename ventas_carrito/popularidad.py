@@ -0,0 +1,137 @@
+"""
+CU10: Contadores de popularidad por producto
+
+PopularidadProducto guarda por producto las unidades vendidas, los ingresos,
+la cantidad de ventas y la fecha de la última venta. Se incrementan en la
+misma transacción que completa la venta (checkout, pago en línea y
+verificación de Stripe) con INSERT ... ON CONFLICT DO UPDATE: la suma se hace
+en la BD, así que ventas simultáneas del mismo producto no pierden incrementos.
+
+Los listados de "más vendidos" leen esta tabla (una fila por producto) en
+lugar de agrupar todo DetalleVenta. `reconciliar_popularidad` la recalcula
+desde las ventas completadas para corregir desvíos (ventas anuladas o
+editadas a mano).
+"""
+from django.db import connection, transaction
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from productos.cache_catalogo import invalidar_catalogo
+from .models import DetalleVenta, PopularidadProducto
+
+
+# ==========================================================
+# INCREMENTO AL COMPLETAR UNA VENTA
+# ==========================================================
+
+def _sumar(filas):
+    """Sumar [(producto_id, unidades, ingresos, pedidos, fecha)] a los contadores"""
+    if not filas:
+        return
+    tabla = PopularidadProducto._meta.db_table
+    # Orden por producto: dos ventas simultáneas toman los bloqueos en el mismo orden
+    filas = sorted(filas)
+    valores = ', '.join(['(%s, %s, %s, %s, %s)'] * len(filas))
+    parametros = [valor for fila in filas for valor in fila]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {tabla} (id_producto, unidades_vendidas, ingresos, pedidos, ultima_venta) '
+            f'VALUES {valores} '
+            f'ON CONFLICT (id_producto) DO UPDATE SET '
+            f'unidades_vendidas = {tabla}.unidades_vendidas + EXCLUDED.unidades_vendidas, '
+            f'ingresos = {tabla}.ingresos + EXCLUDED.ingresos, '
+            f'pedidos = {tabla}.pedidos + EXCLUDED.pedidos, '
+            f'ultima_venta = GREATEST({tabla}.ultima_venta, EXCLUDED.ultima_venta)',
+            parametros,
+        )
+
+
+def registrar_venta(venta_id):
+    """
+    Sumar los detalles de la venta a los contadores. Debe llamarse una sola vez
+    por venta, dentro de la transacción que la marca como completada.
+    """
+    ahora = timezone.now()
+    detalles = (
+        DetalleVenta.objects.filter(venta_id=venta_id, producto__isnull=False)
+        .values('producto_id')
+        .annotate(unidades=Sum('cantidad'), ingresos=Sum('subtotal'))
+        .order_by()
+    )
+    _sumar([
+        (fila['producto_id'], fila['unidades'], fila['ingresos'] or 0, 1, ahora)
+        for fila in detalles
+    ])
+    invalidar_catalogo()  # El orden por popularidad del catálogo cambia
+
+
+# ==========================================================
+# RECONCILIACIÓN
+# ==========================================================
+
+def reconciliar_popularidad(aplicar=True):
+    """
+    Recalcular los contadores desde las ventas completadas y corregir los que
+    difieran. Devuelve {'productos', 'corregidos', 'eliminados', 'diferencias'}.
+    """
+    esperados = {
+        fila['producto_id']: fila
+        for fila in DetalleVenta.objects.filter(venta__estado='completada', producto__isnull=False)
+        .values('producto_id')
+        .annotate(
+            unidades=Sum('cantidad'),
+            ingresos=Sum('subtotal'),
+            pedidos=Count('venta', distinct=True),
+            ultima=Max('venta__fecha_venta'),
+        )
+        .order_by()
+    }
+    actuales = {p.producto_id: p for p in PopularidadProducto.objects.all()}
+
+    corregir, diferencias = [], []
+    for producto_id, fila in esperados.items():
+        actual = actuales.get(producto_id)
+        valores = (fila['unidades'], fila['ingresos'] or 0, fila['pedidos'])
+        if actual is not None and (actual.unidades_vendidas, actual.ingresos, actual.pedidos) == valores:
+            continue
+        diferencias.append({
+            'producto_id': producto_id,
+            'actual': (actual.unidades_vendidas, actual.ingresos, actual.pedidos) if actual else None,
+            'esperado': valores,
+        })
+        corregir.append(PopularidadProducto(
+            producto_id=producto_id, unidades_vendidas=valores[0], ingresos=valores[1],
+            pedidos=valores[2], ultima_venta=fila['ultima'],
+        ))
+    sobrantes = [pid for pid in actuales if pid not in esperados]
+
+    if aplicar and (corregir or sobrantes):
+        with transaction.atomic():
+            PopularidadProducto.objects.bulk_create(
+                corregir,
+                update_conflicts=True,
+                unique_fields=['producto'],
+                update_fields=['unidades_vendidas', 'ingresos', 'pedidos', 'ultima_venta'],
+                batch_size=1000,
+            )
+            PopularidadProducto.objects.filter(producto_id__in=sobrantes).delete()
+            invalidar_catalogo()
+
+    return {
+        'productos': len(esperados),
+        'corregidos': len(corregir),
+        'eliminados': len(sobrantes),
+        'diferencias': diferencias,
+    }
+
+
+# ==========================================================
+# LECTURA
+# ==========================================================
+
+def mas_vendidos(limite=10, productos=None):
+    """Contadores de los productos más vendidos (opcionalmente dentro de un queryset de productos)"""
+    contadores = PopularidadProducto.objects.select_related('producto').filter(unidades_vendidas__gt=0)
+    if productos is not None:
+        contadores = contadores.filter(producto__in=productos)
+    return contadores.order_by('-unidades_vendidas', 'producto_id')[:limite]
@@ -0,0 +1,236 @@
+"""
+CU10: Recomendaciones "comprados juntos"
+
+Tablas precalculadas a partir de DetalleVenta agrupado por venta:
+- CoocurrenciaProducto: para cada par (a, b), en cuántas ventas completadas
+  aparecen ambos productos. Se actualiza de forma incremental: solo se
+  procesan las ventas completadas que aún no están en VentaRecomendacion, y
+  los conteos se suman en la BD (INSERT ... ON CONFLICT DO UPDATE).
+- RecomendacionProducto: los K relacionados más frecuentes de cada producto,
+  recalculados solo para los productos que aparecen en las ventas nuevas.
+
+Las lecturas (página de producto y carrito) son una consulta indexada sobre
+RecomendacionProducto, con costo constante sin importar cuántas ventas haya.
+"""
+import logging
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import permutations
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Sum, Window
+from django.db.models.functions import RowNumber
+
+from productos.models import Producto
+from productos.miniaturas import url_miniatura
+from productos.cache_catalogo import invalidar_datos
+from .models import Venta, DetalleVenta, CoocurrenciaProducto, RecomendacionProducto, VentaRecomendacion
+
+logger = logging.getLogger(__name__)
+
+
+TAMANO_LOTE = 500  # Ventas por transacción
+LIMITE_RECOMENDACIONES = 6
+MAX_LIMITE = 20
+PARES_POR_SENTENCIA = 1000
+
+
+def _top_k():
+    return getattr(settings, 'RECOMENDACIONES_TOP_K', 10)
+
+
+# ==========================================================
+# ACTUALIZACIÓN INCREMENTAL
+# ==========================================================
+
+def contar_pares(detalles):
+    """Contar pares (a, b) de productos distintos de cada venta: [(venta_id, producto_id)]"""
+    productos_por_venta = defaultdict(set)
+    for venta_id, producto_id in detalles:
+        productos_por_venta[venta_id].add(producto_id)
+    pares = Counter()
+    for productos in productos_por_venta.values():
+        pares.update(permutations(productos, 2))
+    return pares
+
+
+def _sumar_pares(pares):
+    """Sumar los conteos a la tabla de coocurrencias (alta o incremento en una sentencia)"""
+    tabla = CoocurrenciaProducto._meta.db_table
+    filas = list(pares.items())
+    with connection.cursor() as cursor:
+        for inicio in range(0, len(filas), PARES_POR_SENTENCIA):
+            lote = filas[inicio:inicio + PARES_POR_SENTENCIA]
+            valores = ', '.join(['(%s, %s, %s)'] * len(lote))
+            parametros = [valor for (a, b), veces in lote for valor in (a, b, veces)]
+            cursor.execute(
+                f'INSERT INTO {tabla} (id_producto, id_relacionado, veces) VALUES {valores} '
+                f'ON CONFLICT (id_producto, id_relacionado) '
+                f'DO UPDATE SET veces = {tabla}.veces + EXCLUDED.veces',
+                parametros,
+            )
+
+
+def _recalcular_top(producto_ids):
+    """Reemplazar el top-K de los productos indicados con una consulta por ventana"""
+    mejores = CoocurrenciaProducto.objects.filter(producto_id__in=producto_ids).annotate(
+        posicion=Window(
+            RowNumber(),
+            partition_by=F('producto'),
+            order_by=[F('veces').desc(), F('relacionado').asc()],
+        )
+    ).filter(posicion__lte=_top_k()).values_list('producto_id', 'relacionado_id', 'veces', 'posicion')
+
+    recomendaciones = [
+        RecomendacionProducto(producto_id=producto_id, relacionado_id=relacionado_id, veces=veces, posicion=posicion)
+        for producto_id, relacionado_id, veces, posicion in mejores
+    ]
+    RecomendacionProducto.objects.filter(producto_id__in=producto_ids).delete()
+    # Upsert por posición: tolera que otro proceso haya recalculado el mismo producto
+    RecomendacionProducto.objects.bulk_create(
+        recomendaciones,
+        update_conflicts=True,
+        unique_fields=['producto', 'posicion'],
+        update_fields=['relacionado', 'veces'],
+    )
+
+
+def actualizar_recomendaciones(lote=TAMANO_LOTE):
+    """Procesar las ventas completadas nuevas. Devuelve un resumen"""
+    resumen = {'ventas': 0, 'pares': 0, 'productos': 0}
+    while True:
+        with transaction.atomic():
+            # skip_locked: dos ejecuciones simultáneas toman ventas distintas
+            ventas = list(
+                Venta.objects.select_for_update(skip_locked=True, of=('self',))
+                .filter(estado='completada', recomendacion__isnull=True)
+                .order_by('id_venta')
+                .values_list('id_venta', flat=True)[:lote]
+            )
+            if not ventas:
+                break
+
+            detalles = DetalleVenta.objects.filter(
+                venta_id__in=ventas, producto_id__in=Producto.objects.values('pk')
+            ).values_list('venta_id', 'producto_id')
+            pares = contar_pares(detalles)
+            afectados = {a for a, _ in pares}
+
+            _sumar_pares(pares)
+            _recalcular_top(afectados)
+            VentaRecomendacion.objects.bulk_create([VentaRecomendacion(venta_id=v) for v in ventas])
+            invalidar_datos('recomendaciones')
+
+        resumen['ventas'] += len(ventas)
+        resumen['pares'] += len(pares)
+        resumen['productos'] += len(afectados)
+        if len(ventas) < lote:
+            break
+    return resumen
+
+
+def reconstruir_recomendaciones(lote=TAMANO_LOTE):
+    """Descartar las tablas y procesar todas las ventas completadas desde cero"""
+    with transaction.atomic():
+        RecomendacionProducto.objects.all().delete()
+        CoocurrenciaProducto.objects.all().delete()
+        VentaRecomendacion.objects.all().delete()
+        return actualizar_recomendaciones(lote)
+
+
+# ==========================================================
+# PROCESO EN SEGUNDO PLANO
+# ==========================================================
+
+_executor = None
+_pendiente = False
+_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='recomendaciones')
+    return _executor
+
+
+def _trabajo():
+    global _pendiente
+    with _lock:
+        _pendiente = False  # Las ventas que lleguen durante el proceso vuelven a encolar
+    try:
+        actualizar_recomendaciones()
+    except Exception as e:
+        logger.warning(f"No se pudieron actualizar las recomendaciones: {str(e)}")
+    finally:
+        connection.close()
+
+
+def _encolar():
+    global _pendiente
+    with _lock:
+        if _pendiente:
+            return
+        _pendiente = True
+        _pool().submit(_trabajo)
+
+
+def programar_actualizacion():
+    """Procesar en segundo plano las ventas completadas (al confirmar la transacción)"""
+    if getattr(settings, 'RECOMENDACIONES_AUTO', True):
+        transaction.on_commit(_encolar)
+
+
+# ==========================================================
+# LECTURA
+# ==========================================================
+
+CAMPOS_RELACIONADO = (
+    'relacionado_id',
+    'relacionado__nombre',
+    'relacionado__precio',
+    'relacionado__imagen',
+)
+
+
+def _serializar(fila, veces):
+    return {
+        'id': fila['relacionado_id'],
+        'nombre': fila['relacionado__nombre'] or '',
+        'precio': float(fila['relacionado__precio']) if fila['relacionado__precio'] else 0.0,
+        'imagen': fila['relacionado__imagen'] or '',
+        'imagen_miniatura': url_miniatura(fila['relacionado_id'], fila['relacionado__imagen']),
+        'veces': veces,
+    }
+
+
+def limite_recomendaciones(valor):
+    try:
+        return max(1, min(int(valor), MAX_LIMITE))
+    except (TypeError, ValueError):
+        return LIMITE_RECOMENDACIONES
+
+
+def recomendaciones_producto(producto_id, limite=LIMITE_RECOMENDACIONES):
+    """Productos comprados junto a `producto_id` (una consulta por índice)"""
+    filas = RecomendacionProducto.objects.filter(producto_id=producto_id).order_by('posicion').values(
+        'veces', *CAMPOS_RELACIONADO
+    )[:limite]
+    return [_serializar(fila, fila['veces']) for fila in filas]
+
+
+def recomendaciones_carrito(producto_ids, limite=LIMITE_RECOMENDACIONES):
+    """Relacionados de todos los productos del carrito, sumando su frecuencia (una consulta)"""
+    producto_ids = list(producto_ids)
+    if not producto_ids:
+        return []
+    filas = (
+        RecomendacionProducto.objects.filter(producto_id__in=producto_ids)
+        .exclude(relacionado_id__in=producto_ids)
+        .values(*CAMPOS_RELACIONADO)
+        .annotate(total=Sum('veces'))
+        .order_by('-total', 'relacionado_id')[:limite]
+    )
+    return [_serializar(fila, fila['total']) for fila in filas]
@@ -22,9 +22,15 @@ except ImportError:
     STRIPE_AVAILABLE = False
 
 from .models import Venta, PagoOnline, MetodoPago, Carrito, ItemCarrito, DetalleVenta, Comprobante
-from autenticacion_usuarios.models import Usuario, Cliente, Bitacora
-from productos.models import Stock
+from autenticacion_usuarios.models import Bitacora
+from autenticacion_usuarios.contexto import cliente_de
+from productos.inventario import (
+    descontar_stock, liberar_stock, movimientos_de_venta, reservar_stock, stock_disponible, StockInsuficiente,
+)
+from .almacen_carrito import referencia_carrito
 from .comprobantes_views import ComprobanteView
+from .recomendaciones import programar_actualizacion
+from .popularidad import registrar_venta
 
 logger = logging.getLogger(__name__)
 
@@ -111,11 +117,9 @@ class CreatePaymentIntentView(View):
                 }, status=400)
             
             # Obtener cliente autenticado
-            user_id = request.session.get('user_id')
-            try:
-                usuario = Usuario.objects.get(id=user_id)
-                cliente = Cliente.objects.get(id=usuario)
-            except (Usuario.DoesNotExist, Cliente.DoesNotExist):
+            usuario = request.usuario
+            cliente = cliente_de(usuario)
+            if cliente is None:
                 return JsonResponse({
                     'success': False,
                     'message': 'Cliente no encontrado'
@@ -148,15 +152,16 @@ class CreatePaymentIntentView(View):
             
             # Verificar stock antes de crear la venta
             productos_sin_stock = []
-            for item in items_carrito.select_related('producto'):
-                stock_obj = Stock.objects.filter(producto=item.producto).first()
-                stock_disponible = stock_obj.cantidad if stock_obj else 0
-                
-                if stock_disponible < item.cantidad:
+            items = list(items_carrito.select_related('producto'))
+            disponibles = stock_disponible(
+                (item.producto_id for item in items), referencia_carrito(carrito.id_carrito)
+            )
+            for item in items:
+                if disponibles[item.producto_id] < item.cantidad:
                     productos_sin_stock.append({
                         'producto': item.producto.nombre,
                         'solicitado': item.cantidad,
-                        'disponible': stock_disponible
+                        'disponible': disponibles[item.producto_id]
                     })
             
             if productos_sin_stock:
@@ -168,25 +173,42 @@ class CreatePaymentIntentView(View):
                     'message': mensaje
                 }, status=400)
             
-            # Crear venta y detalles en una transacción
-            with transaction.atomic():
-                venta = Venta.objects.create(
-                    cliente=cliente,
-                    total=total,
-                    estado='pendiente',
-                    metodo_pago='stripe',
-                    direccion_entrega=direccion_entrega,
-                    notas=notas
-                )
-                
-                # Crear detalles de venta
-                for item in items_carrito.select_related('producto'):
-                    DetalleVenta.objects.create(
-                        venta=venta,
-                        producto=item.producto,
-                        cantidad=item.cantidad,
-                        precio_unitario=item.precio_unitario
+            # Crear venta y detalles en una transacción; la reserva del carrito
+            # pasa a la venta y retiene el stock mientras el pago está pendiente
+            try:
+                with transaction.atomic():
+                    venta = Venta.objects.create(
+                        cliente=cliente,
+                        total=total,
+                        estado='pendiente',
+                        metodo_pago='stripe',
+                        direccion_entrega=direccion_entrega,
+                        notas=notas
+                    )
+                    
+                    # Crear detalles de venta
+                    for item in items:
+                        DetalleVenta.objects.create(
+                            venta=venta,
+                            producto=item.producto,
+                            cantidad=item.cantidad,
+                            precio_unitario=item.precio_unitario
+                        )
+                    reservar_stock(
+                        f'venta:{venta.id_venta}',
+                        {item.producto_id: item.cantidad for item in items},
+                        ttl=getattr(settings, 'RESERVA_PAGO_TTL', 30 * 60),
+                        liberar=referencia_carrito(carrito.id_carrito)
                     )
+            except StockInsuficiente as e:
+                nombres = {item.producto_id: item.producto.nombre for item in items}
+                mensaje = 'Stock insuficiente para los siguientes productos: '
+                mensaje += ', '.join([f"{nombres[p['producto_id']]} (solicitado: {p['solicitado']}, disponible: {p['disponible']})"
+                                    for p in e.faltantes])
+                return JsonResponse({
+                    'success': False,
+                    'message': mensaje
+                }, status=400)
             
             # Obtener o crear método de pago Stripe
             metodo_pago, _ = MetodoPago.objects.get_or_create(nombre='Stripe')
@@ -209,8 +231,9 @@ class CreatePaymentIntentView(View):
                 )
             except stripe.error.StripeError as e:
                 logger.error(f"Error de Stripe al crear Payment Intent: {str(e)}")
-                # Revertir la venta creada
+                # Revertir la venta creada y soltar su reserva
                 venta.delete()
+                liberar_stock(f'venta:{venta.id_venta}')
                 return JsonResponse({
                     'success': False,
                     'message': f'Error al crear sesión de pago: {str(e)}'
@@ -325,28 +348,40 @@ class VerifyPaymentIntentView(View):
                 comprobante_data = None
                 
                 with transaction.atomic():
+                    # Bloquear el pago: dos verificaciones simultáneas no descuentan dos veces
+                    pago_online = PagoOnline.objects.select_for_update().get(pk=pago_online.pk)
                     pago_online.estado = 'exitoso'
                     pago_online.save(update_fields=['estado'])
                     
-                    # Actualizar estado de la venta
+                    # Actualizar estado de la venta (los contadores se suman una sola vez)
+                    venta = Venta.objects.select_for_update().get(pk=venta.pk)
+                    ya_completada = venta.estado == 'completada'
                     venta.estado = 'completada'
                     venta.metodo_pago = 'stripe'
                     venta.save(update_fields=['estado', 'metodo_pago'])
+                    if not ya_completada:
+                        registrar_venta(venta.id_venta)
+                    programar_actualizacion()
                     
-                    # Actualizar stock
-                    for detalle in venta.detalles.all():
-                        stock_obj = Stock.objects.filter(producto=detalle.producto).first()
-                        if stock_obj:
-                            stock_obj.cantidad -= detalle.cantidad
-                            if stock_obj.cantidad < 0:
-                                stock_obj.cantidad = 0
-                            stock_obj.save()
+                    # Actualizar stock (el pago ya está cobrado: se descuenta lo que haya)
+                    if not movimientos_de_venta(venta.id_venta).exists():
+                        solicitados = [
+                            (detalle.producto_id, detalle.cantidad)
+                            for detalle in venta.detalles.all() if detalle.producto_id
+                        ]
+                        movimientos = descontar_stock(
+                            solicitados, referencia=f'venta:{venta.id_venta}', permitir_faltante=True,
+                            reserva=f'venta:{venta.id_venta}'
+                        )
+                        if sum(m.cantidad for m in movimientos) != -sum(c for _, c in solicitados):
+                            logger.error(f"Venta #{venta.id_venta} pagada con stock insuficiente (sobreventa)")
                     
                     # Limpiar carrito
                     try:
                         carrito = Carrito.objects.get(cliente=venta.cliente, activo=True)
                         carrito.items.all().delete()
                         carrito.delete()
+                        liberar_stock(referencia_carrito(carrito.id_carrito))
                     except Carrito.DoesNotExist:
                         pass
                 
@@ -381,9 +416,8 @@ class VerifyPaymentIntentView(View):
                 
                 # Registrar en bitácora
                 try:
-                    user_id = request.session.get('user_id')
-                    if user_id:
-                        usuario = Usuario.objects.get(id=user_id)
+                    usuario = request.usuario
+                    if usuario:
                         Bitacora.objects.create(
                             id_usuario=usuario,
                             accion='STRIPE_PAYMENT_SUCCEEDED',
@@ -427,6 +461,7 @@ class VerifyPaymentIntentView(View):
             else:
                 pago_online.estado = 'fallido'
                 pago_online.save(update_fields=['estado'])
+                liberar_stock(f'venta:{venta.id_venta}')
                 
                 return JsonResponse({
                     'success': False,
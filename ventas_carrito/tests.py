@@ -1,3 +1,196 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+
+from autenticacion_usuarios.models import Cliente, Rol, Usuario
+from productos.inventario import fijar_stock, reservar_stock
+from productos.models import Producto, ReservaStock, Stock
+from .almacen_carrito import (
+    COOKIE_CARRITO, CarritoAnonimo, CarritoOcupado, CarritoBD, carrito_de_cliente, fusionar_carritos, persistir_carrito_anonimo,
+)
+from .models import Carrito, ItemCarrito
+
+
+# ==========================================================
+# CARRITO ANÓNIMO
+# ==========================================================
+
+class CarritoAnonimoTests(TestCase):
+
+    def setUp(self):
+        caches['carritos'].clear()
+        self.mesa = Producto.objects.create(nombre='Mesa', precio=100)
+        self.silla = Producto.objects.create(nombre='Silla', precio=40)
+        fijar_stock({self.mesa.pk: 10, self.silla.pk: 10})
+
+    def test_dos_pestanas_no_pierden_lineas(self):
+        carrito = CarritoAnonimo()
+        carrito.fijar(self.mesa, 1)
+
+        # Las dos pestañas leen el carrito antes de que escriba la otra
+        pestana_a = CarritoAnonimo(carrito.token)
+        pestana_b = CarritoAnonimo(carrito.token)
+        pestana_a.fijar(self.silla, 4)
+        pestana_b.fijar(self.mesa, 2)
+
+        lineas = CarritoAnonimo(carrito.token).lineas
+        self.assertEqual(lineas[str(self.mesa.pk)][0], 2)
+        self.assertEqual(lineas[str(self.silla.pk)][0], 4)
+
+    def test_quitar_conserva_lo_agregado_en_otra_pestana(self):
+        carrito = CarritoAnonimo()
+        carrito.fijar(self.mesa, 1)
+        pestana_b = CarritoAnonimo(carrito.token)
+        carrito.fijar(self.silla, 3)
+
+        pestana_b.quitar(pestana_b.item(self.mesa.pk))
+
+        lineas = CarritoAnonimo(carrito.token).lineas
+        self.assertEqual({pid: cantidad for pid, (cantidad, _) in lineas.items()}, {str(self.silla.pk): 3})
+
+    def test_bloqueo_ajeno_no_se_escribe_ni_se_borra(self):
+        carrito = CarritoAnonimo()
+        carrito.fijar(self.mesa, 1)
+        bloqueo = f'carrito:anonimo:{carrito.token}:bloqueo'
+        caches['carritos'].set(bloqueo, 'otra-peticion', timeout=60)
+
+        with mock.patch('ventas_carrito.almacen_carrito.BLOQUEO_CARRITO', 0.05):
+            with self.assertRaises(CarritoOcupado):
+                carrito.quitar(carrito.item(self.mesa.pk))
+
+        self.assertEqual(caches['carritos'].get(bloqueo), 'otra-peticion')
+        self.assertIn(str(self.mesa.pk), CarritoAnonimo(carrito.token).lineas)
+
+
+# ==========================================================
+# PURGA DE CARRITOS ABANDONADOS
+# ==========================================================
+
+class PurgarCarritosTests(TestCase):
+
+    def setUp(self):
+        self.producto = Producto.objects.create(nombre='Mesa', precio=100)
+        fijar_stock({self.producto.pk: 10})
+        self.hace_40_dias = timezone.now() - timedelta(days=40)
+
+    def _carrito(self, clave):
+        Session.objects.create(session_key=clave, session_data='', expire_date=timezone.now() + timedelta(days=1))
+        carrito = CarritoBD(Carrito.objects.create(session_key=clave))
+        carrito.fijar(self.producto, 2)
+        return carrito
+
+    def test_item_reciente_conserva_el_carrito(self):
+        carrito = self._carrito('reciente')
+        Carrito.objects.filter(pk=carrito.id_carrito).update(fecha_actualizacion=self.hace_40_dias)
+
+        call_command('purgar_carritos', stdout=StringIO())
+        self.assertTrue(Carrito.objects.filter(pk=carrito.id_carrito).exists())
+
+    def test_carrito_abandonado_libera_su_reserva(self):
+        carrito = self._carrito('abandonado')
+        ItemCarrito.objects.filter(carrito_id=carrito.id_carrito).update(fecha_adicion=self.hace_40_dias)
+        Carrito.objects.filter(pk=carrito.id_carrito).update(fecha_actualizacion=self.hace_40_dias)
+        self.assertEqual(Stock.objects.get(producto=self.producto).reservado, 2)
+
+        call_command('purgar_carritos', stdout=StringIO())
+        self.assertFalse(Carrito.objects.filter(pk=carrito.id_carrito).exists())
+        self.assertEqual(Stock.objects.get(producto=self.producto).reservado, 0)
+        self.assertFalse(ReservaStock.objects.exists())
+
+
+# ==========================================================
+# FUSIÓN DE CARRITOS (tope por stock)
+# ==========================================================
+
+class FusionCarritosTests(TestCase):
+
+    def setUp(self):
+        caches['carritos'].clear()
+        rol = Rol.objects.create(nombre='Cliente')
+        usuario = Usuario.objects.create(nombre='ana', email='ana@tienda.com', contrasena='x', id_rol=rol)
+        self.cliente = Cliente.objects.create(id=usuario)
+        self.mesa = Producto.objects.create(nombre='Mesa', precio=100)
+        self.silla = Producto.objects.create(nombre='Silla', precio=40)
+        fijar_stock({self.mesa.pk: 10, self.silla.pk: 10})
+        self.destino = CarritoBD(carrito_de_cliente(self.cliente))
+        self.destino.fijar(self.mesa, 5)
+
+    def _request(self, token):
+        request = RequestFactory().post('/')
+        request.COOKIES[COOKIE_CARRITO] = token
+        request.session = SessionStore()
+        return request
+
+    def _cantidades(self):
+        return dict(ItemCarrito.objects.filter(carrito_id=self.destino.id_carrito).values_list('producto_id', 'cantidad'))
+
+    def test_persistir_recorta_al_stock_disponible(self):
+        anonimo = CarritoAnonimo()
+        anonimo.fijar_varios({self.mesa: 5, self.silla: 2})
+        # Líneas que el visitante agregó cuando había más stock libre
+        lineas = CarritoAnonimo(anonimo.token).lineas
+        lineas[str(self.mesa.pk)][0] = 8
+        caches['carritos'].set(f'carrito:anonimo:{anonimo.token}', lineas)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            resultado = persistir_carrito_anonimo(self._request(anonimo.token), self.cliente)
+
+        self.assertEqual(resultado, {'movidos': 2, 'limitados': 1})
+        self.assertEqual(self._cantidades(), {self.mesa.pk: 10, self.silla.pk: 2})
+        self.assertEqual(Stock.objects.get(producto=self.mesa).reservado, 10)
+        self.assertEqual(CarritoAnonimo(anonimo.token).lineas, {})  # Reclamado por la fusión
+
+    def test_segundo_inicio_de_sesion_no_vuelve_a_sumar(self):
+        anonimo = CarritoAnonimo()
+        anonimo.fijar(self.silla, 2)
+        # Dos pestañas inician sesión con la misma cookie
+        primera = persistir_carrito_anonimo(self._request(anonimo.token), self.cliente)
+        segunda = persistir_carrito_anonimo(self._request(anonimo.token), self.cliente)
+
+        self.assertEqual((primera['movidos'], segunda['movidos']), (1, 0))
+        self.assertEqual(self._cantidades(), {self.mesa.pk: 5, self.silla.pk: 2})
+
+    def test_fusion_fallida_devuelve_las_lineas(self):
+        anonimo = CarritoAnonimo()
+        anonimo.fijar(self.silla, 2)
+        request = self._request(anonimo.token)
+
+        with mock.patch('ventas_carrito.almacen_carrito._sumar_items', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                persistir_carrito_anonimo(request, self.cliente)
+
+        self.assertEqual(CarritoAnonimo(anonimo.token).cantidad_de(self.silla.pk), 2)
+        self.assertFalse(getattr(request, '_borrar_cookie_carrito', False))
+
+    def test_reservas_ajenas_bajan_el_tope(self):
+        reservar_stock('venta:1', {self.mesa.pk: 3}, ttl=600)
+        origen = Carrito.objects.create(session_key='otra')
+        ItemCarrito.objects.create(carrito=origen, producto=self.mesa, cantidad=4, precio_unitario=100)
+
+        resultado = fusionar_carritos(origen, self.destino)
+
+        # 10 - 3 de la venta: el destino (5 + 4) solo puede llegar a 7
+        self.assertEqual(resultado, {'movidos': 1, 'limitados': 1})
+        self.assertEqual(self._cantidades(), {self.mesa.pk: 7})
+        self.assertEqual(Stock.objects.get(producto=self.mesa).reservado, 10)
+        self.assertFalse(Carrito.objects.filter(pk=origen.pk).exists())
+
+    def test_nunca_baja_lo_que_el_destino_ya_tenia(self):
+        fijar_stock({self.mesa.pk: 5})  # Todo reservado por el destino
+        anonimo = CarritoAnonimo()
+        anonimo.fijar(self.silla, 1)
+        # Línea que el visitante agregó cuando había stock
+        caches['carritos'].set(f'carrito:anonimo:{anonimo.token}', {str(self.mesa.pk): [3, '100']})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            resultado = persistir_carrito_anonimo(self._request(anonimo.token), self.cliente)
+
+        self.assertEqual(resultado, {'movidos': 0, 'limitados': 1})
+        self.assertEqual(self._cantidades(), {self.mesa.pk: 5})
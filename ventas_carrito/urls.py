@@ -10,8 +10,10 @@ app_name = 'ventas_carrito'
 
 urlpatterns = [
     path('carrito/', views.CarritoView.as_view(), name='carrito'),
+    path('carrito/lote/', views.CarritoLoteView.as_view(), name='carrito_lote'),
     path('carrito/management/', views.CarritoManagementView.as_view(), name='carrito_management'),
     path('checkout/', checkout_views.CheckoutView.as_view(), name='checkout'),
+    path('recomendaciones/<int:producto_id>/', views.RecomendacionesView.as_view(), name='recomendaciones'),
     # CU11: Pagos en línea
     path('pagos-online/', pagos_views.PagoOnlineView.as_view(), name='pagos_online'),
     path('pagos-online/<int:pago_id>/', pagos_views.EstadoPagoView.as_view(), name='estado_pago'),
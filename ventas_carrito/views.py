@@ -2,31 +2,64 @@ from django.http import JsonResponse
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from django.contrib.sessions.models import Session
+from django.db.models import Q
 import json
 import logging
 
-from .models import Carrito, ItemCarrito, Venta, DetalleVenta
+from .models import Carrito, Venta, DetalleVenta
+from .almacen_carrito import (
+    CarritoOcupado, CookieCarritoMixin, cliente_de_sesion, fusionar_carritos, obtener_carrito, persistir_carrito_anonimo,
+)
+from .recomendaciones import recomendaciones_producto, recomendaciones_carrito, limite_recomendaciones
 from productos.models import Producto
+from productos.inventario import StockInsuficiente
+from productos.cache_catalogo import etag_datos, respuesta_condicional
 
 logger = logging.getLogger(__name__)
 
+# Productos distintos por petición en la carga por lote
+MAX_ITEMS_LOTE = 200
+
+
+def respuesta_stock_insuficiente(error):
+    """400 cuando otra compra o reserva tomó el stock entre la validación y la reserva"""
+    return JsonResponse({
+        'success': False,
+        'message': 'Stock insuficiente. ' + ', '.join(
+            f"Disponible: {f['disponible']}, solicitado: {f['solicitado']}" for f in error.faltantes
+        ),
+        'errores': [
+            {'producto_id': f['producto_id'], 'message': f"Stock insuficiente. Disponible: {f['disponible']}, solicitado: {f['solicitado']}"}
+            for f in error.faltantes
+        ]
+    }, status=400)
+
+
+def respuesta_carrito_ocupado():
+    """409 cuando otra petición mantiene bloqueado el carrito anónimo"""
+    return JsonResponse({
+        'success': False,
+        'message': 'El carrito se está modificando en otra petición, intenta de nuevo'
+    }, status=409)
+
 
 @method_decorator(csrf_exempt, name='dispatch')
-class CarritoView(View):
+class CarritoView(CookieCarritoMixin, View):
     """CU8 y CU9: Gestión completa del carrito de compras"""
     
     def get(self, request):
         """Obtener el carrito del usuario"""
         try:
-            carrito = self._get_or_create_carrito(request)
+            carrito = obtener_carrito(request)
             
-            items = ItemCarrito.objects.filter(carrito=carrito).select_related('producto')
+            items = carrito.items()
             
+            # Totales a partir de los items ya cargados (sin otra consulta)
             data = {
                 'carrito_id': carrito.id_carrito,
-                'total_items': carrito.get_total_items(),
-                'total_precio': float(carrito.get_total_precio()),
+                'anonimo': carrito.anonimo,
+                'total_items': sum(item.cantidad for item in items),
+                'total_precio': float(sum(item.get_subtotal() for item in items)),
                 'items': []
             }
             
@@ -40,6 +73,9 @@ class CarritoView(View):
                     'precio_unitario': float(item.precio_unitario),
                     'subtotal': float(item.get_subtotal()),
                 })
+
+            # Productos comprados junto a los del carrito
+            data['recomendaciones'] = recomendaciones_carrito(item['producto_id'] for item in data['items'])
             
             return JsonResponse({
                 'success': True,
@@ -81,58 +117,40 @@ class CarritoView(View):
                     'message': 'La cantidad debe ser mayor a 0'
                 }, status=400)
             
-            # Obtener o crear carrito
-            carrito = self._get_or_create_carrito(request)
+            # Obtener carrito (BD si es cliente, caché si es visitante)
+            carrito = obtener_carrito(request)
             
-            # Validar stock disponible
-            from productos.models import Stock
-            stock_obj = Stock.objects.filter(producto=producto).first()
-            stock_disponible = stock_obj.cantidad if stock_obj else 0
+            # Validar stock disponible (total de todas las ubicaciones menos reservas ajenas)
+            disponible = carrito.disponibles([producto.id])[producto.id]
             
             # Calcular cantidad total que se intenta agregar
-            cantidad_actual = 0
-            item_existente = ItemCarrito.objects.filter(
-                carrito=carrito,
-                producto=producto
-            ).first()
-            if item_existente:
-                cantidad_actual = item_existente.cantidad
-            
+            cantidad_actual = carrito.cantidad_de(producto.id)
             cantidad_total = cantidad_actual + cantidad
             
-            if cantidad_total > stock_disponible:
+            if cantidad_total > disponible:
                 return JsonResponse({
                     'success': False,
-                    'message': f'Stock insuficiente. Disponible: {stock_disponible}, solicitado: {cantidad_total}'
+                    'message': f'Stock insuficiente. Disponible: {disponible}, solicitado: {cantidad_total}'
                 }, status=400)
             
-            # Verificar si el producto ya está en el carrito
-            if item_existente:
-                # Actualizar cantidad del item existente
-                item_existente.cantidad = cantidad_total
-                item_existente.save()
+            carrito.fijar(producto, cantidad_total)
+            if cantidad_actual:
                 mensaje = f"Se agregaron {cantidad} unidades más de {producto.nombre}"
             else:
-                # Crear nuevo item en el carrito
-                ItemCarrito.objects.create(
-                    carrito=carrito,
-                    producto=producto,
-                    cantidad=cantidad,
-                    precio_unitario=producto.precio
-                )
                 mensaje = f"{producto.nombre} agregado al carrito"
             
-            # Recargar carrito para obtener total actualizado
-            carrito.refresh_from_db()
-            
             return JsonResponse({
                 'success': True,
                 'message': mensaje,
                 'carrito_id': carrito.id_carrito,
-                'total_items': carrito.get_total_items(),
-                'total_precio': float(carrito.get_total_precio())
+                'anonimo': carrito.anonimo,
+                **carrito.totales()
             }, status=200)
             
+        except StockInsuficiente as e:
+            return respuesta_stock_insuficiente(e)
+        except CarritoOcupado:
+            return respuesta_carrito_ocupado()
         except json.JSONDecodeError:
             return JsonResponse({
                 'success': False,
@@ -158,9 +176,9 @@ class CarritoView(View):
                     'message': 'ID de item y cantidad requeridos'
                 }, status=400)
             
-            try:
-                item = ItemCarrito.objects.select_related('producto').get(id_item=item_id)
-            except ItemCarrito.DoesNotExist:
+            carrito = obtener_carrito(request)
+            item = carrito.item(item_id)
+            if item is None:
                 return JsonResponse({
                     'success': False,
                     'message': 'Item no encontrado'
@@ -168,36 +186,31 @@ class CarritoView(View):
             
             if cantidad <= 0:
                 # Eliminar el item si la cantidad es 0 o menor
-                producto_nombre = item.producto.nombre
-                item.delete()
-                mensaje = f"{producto_nombre} eliminado del carrito"
+                carrito.quitar(item)
+                mensaje = f"{item.producto.nombre} eliminado del carrito"
             else:
-                # Validar stock disponible
-                from productos.models import Stock
-                stock_obj = Stock.objects.filter(producto=item.producto).first()
-                stock_disponible = stock_obj.cantidad if stock_obj else 0
+                # Validar stock disponible (total de todas las ubicaciones menos reservas ajenas)
+                disponible = carrito.disponibles([item.producto_id])[item.producto_id]
                 
-                if cantidad > stock_disponible:
+                if cantidad > disponible:
                     return JsonResponse({
                         'success': False,
-                        'message': f'Stock insuficiente. Disponible: {stock_disponible}, solicitado: {cantidad}'
+                        'message': f'Stock insuficiente. Disponible: {disponible}, solicitado: {cantidad}'
                     }, status=400)
                 
-                item.cantidad = cantidad
-                item.save()
+                carrito.fijar(item.producto, cantidad)
                 mensaje = f"Cantidad de {item.producto.nombre} actualizada"
             
-            # Obtener carrito actualizado
-            carrito = item.carrito
-            carrito.refresh_from_db()
-            
             return JsonResponse({
                 'success': True,
                 'message': mensaje,
-                'total_items': carrito.get_total_items(),
-                'total_precio': float(carrito.get_total_precio())
+                **carrito.totales()
             }, status=200)
             
+        except StockInsuficiente as e:
+            return respuesta_stock_insuficiente(e)
+        except CarritoOcupado:
+            return respuesta_carrito_ocupado()
         except json.JSONDecodeError:
             return JsonResponse({
                 'success': False,
@@ -221,28 +234,24 @@ class CarritoView(View):
                     'message': 'ID de item requerido'
                 }, status=400)
             
-            try:
-                item = ItemCarrito.objects.select_related('producto', 'carrito').get(id_item=item_id)
-                producto_nombre = item.producto.nombre
-                carrito = item.carrito
-                item.delete()
-                
-                # Recargar carrito para obtener total actualizado
-                carrito.refresh_from_db()
-                
-                return JsonResponse({
-                    'success': True,
-                    'message': f"{producto_nombre} eliminado del carrito",
-                    'total_items': carrito.get_total_items(),
-                    'total_precio': float(carrito.get_total_precio())
-                }, status=200)
-                
-            except ItemCarrito.DoesNotExist:
+            carrito = obtener_carrito(request)
+            item = carrito.item(item_id)
+            if item is None:
                 return JsonResponse({
                     'success': False,
                     'message': 'Item no encontrado'
                 }, status=404)
+            
+            carrito.quitar(item)
+            
+            return JsonResponse({
+                'success': True,
+                'message': f"{item.producto.nombre} eliminado del carrito",
+                **carrito.totales()
+            }, status=200)
                 
+        except CarritoOcupado:
+            return respuesta_carrito_ocupado()
         except Exception as e:
             logger.error(f"Error en CarritoView.delete: {str(e)}", exc_info=True)
             return JsonResponse({
@@ -250,46 +259,101 @@ class CarritoView(View):
                 'message': f'Error al eliminar del carrito: {str(e)}'
             }, status=500)
 
-    def _get_or_create_carrito(self, request):
-        """Obtener o crear carrito para el usuario/sesión"""
-        # Si el usuario está autenticado (usando sesión personalizada), usar su carrito
-        if request.session.get('is_authenticated'):
-            try:
-                from autenticacion_usuarios.models import Cliente, Usuario
-                user_id = request.session.get('user_id')
-                if user_id:
-                    usuario = Usuario.objects.get(id=user_id)
-                    # Verificar si es cliente
-                    if usuario.id_rol.nombre.lower() == 'cliente':
-                        try:
-                            cliente = Cliente.objects.get(id=usuario)
-                            carrito, created = Carrito.objects.get_or_create(
-                                cliente=cliente,
-                                activo=True,
-                                defaults={'session_key': None}
-                            )
-                            return carrito
-                        except Cliente.DoesNotExist:
-                            pass
-            except Exception:
-                pass
-        
-        # Si no está autenticado o no es cliente, usar session_key
-        session_key = request.session.session_key
-        if not session_key:
-            request.session.create()
-            session_key = request.session.session_key
-        
-        carrito, created = Carrito.objects.get_or_create(
-            session_key=session_key,
-            activo=True,
-            defaults={'cliente': None}
-        )
-        return carrito
+
+@method_decorator(csrf_exempt, name='dispatch')
+class CarritoLoteView(CookieCarritoMixin, View):
+    """
+    CU8: Añadir varios productos al carrito en una sola petición
+    (lista guardada, "volver a comprar"). Se valida todo antes de escribir:
+    si algún producto no existe o no alcanza el stock no se agrega ninguno.
+    """
+
+    def post(self, request):
+        try:
+            data = json.loads(request.body)
+            cantidades, errores = self._leer_items(data.get('items'))
+            if errores:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Items inválidos',
+                    'errores': errores
+                }, status=400)
+
+            # Productos, stock y cantidades actuales: una consulta cada uno
+            productos = Producto.objects.only('id', 'nombre', 'precio').in_bulk(list(cantidades))
+            carrito = obtener_carrito(request)
+            disponibles = carrito.disponibles(productos)
+            actuales = carrito.cantidades_de(list(productos))
+
+            nuevas = {}
+            for producto_id, cantidad in cantidades.items():
+                producto = productos.get(producto_id)
+                if producto is None:
+                    errores.append({'producto_id': producto_id, 'message': 'Producto no encontrado'})
+                    continue
+                cantidad_total = actuales.get(producto_id, 0) + cantidad
+                if cantidad_total > disponibles[producto_id]:
+                    errores.append({
+                        'producto_id': producto_id,
+                        'message': f'Stock insuficiente. Disponible: {disponibles[producto_id]}, solicitado: {cantidad_total}'
+                    })
+                    continue
+                nuevas[producto] = cantidad_total
+
+            if errores:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'No se agregó ningún producto',
+                    'errores': errores
+                }, status=400)
+
+            carrito.fijar_varios(nuevas)
+
+            return JsonResponse({
+                'success': True,
+                'message': f'{len(nuevas)} productos agregados al carrito',
+                'carrito_id': carrito.id_carrito,
+                'anonimo': carrito.anonimo,
+                **carrito.totales()
+            }, status=200)
+
+        except StockInsuficiente as e:
+            return respuesta_stock_insuficiente(e)
+        except CarritoOcupado:
+            return respuesta_carrito_ocupado()
+        except json.JSONDecodeError:
+            return JsonResponse({
+                'success': False,
+                'message': 'JSON inválido'
+            }, status=400)
+        except Exception as e:
+            logger.error(f"Error en CarritoLoteView.post: {str(e)}", exc_info=True)
+            return JsonResponse({
+                'success': False,
+                'message': f'Error al agregar al carrito: {str(e)}'
+            }, status=500)
+
+    @staticmethod
+    def _leer_items(items):
+        """{producto_id: cantidad} sumando repetidos, y la lista de errores de formato"""
+        if not isinstance(items, list) or not items:
+            return {}, [{'message': 'Se requiere una lista de items con producto_id y cantidad'}]
+        if len(items) > MAX_ITEMS_LOTE:
+            return {}, [{'message': f'Máximo {MAX_ITEMS_LOTE} items por petición'}]
+
+        cantidades, errores = {}, []
+        for posicion, item in enumerate(items):
+            producto_id = item.get('producto_id') if isinstance(item, dict) else None
+            cantidad = item.get('cantidad', 1) if isinstance(item, dict) else None
+            if not isinstance(producto_id, int) or not isinstance(cantidad, int) or cantidad <= 0:
+                errores.append({'posicion': posicion, 'message': 'producto_id y cantidad (mayor a 0) deben ser enteros'})
+                continue
+            cantidades[producto_id] = cantidades.get(producto_id, 0) + cantidad
+        return cantidades, errores
 
 
 @method_decorator(csrf_exempt, name='dispatch')
-class CarritoManagementView(View):
+class CarritoManagementView(CookieCarritoMixin, View):
     """CU9: Gestión avanzada del carrito"""
     
     def post(self, request):
@@ -312,6 +376,8 @@ class CarritoManagementView(View):
                     'message': 'Acción no válida'
                 }, status=400)
                 
+        except CarritoOcupado:
+            return respuesta_carrito_ocupado()
         except json.JSONDecodeError:
             return JsonResponse({
                 'success': False,
@@ -326,70 +392,51 @@ class CarritoManagementView(View):
 
     def _clear_carrito(self, request):
         """CU9: Limpiar completamente el carrito"""
-        carrito = self._get_or_create_carrito(request)
-        ItemCarrito.objects.filter(carrito=carrito).delete()
-        carrito.refresh_from_db()
+        carrito = obtener_carrito(request)
+        carrito.vaciar()
         
         return JsonResponse({
             'success': True,
             'message': 'Carrito limpiado exitosamente',
-            'total_items': carrito.get_total_items(),
-            'total_precio': float(carrito.get_total_precio())
+            'total_items': 0,
+            'total_precio': 0.0
         }, status=200)
 
     def _merge_carritos(self, request, data):
         """CU9: Fusionar carritos (útil cuando un visitante se registra)"""
         carrito_origen_id = data.get('carrito_origen_id')
         
-        if not carrito_origen_id:
+        # Un cliente autenticado incorpora primero su carrito de visitante
+        # (también se hace solo al iniciar sesión)
+        cliente = cliente_de_sesion(request)
+        resultado = persistir_carrito_anonimo(request, cliente) if cliente else {'movidos': 0, 'limitados': 0}
+        
+        if not carrito_origen_id and not resultado['movidos']:
             return JsonResponse({
                 'success': False,
                 'message': 'ID de carrito origen requerido'
             }, status=400)
         
-        try:
-            carrito_origen = Carrito.objects.get(id_carrito=carrito_origen_id)
-            carrito_destino = self._get_or_create_carrito(request)
-            
-            # Mover items del carrito origen al destino
-            items_origen = ItemCarrito.objects.filter(carrito=carrito_origen)
-            items_movidos = 0
-            
-            for item in items_origen:
-                # Verificar si el producto ya existe en el carrito destino
-                item_existente = ItemCarrito.objects.filter(
-                    carrito=carrito_destino,
-                    producto=item.producto
-                ).first()
-                
-                if item_existente:
-                    # Sumar cantidades
-                    item_existente.cantidad += item.cantidad
-                    item_existente.save()
-                else:
-                    # Crear nuevo item
-                    ItemCarrito.objects.create(
-                        carrito=carrito_destino,
-                        producto=item.producto,
-                        cantidad=item.cantidad,
-                        precio_unitario=item.precio_unitario
-                    )
-                items_movidos += 1
-            
-            # Eliminar carrito origen
-            carrito_origen.delete()
-            
-            return JsonResponse({
-                'success': True,
-                'message': f'Carrito fusionado exitosamente. {items_movidos} items movidos.',
-                'carrito_id': carrito_destino.id_carrito
-            }, status=200)
-            
-        except Carrito.DoesNotExist:
-            return JsonResponse({
-                'success': False,
-                'message': 'Carrito origen no encontrado'
-            }, status=404)
+        carrito_destino = obtener_carrito(request)
+        if carrito_origen_id:
+            # Solo carritos de visitante o del propio cliente
+            carrito_origen = Carrito.objects.filter(
+                Q(cliente__isnull=True) | Q(cliente=cliente), id_carrito=carrito_origen_id
+            ).exclude(id_carrito=carrito_destino.id_carrito).first()
+            if carrito_origen is None:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Carrito origen no encontrado'
+                }, status=404)
+            fusion = fusionar_carritos(carrito_origen, carrito_destino)
+            resultado = {clave: resultado[clave] + fusion[clave] for clave in resultado}
+        
+        return JsonResponse({
+            'success': True,
+            'message': f"Carrito fusionado exitosamente. {resultado['movidos']} items movidos.",
+            'carrito_id': carrito_destino.id_carrito,
+            'items_limitados_por_stock': resultado['limitados']
+        }, status=200)
 
     def _save_for_later(self, request, data):
         """CU9: Guardar item para más tarde (marcar como favorito)"""
@@ -401,22 +448,21 @@ class CarritoManagementView(View):
                 'message': 'ID de item requerido'
             }, status=400)
         
-        try:
-            item = ItemCarrito.objects.get(id_item=item_id)
-            # Por ahora solo eliminamos del carrito, en el futuro se podría guardar en una tabla de favoritos
-            producto_nombre = item.producto.nombre
-            item.delete()
-            
-            return JsonResponse({
-                'success': True,
-                'message': f'{producto_nombre} guardado para más tarde'
-            }, status=200)
-            
-        except ItemCarrito.DoesNotExist:
+        carrito = obtener_carrito(request)
+        item = carrito.item(item_id)
+        if item is None:
             return JsonResponse({
                 'success': False,
                 'message': 'Item no encontrado'
             }, status=404)
+        
+        # Por ahora solo eliminamos del carrito, en el futuro se podría guardar en una tabla de favoritos
+        carrito.quitar(item)
+        
+        return JsonResponse({
+            'success': True,
+            'message': f'{item.producto.nombre} guardado para más tarde'
+        }, status=200)
 
     def _apply_discount(self, request, data):
         """CU9: Aplicar descuento al carrito"""
@@ -429,7 +475,7 @@ class CarritoManagementView(View):
                 'message': 'Código de descuento o porcentaje requerido'
             }, status=400)
         
-        carrito = self._get_or_create_carrito(request)
+        carrito = obtener_carrito(request)
         
         # Por simplicidad, aplicamos un descuento del 10% si se proporciona código
         if codigo_descuento:
@@ -442,15 +488,7 @@ class CarritoManagementView(View):
                 }, status=400)
         
         # Aplicar descuento a todos los items del carrito
-        items = ItemCarrito.objects.filter(carrito=carrito)
-        items_actualizados = 0
-        
-        for item in items:
-            precio_original = item.producto.precio
-            precio_descuento = precio_original * (1 - porcentaje / 100)
-            item.precio_unitario = precio_descuento
-            item.save()
-            items_actualizados += 1
+        items_actualizados = carrito.descontar(porcentaje)
         
         return JsonResponse({
             'success': True,
@@ -458,39 +496,30 @@ class CarritoManagementView(View):
             'descuento_aplicado': porcentaje
         }, status=200)
 
-    def _get_or_create_carrito(self, request):
-        """Método auxiliar para obtener o crear carrito"""
-        # Si el usuario está autenticado (usando sesión personalizada), usar su carrito
-        if request.session.get('is_authenticated'):
-            try:
-                from autenticacion_usuarios.models import Cliente, Usuario
-                user_id = request.session.get('user_id')
-                if user_id:
-                    usuario = Usuario.objects.get(id=user_id)
-                    # Verificar si es cliente
-                    if usuario.id_rol.nombre.lower() == 'cliente':
-                        try:
-                            cliente = Cliente.objects.get(id=usuario)
-                            carrito, created = Carrito.objects.get_or_create(
-                                cliente=cliente,
-                                activo=True,
-                                defaults={'session_key': None}
-                            )
-                            return carrito
-                        except Cliente.DoesNotExist:
-                            pass
-            except Exception:
-                pass
-        
-        # Si no está autenticado o no es cliente, usar session_key
-        session_key = request.session.session_key
-        if not session_key:
-            request.session.create()
-            session_key = request.session.session_key
-        
-        carrito, created = Carrito.objects.get_or_create(
-            session_key=session_key,
-            activo=True,
-            defaults={'cliente': None}
-        )
-        return carrito
\ No newline at end of file
+
+# ==========================================================
+# CU10: RECOMENDACIONES "COMPRADOS JUNTOS"
+# ==========================================================
+
+@method_decorator(csrf_exempt, name='dispatch')
+class RecomendacionesView(View):
+    """Productos comprados frecuentemente junto a un producto (página de producto)"""
+
+    def get(self, request, producto_id):
+        try:
+            etag = etag_datos('recomendaciones', request, 'recomendaciones', 'catalogo', extra=str(producto_id))
+            return respuesta_condicional(request, etag, lambda: self._listar(request, producto_id))
+        except Exception as e:
+            logger.error(f"Error en RecomendacionesView.get: {str(e)}", exc_info=True)
+            return JsonResponse({
+                'success': False,
+                'message': f'Error al obtener recomendaciones: {str(e)}'
+            }, status=500)
+
+    def _listar(self, request, producto_id):
+        limite = limite_recomendaciones(request.GET.get('limit'))
+        return JsonResponse({
+            'success': True,
+            'producto_id': producto_id,
+            'items': recomendaciones_producto(producto_id, limite),
+        }, status=200)